@@ -0,0 +1,152 @@
+import re
+import threading
+
+# Compiled glob patterns, cleared whenever it gets too big
+regex_cache = {}
+REGEX_CACHE_SIZE = 1000
+
+
+class Batch(object):
+    __slots__ = ('items', 'full', 'done', 'results', 'error')
+
+    def __init__(self):
+        self.items = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class Batcher(object):
+    """
+    Collects the items submitted under the same key within "window" seconds
+    and handles them together.  The first thread to submit an item for a
+    key waits out the window (or until "max_items" are in), then calls
+    run(key, items), which must return one result per item.  The other
+    threads just wait for their result, or get the exception run raised.
+    """
+
+    def __init__(self, window, run, max_items=None):
+        self.window = window
+        self.run = run
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def submit(self, key, item):
+        with self.lock:
+            batch = self.pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.pending[key] = Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            if self.max_items and len(batch.items) >= self.max_items:
+                del self.pending[key]
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.window)
+            with self.lock:
+                if self.pending.get(key) is batch:
+                    del self.pending[key]
+            try:
+                batch.results = self.run(key, batch.items)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+
+    def after_fork(self):
+        # The leaders of the pending batches stayed in the parent
+        self.lock = threading.Lock()
+        self.pending = {}
+
+
+def glob_to_regex(pattern):
+    # Compiles a graphite glob, where "*", "?" and "[...]" don't match
+    # across "." and "{a,b}" matches either alternative
+    regex = regex_cache.get(pattern)
+    if regex is not None:
+        return regex
+    out = []
+    in_brace = False
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            out.append('[^.]*')
+        elif c == '?':
+            out.append('[^.]')
+        elif c == '[':
+            j = pattern.find(']', i + 1)
+            if j == -1:
+                out.append('\\[')
+            else:
+                body = pattern[i:j].replace('\\', '\\\\')
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                out.append('[%s]' % body)
+                i = j + 1
+        elif c == '{' and not in_brace:
+            out.append('(?:')
+            in_brace = True
+        elif c == ',' and in_brace:
+            out.append('|')
+        elif c == '}' and in_brace:
+            out.append(')')
+            in_brace = False
+        else:
+            out.append(re.escape(c))
+    regex = re.compile(''.join(out) + r'\Z')
+    if len(regex_cache) >= REGEX_CACHE_SIZE:
+        regex_cache.clear()
+    regex_cache[pattern] = regex
+    return regex
+
+
+def cover_patterns(patterns, max_alternatives=50):
+    # Groups glob patterns that only differ in one component, and returns
+    # a list of (covering pattern, [patterns]) where the covering pattern
+    # lists the different values as "{a,b,...}" alternatives
+    covers = []  # [parts, index of the differing component, alternatives]
+    seen = set()
+    for pattern in patterns:
+        if pattern in seen:
+            continue
+        seen.add(pattern)
+        parts = pattern.split('.')
+        for cover in covers:
+            if len(cover[0]) != len(parts) or \
+                    len(cover[2]) >= max_alternatives:
+                continue
+            diff = [i for i, (a, b) in enumerate(zip(cover[0], parts))
+                    if a != b and i != cover[1]]
+            if cover[1] is None and len(diff) == 1:
+                index = diff[0]
+                if '{' in cover[0][index] or '{' in parts[index]:
+                    continue
+                cover[1] = index
+                cover[2][0][1] = cover[0][index]
+            elif diff or cover[1] is None or '{' in parts[cover[1]]:
+                continue
+            cover[2].append([pattern, parts[cover[1]]])
+            break
+        else:
+            covers.append([parts, None, [[pattern, None]]])
+    result = []
+    for parts, index, alternatives in covers:
+        members = [p for p, _ in alternatives]
+        if index is None:
+            result.append((members[0], members))
+            continue
+        parts = list(parts)
+        parts[index] = '{%s}' % ','.join(a for _, a in alternatives)
+        result.append(('.'.join(parts), members))
+    return result
@@ -1,17 +1,37 @@
 from __future__ import absolute_import
 
 import Queue
-import json
+import copy
 import logging
 import threading
 import time
 
-import requests
-
 import fnmatch
 import os.path
 import importlib
+import requests
 from blueflood_graphite_finder import auth
+from blueflood_graphite_finder import codec
+from blueflood_graphite_finder import context
+from blueflood_graphite_finder import intervals
+from blueflood_graphite_finder import lifecycle
+from blueflood_graphite_finder import offload
+from blueflood_graphite_finder import scheduler
+from blueflood_graphite_finder import slowlog
+from blueflood_graphite_finder import tracing
+from blueflood_graphite_finder import transport
+from blueflood_graphite_finder.batching import Batcher, cover_patterns, \
+    glob_to_regex
+from blueflood_graphite_finder.breaker import AdmissionQueue
+from blueflood_graphite_finder.cache import LRUCache
+from blueflood_graphite_finder.errors import BluefloodError
+from blueflood_graphite_finder.events import EventsCache
+from blueflood_graphite_finder.guard import QueryGuard
+from blueflood_graphite_finder.rollup_cache import RollupCache
+from blueflood_graphite_finder.shared_cache import decode_metrics, \
+    decode_nodes, decode_series, encode_metrics, encode_nodes, \
+    encode_series, make_cache
+from blueflood_graphite_finder.warmer import CacheWarmer
 
 logger = logging.getLogger('blueflood_finder')
 
@@ -37,8 +57,23 @@ secs_per_res = {
     'MIN240': 240 * 60,
     'MIN1440': 1440 * 60}
 
+# Blueflood resolutions, finest first
+res_order = ['FULL', 'MIN5', 'MIN20', 'MIN60', 'MIN240', 'MIN1440']
+
+# Stands for a datapoint that doesn't have the value asked for
+MISSING = object()
+
 
-def calc_res(start, stop):
+def get_option(config, name, default=None):
+    # Reads an option from the "blueflood" section of the graphite-api
+    # config, or from the matching BF_* django setting under graphite-web
+    if config is not None:
+        return config.get('blueflood', {}).get(name, default)
+    from django.conf import settings
+    return getattr(settings, 'BF_' + name.upper(), default)
+
+
+def calc_res(start, stop, max_points=None):
     # make an educated guess about the likely number of data points returned.
     num_points = (stop - start) / 60
     res = 'FULL'
@@ -61,10 +96,29 @@ def calc_res(start, stop):
         res = 'MIN20'
     elif num_points > 400:
         res = 'MIN5'
-    logger.debug("calc_res: num_points=%d, res=%s", num_points, res)
+    if max_points:
+        # The caller can only display "max_points" points, so step up to
+        # the coarsest rollup that still returns at least that many.  We
+        # never go finer than the guess above.
+        i = res_order.index(res)
+        while i + 1 < len(res_order) and \
+                (stop - start) / secs_per_res[res_order[i + 1]] >= max_points:
+            i += 1
+        res = res_order[i]
+    logger.debug("calc_res: num_points=%d, max_points=%s, res=%s",
+                 num_points, max_points, res)
     return res
 
 
+def requested_max_data_points(default=None):
+    # graphite-api doesn't hand maxDataPoints to the finders, so pick it
+    # up from the render request when there is one
+    try:
+        return int(float(context.get_request_param('maxDataPoints')))
+    except (TypeError, ValueError):
+        return default
+
+
 class TenantBluefloodFinder(threading.Thread):
     __fetch_multi__ = 'tenant_blueflood'
     __fetch_events__ = 'tenant_blueflood'
@@ -100,6 +154,67 @@ class TenantBluefloodFinder(threading.Thread):
             submetric_aliases = getattr(settings,
                                         'BF_SUBMETRIC_ALIASES', {})
 
+        # In multi-tenant mode the tenant comes with each request, either as
+        # the first component of the metric paths ("prefix") or from a
+        # request header ("header").  "tenant" is then only the default.
+        self.multi_tenant = get_option(config, 'multi_tenant')
+        self.tenant_header = get_option(config, 'tenant_header',
+                                        'X-Tenant-Id')
+        self.tenants = get_option(config, 'tenants')
+        self.tenant_views = LRUCache(1000)
+        # Share of each cache a single tenant may use
+        tenant_share = get_option(config, 'tenant_cache_share', 0.25)
+        if not self.multi_tenant:
+            tenant_share = None
+
+        def tenant_quota(size):
+            return None if tenant_share is None else int(size * tenant_share)
+
+        codec.configure(get_option(config, 'json_codec'))
+        breaker_options = get_option(config, 'circuit_breaker', {})
+        transport.configure(get_option(config, 'connection_pool_size', 10),
+                            get_option(config, 'request_timeout', 60),
+                            None if breaker_options is False
+                            else breaker_options,
+                            get_option(config, 'max_retries', 2),
+                            get_option(config, 'retry_backoff', 0.1),
+                            get_option(config, 'retry_max_backoff', 2))
+        scheduler.configure(get_option(config, 'scheduler'))
+        tracing.configure(get_option(config, 'tracing'))
+        # Seconds a render may spend waiting on Blueflood, retries included
+        self.render_deadline = get_option(config, 'render_deadline')
+        slowlog.configure(get_option(config, 'slow_query_threshold'),
+                          get_option(config, 'slow_query_profile_rate', 0),
+                          get_option(config, 'slow_query_profile_dir'),
+                          get_option(config, 'slow_query_profile_keep', 100))
+        offload.configure(get_option(config, 'process_pool_size', 0),
+                          get_option(config, 'process_pool_min_series', 100),
+                          get_option(config, 'process_pool_timeout', 30))
+        max_concurrent_renders = get_option(config, 'max_concurrent_renders')
+        self.admission = None
+        if max_concurrent_renders:
+            self.admission = AdmissionQueue(
+                max_concurrent_renders,
+                get_option(config, 'max_queued_renders', 0),
+                get_option(config, 'render_queue_timeout', 5))
+        max_data_points = get_option(config, 'max_data_points')
+        interval_cache_size = get_option(config, 'interval_cache_size',
+                                         100000)
+        if interval_cache_size:
+            intervals.set_tracker(intervals.IntervalTracker(
+                interval_cache_size,
+                get_option(config, 'interval_cache_ttl', 3600),
+                tenant_quota=tenant_quota(interval_cache_size)))
+        else:
+            intervals.set_tracker(None)
+        rollup_cache_dir = get_option(config, 'rollup_cache_dir')
+        rollup_cache = None
+        if rollup_cache_dir:
+            rollup_cache = RollupCache(
+                rollup_cache_dir,
+                get_option(config, 'rollup_cache_max_bytes', 1 << 30),
+                settle=get_option(config, 'rollup_cache_settle'))
+
         if authentication_module:
             module = importlib.import_module(authentication_module)
             class_ = getattr(module, authentication_class)
@@ -110,18 +225,141 @@ class TenantBluefloodFinder(threading.Thread):
         self.metrics_q = Queue.Queue(1)
         self.data_q = Queue.Queue(1)
 
+        # Searches that came back empty or failed are answered from here
+        # for a little while instead of being sent again
+        negative_cache_size = get_option(config, 'negative_cache_size',
+                                         10000)
+        self.negative_cache = None
+        if negative_cache_size:
+            self.negative_cache = LRUCache(
+                negative_cache_size,
+                get_option(config, 'negative_cache_ttl', 60),
+                tenant_quota(negative_cache_size))
+
+        # Searches arriving within this many seconds of each other are
+        # merged into as few Blueflood requests as possible
+        find_batch_window = get_option(config, 'find_batch_window', 0)
+        self.find_batcher = None
+        if find_batch_window:
+            self.find_batcher = Batcher(
+                find_batch_window, self.search_nodes_batch,
+                get_option(config, 'find_batch_size', 50))
+
+        events_cache_size = get_option(config, 'events_cache_size', 10000)
+        self.events_cache = None
+        if events_cache_size:
+            self.events_cache = EventsCache(
+                events_cache_size,
+                get_option(config, 'events_cache_ttl', 3600),
+                tenant_quota=tenant_quota(events_cache_size))
+
+        # Limits on what a single fetch may cost
+        query_guard = get_option(config, 'query_guard')
+        self.guard = None
+        if query_guard:
+            self.guard = QueryGuard(**query_guard)
+
+        # Search and datapoint results shared with other workers and hosts
+        shared_cache = get_option(config, 'shared_cache')
+        self.shared_cache = None
+        if shared_cache:
+            self.shared_cache = make_cache(shared_cache)
+
         self.tenant = tenant
         self.bf_query_endpoint = urls[0]
         self.enable_submetrics = enable_submetrics
         self.submetric_aliases = submetric_aliases
+        logger.info('Blueflood Finder statsd ' + str(enable_statsd))
         self.client = BluefloodClient(self.bf_query_endpoint,
                                       self.tenant,
                                       self.enable_submetrics,
                                       self.submetric_aliases,
-                                      enable_statsd)
-        self.daemon = True
-        self.start()
+                                      enable_statsd,
+                                      max_data_points=max_data_points,
+                                      rollup_cache=rollup_cache,
+                                      partial_results=get_option(
+                                          config, 'partial_results', False),
+                                      fetch_batch_window=get_option(
+                                          config, 'fetch_batch_window', 0),
+                                      shared_cache=self.shared_cache,
+                                      align_windows=get_option(
+                                          config, 'align_windows', False),
+                                      guard=self.guard,
+                                      skip_dead_metrics=get_option(
+                                          config, 'skip_dead_metrics',
+                                          False))
+        # Searches run before the workers are forked, which all of them
+        # share read-only for "prewarm_ttl" seconds
+        self.prewarmed = {}
+        self.prewarmed_until = 0
+        self.prewarm_ttl = get_option(config, 'prewarm_ttl', 300)
+        self.background = None
+        self.start_background()
+        lifecycle.register_object(self)
+        # Keeps the caches of the busiest dashboards hot
+        cache_warmer = get_option(config, 'cache_warmer')
+        self.warmer = None
+        if cache_warmer:
+            self.warmer = CacheWarmer(self, **cache_warmer)
         logger.debug("BF finder submetrics enabled: %s", enable_submetrics)
+        prewarm_patterns = get_option(config, 'prewarm_patterns', [])
+        if get_option(config, 'prewarm', False) or prewarm_patterns:
+            self.prewarm(prewarm_patterns)
+
+    def start_background(self):
+        # One thread per process does the queued reads
+        self.background = threading.Thread(target=self.run,
+                                           name='blueflood-finder')
+        self.background.daemon = True
+        self.background.start()
+
+    def after_fork(self):
+        # Runs in the processes forked from the one that made the finder.
+        # What is cached is still good, the locks, queues, batches and
+        # thread are made anew.
+        self.metrics_q = Queue.Queue(1)
+        self.data_q = Queue.Queue(1)
+        for obj in (self.tenant_views, self.negative_cache,
+                    self.events_cache, self.find_batcher, self.admission,
+                    self.client.fetch_batcher, self.client.rollup_cache):
+            if obj is not None:
+                obj.after_fork()
+        self.start_background()
+
+    def prewarm(self, patterns=()):
+        """
+        Gets the auth token and runs the Blueflood searches of "patterns"
+        ahead of time, so the workers forked from this process start with
+        them instead of each doing them again.
+        """
+        try:
+            auth.get_token()
+        except Exception:
+            logger.exception("Can't get the auth token ahead of time")
+        self.prewarmed = {}
+        prewarmed = {}
+        for pattern in patterns:
+            try:
+                if self.enable_submetrics:
+                    kind = 'metrics'
+                    result = self.find_metrics_with_enum_values(pattern)
+                else:
+                    kind = 'nodes'
+                    _, result = self.search_nodes(pattern)
+            except Exception:
+                logger.exception("Can't prewarm [%s]", pattern)
+                continue
+            if result:
+                prewarmed[(self.tenant, kind, pattern)] = result
+        self.prewarmed_until = time.time() + self.prewarm_ttl
+        self.prewarmed = prewarmed
+        logger.info("Prewarmed %d of %d searches", len(prewarmed),
+                    len(patterns))
+
+    def prewarmed_result(self, kind, query):
+        if not self.prewarmed or time.time() > self.prewarmed_until:
+            return None
+        return self.prewarmed.get((self.tenant, kind, query))
 
     def run(self):
         # This separate thread allows queued reads to happen in the background
@@ -135,23 +373,106 @@ class TenantBluefloodFinder(threading.Thread):
         metric_parts = metric.split('.')
         return (len(metric_parts) == complete_len)
 
-    def make_request(self, url, payload, headers):
-        if auth.is_active():
-            headers['X-Auth-Token'] = auth.get_token(False)
-        r = requests.get(url, params=payload, headers=headers)
-        if r.status_code == 401 and auth.is_active():
-            headers['X-Auth-Token'] = auth.get_token(True)
-            r = requests.get(url, params=payload, headers=headers)
-        return r
+    def make_request(self, url, payload, headers, kind='search'):
+        with transport.budget(self.render_deadline):
+            return transport.get(url, payload, headers, kind)
+
+    def request_tenant(self):
+        # The tenant of the request being served
+        if self.multi_tenant == 'header':
+            return context.get_request_header(self.tenant_header,
+                                              self.tenant)
+        return self.tenant
+
+    def tenant_allowed(self, tenant):
+        return tenant is not None and \
+            (not self.tenants or tenant in map(str, self.tenants))
+
+    def for_tenant(self, tenant):
+        # Returns a finder for another tenant.  It's a shallow copy, so the
+        # caches, auth and connection pool are shared and only the tenant
+        # and its client differ.
+        if tenant == self.tenant:
+            return self
+        view = self.tenant_views.get(tenant)
+        if view is None:
+            view = copy.copy(self)
+            view.tenant = tenant
+            view.client = self.client.for_tenant(tenant)
+            self.tenant_views.put(tenant, view)
+        return view
+
+    def known_empty(self, kind, query):
+        # True if the search was recently found to have no results
+        if self.negative_cache is None:
+            return False
+        status = self.negative_cache.get((self.tenant, kind, query))
+        if status is None:
+            return False
+        logger.debug("negative cache hit: %s [%s] status [%s]",
+                     kind, query, status)
+        return True
+
+    def remember_empty(self, kind, query, status):
+        # Auth failures say nothing about the query, so aren't cached
+        if self.negative_cache is not None and status not in (401, 403):
+            self.negative_cache.put((self.tenant, kind, query), status)
+
+    def cache_stats(self):
+        stats = {'tenant_views': self.tenant_views.stats()}
+        if self.negative_cache is not None:
+            stats['negative'] = self.negative_cache.stats()
+        if self.shared_cache is not None:
+            stats['shared'] = self.shared_cache.stats()
+        if self.warmer is not None:
+            stats['warmer'] = self.warmer.stats()
+        if self.guard is not None:
+            stats['guard'] = self.guard.stats()
+        return stats
 
     def find_nodes_endpoint(self, endpoint, tenant):
         return "%s/v2.0/%s/metric_name/search" % (endpoint, tenant)
 
     def find_nodes_from_bf(self, query):
         logger.info("BluefloodClient.find_nodes_from_bf: %s", str(query))
-        payload = {'query': query.pattern}
+        nodes = self.prewarmed_result('nodes', query.pattern)
+        if nodes is not None:
+            return nodes
+        if self.known_empty('nodes', query.pattern):
+            return []
+        if self.find_batcher is None:
+            status, nodes = self.search_nodes(query.pattern)
+        else:
+            key = (self.tenant, query.pattern.count('.'))
+            status, nodes = self.find_batcher.submit(key, query.pattern)
+        if status != 200 or not nodes:
+            self.remember_empty('nodes', query.pattern, status)
+        if status != 200:
+            return []
+        return nodes
+
+    def search_nodes(self, pattern):
+        # Returns the status code and nodes of a BF metric_name search
+        cache = self.shared_cache
+        if cache is None:
+            return self.request_nodes(pattern)
+
+        def encode(result):
+            status, nodes = result
+            if status == 200 and nodes:
+                return encode_nodes(nodes)
+
+        def decode(data):
+            nodes = decode_nodes(data)
+            if nodes is not None:
+                return 200, nodes
+        return cache.fetch(cache.key('nodes', self.tenant, pattern),
+                           lambda: self.request_nodes(pattern),
+                           encode, decode, cache.find_ttl)
+
+    def request_nodes(self, pattern):
+        payload = {'query': pattern}
         headers = auth.headers()
-
         endpoint = self.find_nodes_endpoint(self.bf_query_endpoint,
                                             self.tenant)
         r = self.make_request(endpoint, payload, headers)
@@ -160,8 +481,29 @@ class TenantBluefloodFinder(threading.Thread):
             logger.info("BF(find_metrics_with_enum_values) responded "
                         "with response code: [%s] endpoint [%s]",
                         r.status_code, endpoint)
-
-        return r.json()
+            return r.status_code, None
+        return r.status_code, codec.decode(r)
+
+    def search_nodes_batch(self, key, patterns):
+        # Runs the searches of one tenant batched together, each group of
+        # patterns differing in only one component is sent as a single
+        # search whose results are then split back up
+        finder = self.for_tenant(key[0])
+        results = {}
+        for cover, members in cover_patterns(patterns,
+                                             self.find_batcher.max_items):
+            status, nodes = finder.search_nodes(cover)
+            if len(members) == 1 or status != 200:
+                for p in members:
+                    results[p] = (status, nodes)
+                continue
+            logger.debug("search_nodes_batch: %d patterns as [%s]",
+                         len(members), cover)
+            for p in members:
+                regex = glob_to_regex(p)
+                results[p] = (status, [n for n in nodes
+                                       if regex.match(next(iter(n)))])
+        return [results[p] for p in patterns]
 
     def find_metrics_endpoint(self, endpoint, tenant):
         return "%s/v2.0/%s/metrics/search?include_enum_values=true" % (
@@ -170,6 +512,20 @@ class TenantBluefloodFinder(threading.Thread):
     def find_metrics_with_enum_values(self, query):
         # BF search command that returns enum values as well as metric names
         logger.info("BluefloodClient.find_metrics: %s", str(query))
+        result = self.prewarmed_result('metrics', query)
+        if result is not None:
+            return result
+        if self.known_empty('metrics', query):
+            return {}
+        cache = self.shared_cache
+        if cache is None:
+            return self.request_metrics(query)
+        return cache.fetch(cache.key('metrics', self.tenant, query),
+                           lambda: self.request_metrics(query),
+                           lambda m: encode_metrics(m) if m else None,
+                           decode_metrics, cache.find_ttl)
+
+    def request_metrics(self, query):
         payload = {'query': query}
         headers = auth.headers()
         endpoint = self.find_metrics_endpoint(self.bf_query_endpoint,
@@ -177,17 +533,20 @@ class TenantBluefloodFinder(threading.Thread):
         r = self.make_request(endpoint, payload, headers)
         ret_dict = {}
         if r.status_code == 200:
-            for m in r.json():
+            for m in codec.decode(r):
                 if 'enum_values' in m:
                     v = m['enum_values']
                 else:
                     v = None
                 ret_dict[m['metric']] = v
+            if not ret_dict:
+                self.remember_empty('metrics', query, r.status_code)
             return ret_dict
         else:
             logger.info("BF(find_metrics_with_enum_values) responded with "
                         "response code: [%s] endpoint [%s]",
                         r.status_code, endpoint)
+            self.remember_empty('metrics', query, r.status_code)
             return {}
 
     def find_metrics(self, query):
@@ -321,41 +680,180 @@ class TenantBluefloodFinder(threading.Thread):
         to the BF "/search" endpoint.
         """
         # yields all valid metric names matching glob based query
+        lifecycle.check()
+        if self.warmer is not None:
+            self.warmer.start()
+            tenant = None
+            if self.multi_tenant == 'header':
+                tenant = self.request_tenant()
+            self.warmer.observe(query, tenant)
+        if tracing.enabled():
+            return tracing.traced('find_nodes',
+                                  lambda: self.untraced_nodes(query),
+                                  tenant=self.request_tenant(),
+                                  pattern=query.pattern)
+        return self.untraced_nodes(query)
+
+    def untraced_nodes(self, query):
+        if slowlog.enabled():
+            return self.logged_nodes(query)
+        return self.find_query_nodes(query)
+
+    def logged_nodes(self, query):
+        # find_query_nodes, timed for the slow-query log.  The query is
+        # only active while the finder itself is working.
+        q = slowlog.start('find_nodes', pattern=query.pattern)
+        nodes = 0
+        try:
+            with slowlog.active(q):
+                it = iter(self.find_query_nodes(query))
+            while True:
+                with slowlog.active(q):
+                    try:
+                        node = next(it)
+                    except StopIteration:
+                        break
+                nodes += 1
+                yield node
+        finally:
+            if q is not None:
+                q.fields['nodes'] = nodes
+            slowlog.finish(q)
+
+    def find_query_nodes(self, query):
         try:
             logger.debug("TenantBluefloodFinder.query: %s", str(query.pattern))
 
-            if self.enable_submetrics:
-                return self.find_nodes_with_submetrics(query)
-            else:
-                return self.find_nodes_without_submetrics(query)
+            if self.multi_tenant == 'prefix':
+                return self.find_prefixed_nodes(query)
+            finder = self
+            if self.multi_tenant == 'header':
+                tenant = self.request_tenant()
+                if not self.tenant_allowed(tenant):
+                    logger.info("find_nodes: unknown tenant [%s]", tenant)
+                    return iter([])
+                finder = self.for_tenant(tenant)
+            return finder.find_tenant_nodes(query)
 
         except Exception as e:
             logger.exception("Exception in Blueflood find_nodes: ")
             raise e
 
-    def fetch_multi(self, nodes, start_time, end_time):
+    def find_tenant_nodes(self, query):
+        if self.enable_submetrics:
+            return self.find_nodes_with_submetrics(query)
+        else:
+            return self.find_nodes_without_submetrics(query)
+
+    def find_prefixed_nodes(self, query):
+        # The first component of the pattern selects the tenants, the rest
+        # is searched for in each of them
+        parts = query.pattern.split('.', 1)
+        if any(c in parts[0] for c in '*?[{'):
+            tenants = [t for t in map(str, self.tenants or [])
+                       if fnmatch.fnmatchcase(t, parts[0])]
+        elif self.tenant_allowed(parts[0]):
+            tenants = [parts[0]]
+        else:
+            tenants = []
+        if len(parts) == 1:
+            return (BranchNode(t) for t in tenants)
+        return self.prefix_nodes(tenants, parts[1], query)
+
+    def prefix_nodes(self, tenants, pattern, query):
+        for tenant in tenants:
+            tenant_query = copy.copy(query)
+            tenant_query.pattern = pattern
+            finder = self.for_tenant(tenant)
+            for n in finder.find_tenant_nodes(tenant_query):
+                path = '%s.%s' % (tenant, n.path)
+                if n.is_leaf:
+                    yield TenantBluefloodLeafNode(path, n.reader)
+                else:
+                    yield BranchNode(path)
+
+    def fetch_multi(self, nodes, start_time, end_time, max_data_points=None):
         """
         Returns the data for a list of metrics and corresponds to the BF
         "multiplot" endpoint.
         """
-        return self.client.fetch_multi(nodes, start_time, end_time)
+        lifecycle.check()
+        if self.warmer is not None:
+            self.warmer.start()
+        target = context.get_request_param('target')
+        with transport.budget(self.render_deadline), \
+                slowlog.timed('fetch_multi', nodes=len(nodes),
+                              pattern=target), \
+                tracing.span('fetch_multi', tenant=self.request_tenant(),
+                             nodes=len(nodes), start=start_time,
+                             end=end_time, pattern=target):
+            if self.admission is None:
+                return self.fetch_tenant_multi(nodes, start_time, end_time,
+                                               max_data_points)
+            slowlog.phase('queue')
+            with self.admission:
+                return self.fetch_tenant_multi(nodes, start_time, end_time,
+                                               max_data_points)
+
+    def fetch_tenant_multi(self, nodes, start_time, end_time,
+                           max_data_points):
+        if not self.multi_tenant or not nodes:
+            return self.client.fetch_multi(nodes, start_time, end_time,
+                                           max_data_points)
+        # Nodes know their tenant, fetch each tenant's separately
+        tenant_nodes = {}
+        for n in nodes:
+            tenant_nodes.setdefault(n.reader.tenant, []).append(n)
+        dictionary = {}
+        for tenant, t_nodes in tenant_nodes.items():
+            prefix = ''
+            if self.multi_tenant == 'prefix':
+                prefix = '%s.' % tenant
+                t_nodes = [TenantNode(n.path[len(prefix):], n.reader)
+                           for n in t_nodes]
+            client = self.for_tenant(tenant).client
+            time_info, series = client.fetch_multi(t_nodes, start_time,
+                                                   end_time, max_data_points)
+            for path, values in series.items():
+                dictionary[prefix + path] = values
+        return (time_info, dictionary)
 
     def find_events_endpoint(self, endpoint, tenant):
         return "%s/v2.0/%s/events/getEvents" % (endpoint, tenant)
 
     def getEvents(self, start_time, end_time, tags):
+        lifecycle.check()
+        finder = self
+        if self.multi_tenant:
+            finder = self.for_tenant(self.request_tenant())
+        with tracing.span('getEvents', tenant=finder.tenant, tags=tags,
+                          start=start_time, end=end_time) as span:
+            events = finder.get_tenant_events(start_time, end_time, tags)
+            span.set(events=len(events))
+            return events
+
+    def get_tenant_events(self, start_time, end_time, tags):
+        if self.events_cache is None:
+            return self.fetch_events(start_time, end_time, tags)
+        return self.events_cache.get(
+            self.tenant, tags, start_time, end_time,
+            lambda start, end: self.fetch_events(start, end, tags))
+
+    def fetch_events(self, start_time, end_time, tags):
         url = self.find_events_endpoint(self.bf_query_endpoint, self.tenant)
+        # Events are returned with whole seconds, so those of the last
+        # second, up to its last millisecond, are in range too
         payload = {
             'from': start_time * 1000,
-            'until': end_time * 1000
+            'until': (end_time + 1) * 1000 - 1
         }
 
         if tags is not None:
             payload['tags'] = tags
         headers = auth.headers()
 
-        r = self.make_request(url, payload, headers)
-        r = r.json()
+        r = self.make_request(url, payload, headers, 'events')
+        r = codec.decode(r)
         for event in r:
             event['when'] = int(event['when'] / 1000)
         return r
@@ -377,20 +875,26 @@ class TenantBluefloodReader(object):
         self.enum_value = enum_value
 
     def get_intervals(self):
-        # todo: make this a lot smarter.
-        intervals = []
-        millis = int(round(time.time() * 1000))
-        intervals.append(Interval(0, millis))
-        return IntervalSet(intervals)
+        # The intervals in which the metric may have data, as far as the
+        # multiplot responses seen so far tell
+        tracker = intervals.tracker
+        if tracker is None:
+            return IntervalSet([Interval(0, time.time())])
+        metric = self.metric
+        if self.enum_value is not None:
+            metric = metric[:-(len(self.enum_value) + 1)]
+        return tracker.get_intervals(self.tenant, metric)
 
 
 class BluefloodClient(object):
     def __init__(self, host, tenant, enable_submetrics, submetric_aliases,
-                 enable_statsd):
+                 enable_statsd, max_data_points=None, rollup_cache=None,
+                 partial_results=False, fetch_batch_window=0,
+                 shared_cache=None, align_windows=False, guard=None,
+                 skip_dead_metrics=False):
         self.host = host
         self.tenant = tenant
         self.enable_statsd = enable_statsd
-        logger.info('Blueflood Finder statsd ' + str(self.enable_statsd))
         self.enable_submetrics = enable_submetrics
         self.submetric_aliases = submetric_aliases
         # This is the maximum number of json characters permitted by the
@@ -401,6 +905,38 @@ class BluefloodClient(object):
         # this is for: "'' ," that surround each metric
         self.overhead_per_metric = 4
         self.maxmetrics_per_req = 100
+        # Default number of points per series to aim for when the render
+        # request doesn't say how many it will display
+        self.max_data_points = max_data_points
+        # Optional on-disk cache of finalized coarse rollups
+        self.rollup_cache = rollup_cache
+        # Return the series of the multiplot requests that worked instead
+        # of failing the whole fetch when some of them didn't
+        self.partial_results = partial_results
+        # Optional SharedCache of series, shared with other workers
+        self.shared_cache = shared_cache
+        # Fetch whole steps, so that the same dashboard rendered a few
+        # seconds later makes the same requests.  Always done with a
+        # shared cache.
+        self.align_windows = align_windows
+        # Optional QueryGuard checking the cost of fetches before they're
+        # made
+        self.guard = guard
+        # Don't fetch metrics the interval tracker knows to be empty over
+        # the range at the resolution asked for
+        self.skip_dead_metrics = skip_dead_metrics
+        # Fetches of the same range and resolution arriving within this
+        # many seconds of each other share their multiplot requests
+        self.fetch_batcher = None
+        if fetch_batch_window:
+            self.fetch_batcher = Batcher(fetch_batch_window,
+                                         self.gen_batched_responses)
+
+    def for_tenant(self, tenant):
+        # A client for another tenant, sharing everything else with this one
+        client = copy.copy(self)
+        client.tenant = tenant
+        return client
 
     def gen_data_key(self, values):
         # Determines which key to use for the data
@@ -413,25 +949,6 @@ class BluefloodClient(object):
         else:
             return NonNestedDataKey(None)
 
-    def current_datapoint_passed(self, v_iter, ts):
-        # Determines if the current datapoint is too old to be considered
-        if not len(v_iter):
-            return False
-        datapoint_ts = v_iter[0]['timestamp'] / 1000
-        if (ts > datapoint_ts):
-            return True
-        return False
-
-    def current_datapoint_valid(self, v_iter, data_key, ts, step):
-        # Determines if the current datapoint be included in the current step
-        # assumes current_datapoint_passed() is true
-        if (not len(v_iter)) or not data_key.exists(v_iter[0]):
-            return False
-        datapoint_ts = v_iter[0]['timestamp'] / 1000
-        if (datapoint_ts < (ts + step)):
-            return True
-        return False
-
     def fixup(self, values, fixup_list):
         # Replace the None's in "values" with interpolations of the
         # surrounding non-null values
@@ -454,12 +971,18 @@ class BluefloodClient(object):
         #  with Null's interleaved if needed
         # Note that even if there are no datapoints in "values" it will fill
         #  them with nulls
-        v_iter = values
+        times, vals = data_key.columns(values, step)
+        return self.align(times, vals, start_time, end_time, step)
+
+    def align(self, times, vals, start_time, end_time, step):
+        # Lines up the columns of a series with the steps of the range
         ret_arr = []
         # A fixup is the start and end position of the current range of
         # Null datapoints
         current_fixup = None
         fixup_list = []
+        i = 0
+        n = len(times)
         for ts in range(start_time, end_time, step):
 
             # Skip datapoints that have already passed
@@ -471,10 +994,10 @@ class BluefloodClient(object):
             # res metrics with frequencies less than 60 seconds.  And since
             # Graphite/Whisper doesn't seem to do that this approach seems to
             # better emulate the results produced by Graphite
-            while self.current_datapoint_passed(v_iter, ts):
-                v_iter = v_iter[1:]
-            if self.current_datapoint_valid(v_iter, data_key, ts, step):
-                ret_arr.append(data_key.get_datapoints(v_iter[0], step))
+            while i < n and ts > times[i]:
+                i += 1
+            if i < n and vals[i] is not MISSING and times[i] < ts + step:
+                ret_arr.append(vals[i])
                 if current_fixup is not None:
                     # we have found the end of the current fixup, so add the
                     # start and end of the current fixup into fixup list
@@ -497,27 +1020,22 @@ class BluefloodClient(object):
     def get_multi_endpoint(self, endpoint, tenant):
         return "%s/v2.0/%s/views" % (endpoint, tenant)
 
-    def get_metric_data(self, endpoint, tenant, metric_list, payload, headers):
-        # Generate Multiplot query to get metrics in list
+    def get_metric_data(self, endpoint, tenant, metric_list, payload, headers,
+                        raw=False):
+        # Generate Multiplot query to get metrics in list, the undecoded
+        # body of the response if "raw"
         url = self.get_multi_endpoint(endpoint, tenant)
-        if auth.is_active():
-            headers['X-Auth-Token'] = auth.get_token(False)
-        r = requests.post(url, params=payload,
-                          data=json.dumps(metric_list),
-                          headers=headers)
-        if r.status_code == 401 and auth.is_active():
-            headers['X-Auth-Token'] = auth.get_token(True)
-            r = requests.post(url,
-                              params=payload,
-                              data=json.dumps(metric_list), headers=headers)
+        r = transport.post(url, payload, codec.dumps(metric_list), headers)
         if r.status_code != 200:
             logger.info(
                 "get_metric_data failed endpoint: [%s] "
                 "status code: [%s] tenant: [%s] metric_list: [%s]",
                 endpoint, r.status_code, tenant, metric_list)
             return None
+        elif raw:
+            return r.content
         else:
-            return r.json()['metrics']
+            return codec.decode(r)['metrics']
 
     def gen_payload(self, start_time, end_time, res):
         payload = {
@@ -563,10 +1081,36 @@ class BluefloodClient(object):
         for n in nodes:
             metrics_key, data_key = self.gen_keys(n, metrics)
             if metrics_key:
-                dictionary[n.path] = self.process_path(metrics[metrics_key],
-                                                       start_time,
-                                                       real_end_time, step,
-                                                       data_key)
+                dictionary[n.path] = self.process_path(
+                    metrics[metrics_key], start_time, real_end_time, step,
+                    data_key)
+        return dictionary
+
+    def can_offload(self, nodes, res):
+        # Offloading only pays when the responses go straight from BF to
+        # gen_dict: the caches and coalesced fetches need them decoded
+        # here, and sending decoded datapoints to another process costs
+        # more than processing them
+        return (offload.should_offload(len(nodes)) and
+                self.fetch_batcher is None and self.shared_cache is None and
+                not (self.rollup_cache and self.rollup_cache.cacheable(res)))
+
+    def gen_offloaded_dict(self, nodes, payload, start_time, end_time, step,
+                           trim):
+        # Like gen_dict on the responses of fetch_responses, but the
+        # multiplot responses are decoded and processed by the process
+        # pool; the request thread only sends it their bodies
+        by_metric = {}
+        for n in nodes:
+            by_metric.setdefault(self.node_metric(n), []).append(n)
+        bodies = self.gen_responses(self.gen_groups(nodes), payload,
+                                    raw=True)
+        slowlog.phase('process')
+        dictionary, ends = offload.process_responses(
+            self, [([n for m in set(g) for n in by_metric[m]], body)
+                   for g, body in bodies],
+            start_time, end_time, step, trim, intervals.tracker is not None)
+        self.observe_intervals(ends, start_time, end_time, step)
         return dictionary
 
     def group_has_room(self, cur_metric, cur_path, tot_len, remaining_paths):
@@ -603,22 +1147,82 @@ class BluefloodClient(object):
         path_set = set()
         paths = []
         for n in nodes:
-            if n.reader.enum_value is not None:
+            if n.reader.enum_value is not None or self.enable_submetrics:
                 # add to a "set" here because some of the names may be dupes
-                path_set.add(n.path[:-(len(n.reader.enum_value) + 1)])
+                path_set.add(self.node_metric(n))
             else:
-                if self.enable_submetrics:
-                    path_set.add('.'.join(n.path.split('.')[:-1]))
-                else:
-                    paths.append(n.path)
+                paths.append(n.path)
         for p in path_set:
             paths.append(p)
         return paths
 
+    def node_metric(self, node):
+        # The BF metric name behind a graphite path
+        if node.reader.enum_value is not None:
+            return node.path[:-(len(node.reader.enum_value) + 1)]
+        if self.enable_submetrics:
+            return '.'.join(node.path.split('.')[:-1])
+        return node.path
+
     def gen_groups(self, nodes):
         # creates groups of metrics none of which exceed limits
+        return self.group_paths(self.gen_paths(nodes))
+
+    def group_sizes(self, paths):
+        # The number of paths in each of the groups group_paths would make,
+        # without making them
+        sizes = []
+        count = 0
+        tot_len = 2
+        for p in paths:
+            if count >= self.maxmetrics_per_req or tot_len + len(
+                    p) + self.overhead_per_metric >= self.maxlen_per_req:
+                if count:
+                    sizes.append(count)
+                count = 0
+                tot_len = 2
+            tot_len += len(p) + 2
+            count += 1
+        if count:
+            sizes.append(count)
+        return sizes
+
+    def guard_fetch(self, nodes, start_time, end_time, res):
+        # Estimates the cost of fetching "nodes" and holds it to the limits
+        # of the guard.  Returns the nodes and resolution to fetch.
+        guard = self.guard
+        paths = self.gen_paths(nodes)
+        sizes = self.group_sizes(paths)
+        span = end_time - start_time
+        step = secs_per_res[res]
+        est = guard.estimate(len(nodes), sizes, res, span, step)
+        slowlog.add(est_points=est.points, est_bytes=est.bytes)
+        over = guard.exceeded(est)
+        if not over:
+            return nodes, res
+        if guard.action == 'degrade':
+            for coarser in res_order[res_order.index(res) + 1:]:
+                if not guard.exceeded(guard.estimate(
+                        len(nodes), sizes, coarser, span,
+                        secs_per_res[coarser])):
+                    guard.degraded += 1
+                    logger.warning("Degraded fetch of %s to %s rollups",
+                                   est.describe(), coarser)
+                    return nodes, coarser
+        elif guard.action == 'truncate':
+            kept = set(paths[:guard.paths_that_fit(sizes, span, step)])
+            nodes = [n for n in nodes if self.node_metric(n) in kept]
+            if guard.max_nodes is not None:
+                nodes = nodes[:guard.max_nodes]
+            if nodes:
+                guard.truncated += 1
+                logger.warning("Truncated fetch of %s to %d series",
+                               est.describe(), len(nodes))
+                return nodes, res
+        guard.reject(est, over)
+
+    def group_paths(self, remaining_paths):
         groups = []
-        remaining_paths = self.gen_paths(nodes)
         while remaining_paths:
             new_remaining_paths, groups = self.gen_next_group(remaining_paths,
                                                               groups)
@@ -629,30 +1233,231 @@ class BluefloodClient(object):
                 remaining_paths = new_remaining_paths
         return groups
 
-    def gen_responses(self, groups, payload):
-        # converts groups of requests into a single list of responses
+    def gen_responses(self, groups, payload, raw=False):
+        # converts groups of requests into a single list of responses, or
+        # into (group, undecoded body) pairs if "raw"
         headers = auth.headers()
-        responses = reduce(lambda x, y: x + y,
-                           [self.get_metric_data(self.host,
-                                                 self.tenant,
-                                                 g,
-                                                 payload,
-                                                 headers)
-                            for g in groups])
-        responses = responses or []
+        responses = []
+        failed = 0
+        slowlog.count('groups', len(groups))
+        for g in groups:
+            with tracing.span('multiplot', tenant=self.tenant,
+                              group_size=len(g),
+                              resolution=payload.get('resolution')) as span:
+                try:
+                    data = self.get_metric_data(self.host, self.tenant, g,
+                                                payload, headers, raw)
+                except (requests.RequestException, BluefloodError):
+                    if not self.partial_results:
+                        raise
+                    logger.exception("gen_responses: group failed")
+                    data = None
+                span.set(failed=data is None)
+            if data is None:
+                failed += 1
+            elif raw:
+                responses.append((g, data))
+            else:
+                responses.extend(data)
+        if failed:
+            if not self.partial_results:
+                raise BluefloodError("%d of %d multiplot requests failed" %
+                                     (failed, len(groups)))
+            logger.warning("gen_responses: returning partial results, "
+                           "%d of %d multiplot requests failed",
+                           failed, len(groups))
+        return responses
+
+    def fetch_responses(self, nodes, payload):
+        return self.fetch_paths(self.gen_paths(nodes), payload)
+
+    def fetch_paths(self, paths, payload):
+        if self.fetch_batcher is None:
+            return self.gen_responses(self.group_paths(paths), payload)
+        key = (self.tenant, tuple(sorted(payload.items())))
+        return self.fetch_batcher.submit(key, paths)
+
+    def gen_batched_responses(self, key, path_lists):
+        # Fetches the paths of several fetch_multi calls in as few
+        # multiplot requests as possible, and splits the responses back up
+        client = self
+        if key[0] != self.tenant:
+            client = self.for_tenant(key[0])
+        paths = []
+        seen = set()
+        for p in (p for ps in path_lists for p in ps):
+            if p not in seen:
+                seen.add(p)
+                paths.append(p)
+        logger.debug("gen_batched_responses: %d fetches, %d paths",
+                     len(path_lists), len(paths))
+        responses = client.gen_responses(client.group_paths(paths),
+                                         dict(key[1]))
+        by_metric = {r['metric']: r for r in responses}
+        return [[by_metric[p] for p in ps if p in by_metric]
+                for ps in path_lists]
+
+    def gen_cached_responses(self, paths, start_time, end_time, res,
+                             payload):
+        # Like gen_responses, but the finalized buckets of the range are
+        # served from the rollup cache.  Series with every bucket on disk
+        # only fetch the still open tail of the range from BF, the rest are
+        # fetched from the start of the first bucket and then cached.
+        cache = self.rollup_cache
+        select = payload.get('select')
+        buckets = cache.closed_buckets(res, start_time, end_time)
+        if not buckets:
+            return self.gen_responses(self.group_paths(paths), payload)
+        hist_end = buckets[-1] + cache.bucket_secs(res)
+
+        cached = {}
+        misses = []
+        for p in paths:
+            points = cache.get_range(self.tenant, p, select, res, buckets)
+            if points is None:
+                misses.append(p)
+            else:
+                cached[p] = points
+        logger.debug("rollup cache: %d hits, %d misses",
+                     len(cached), len(misses))
+
+        responses = []
+        if misses:
+            miss_payload = self.gen_payload(buckets[0], end_time, res)
+            for r in self.gen_responses(self.group_paths(misses),
+                                        miss_payload):
+                cache.put_range(self.tenant, r['metric'], select, res,
+                                buckets, r['data'])
+                responses.append(r)
+        if cached:
+            fresh = {}
+            if hist_end < end_time:
+                tail_payload = self.gen_payload(hist_end, end_time, res)
+                for r in self.gen_responses(self.group_paths(list(cached)),
+                                            tail_payload):
+                    fresh[r['metric']] = r['data']
+            for p, points in cached.items():
+                responses.append({'metric': p,
+                                  'data': points + fresh.get(p, [])})
         return responses
 
-    def fetch_multi(self, nodes, start_time, end_time):
+    def gen_shared_responses(self, paths, payload):
+        # Like fetch_paths, but the series are shared through the shared
+        # cache.  The range of "payload" is aligned to whole steps, so
+        # renders of the same dashboard a few seconds apart use the same
+        # entries.
+        cache = self.shared_cache
+        start = payload['from']
+        end = payload['to']
+        res = payload['resolution']
+        select = payload.get('select', '')
+        keys = dict((p, cache.key('series', self.tenant, p, select, res,
+                                  start, end)) for p in paths)
+        found = cache.get_multi(keys.values(), decode_series)
+        responses = [{'metric': p, 'data': found[keys[p]]}
+                     for p in paths if keys[p] in found]
+        misses = [p for p in paths if keys[p] not in found]
+        logger.debug("shared cache: %d hits, %d misses",
+                     len(responses), len(misses))
+        if not misses:
+            return responses
+
+        def entries(fetched):
+            return dict((keys[r['metric']], encode_series(r['data']))
+                        for r in fetched if r['metric'] in keys)
+
+        lock_key = cache.key('fetch', self.tenant, select, res, start, end,
+                             *sorted(misses))
+        computed, fetched = cache.single_flight(
+            lock_key, lambda: self.fetch_paths(misses, payload), entries,
+            cache.fetch_ttl)
+        if not computed:
+            # whoever was fetching them is done
+            found = cache.get_multi([keys[p] for p in misses],
+                                    decode_series)
+            responses.extend({'metric': p, 'data': found[keys[p]]}
+                             for p in misses if keys[p] in found)
+            misses = [p for p in misses if keys[p] not in found]
+            fetched = self.fetch_paths(misses, payload) if misses else []
+            cache.set_multi(entries(fetched), cache.fetch_ttl)
+        return responses + fetched
+
+    def split_dead_nodes(self, nodes, start_time, end_time, step):
+        # Separates out the nodes whose metric is known to have no data in
+        # the requested range at the resolution of "step", so they don't
+        # have to be fetched
+        tracker = intervals.tracker
+        if tracker is None or not self.skip_dead_metrics:
+            return nodes, []
+        live = []
+        dead = []
+        for n in nodes:
+            if tracker.has_data(self.tenant, self.node_metric(n),
+                                start_time, end_time, step):
+                live.append(n)
+            else:
+                dead.append(n)
+        return live, dead
+
+    def observe_intervals(self, responses, start_time, end_time, step):
+        tracker = intervals.tracker
+        if tracker is None:
+            return
+        for r in responses:
+            tracker.observe(self.tenant, r['metric'], start_time, end_time,
+                            r['data'], step)
+
+    def fetch_multi(self, nodes, start_time, end_time, max_data_points=None):
         try:
-            res = calc_res(start_time, end_time)
+            slowlog.phase('plan')
+            if max_data_points is None:
+                max_data_points = requested_max_data_points(
+                    self.max_data_points)
+            res = calc_res(start_time, end_time, max_data_points)
+            if self.guard is not None and nodes:
+                nodes, res = self.guard_fetch(nodes, start_time, end_time,
+                                              res)
             step = secs_per_res[res]
-            payload = self.gen_payload(start_time, end_time, res)
-            # Limit size of MPlot requests by dividing into groups
-            groups = self.gen_groups(nodes)
-            responses = self.gen_responses(groups, payload)
+            fetch_start, fetch_end = start_time, end_time
+            if self.align_windows or self.shared_cache is not None:
+                fetch_start, fetch_end = align_window(start_time, end_time,
+                                                      step)
+            payload = self.gen_payload(fetch_start, fetch_end, res)
+            nodes, dead_nodes = self.split_dead_nodes(nodes, start_time,
+                                                      end_time, step)
+            slowlog.add(res=res, dead_nodes=len(dead_nodes))
+            slowlog.phase('fetch')
+            trim = (fetch_start, fetch_end) != (start_time, end_time)
             real_end_time = end_time + step
-            dictionary = self.gen_dict(nodes, responses, start_time,
-                                       real_end_time, step)
+            if self.can_offload(nodes, res):
+                dictionary = self.gen_offloaded_dict(
+                    nodes, payload, start_time, end_time, step, trim)
+            else:
+                # Limit size of MPlot requests by dividing into groups
+                if not nodes:
+                    responses = []
+                elif self.rollup_cache and self.rollup_cache.cacheable(res):
+                    responses = self.gen_cached_responses(
+                        self.gen_paths(nodes), fetch_start, fetch_end, res,
+                        payload)
+                elif self.shared_cache is not None:
+                    responses = self.gen_shared_responses(
+                        self.gen_paths(nodes), payload)
+                else:
+                    responses = self.fetch_responses(nodes, payload)
+                if trim:
+                    responses = trim_responses(responses, start_time,
+                                               end_time)
+                slowlog.phase('process')
+                self.observe_intervals(responses, start_time, end_time, step)
+                dictionary = self.gen_dict(nodes, responses, start_time,
+                                           real_end_time, step)
+            if dead_nodes:
+                logger.debug("fetch_multi: skipped %d nodes without data",
+                             len(dead_nodes))
+                empty = len(range(start_time, real_end_time, step))
+                for n in dead_nodes:
+                    dictionary[n.path] = [None] * empty
             time_info = (start_time, real_end_time, step)
             return (time_info, dictionary)
 
@@ -665,6 +1470,15 @@ class TenantBluefloodLeafNode(LeafNode):
     __fetch_multi__ = 'tenant_blueflood'
 
 
+class TenantNode(object):
+    # A leaf node with the tenant prefix taken off its path
+    __slots__ = ('path', 'reader')
+
+    def __init__(self, path, reader):
+        self.path = path
+        self.reader = reader
+
+
 # The rollup values are multiplied by the length of the rollup.  For
 #  example, 5 minute rollups have the sum of the counts for all 5
 #  minutes.  This normalizes them.
@@ -675,21 +1489,44 @@ def step_correction(value, step):
         return value/(step/60)
 
 
+def align_window(start_time, end_time, step):
+    # The range widened to the step boundaries around it
+    return (start_time - start_time % step,
+            end_time + (-end_time) % step)
+
+
+def trim_responses(responses, start_time, end_time):
+    # The multiplot responses of a widened range, with only the points of
+    # the range asked for, as if it had been fetched
+    start = start_time * 1000
+    end = end_time * 1000
+    trimmed = []
+    for r in responses:
+        data = r['data']
+        if data and (data[0]['timestamp'] < start or
+                     data[-1]['timestamp'] >= end):
+            r = {'metric': r['metric'],
+                 'data': [d for d in data if start <= d['timestamp'] < end]}
+        trimmed.append(r)
+    return trimmed
+
+
 class NonNestedDataKey(object):
     def __init__(self, key1):
         self.key1 = key1
+        self.corrected = key1 == 'average'
 
-    def exists(self, value):
-        return self.key1 in value
-
-    def get_datapoints(self, value, step):
-        if not self.exists(value):
-            return None
-        else:
-            if self.key1 in set(['average']):
-                return step_correction(value[self.key1], step)
-            else:
-                return value[self.key1]
+    def columns(self, values, step):
+        # Decodes the datapoints into a column of timestamps (in seconds)
+        # and one of values, with MISSING where the key isn't there
+        key1 = self.key1
+        times = [v['timestamp'] / 1000 for v in values]
+        vals = [v.get(key1, MISSING) for v in values]
+        if self.corrected:
+            div = step / 60
+            vals = [v if v is None or v is MISSING else v / div
+                    for v in vals]
+        return times, vals
 
 
 class NestedDataKey(object):
@@ -699,11 +1536,10 @@ class NestedDataKey(object):
         self.key1 = key1
         self.key2 = key2
 
-    def exists(self, value):
-        return self.key1 in value and self.key2 in value[self.key1]
-
-    def get_datapoints(self, value, step):
-        if not self.exists(value):
-            return None
-        else:
-            return value[self.key1][self.key2]
+    def columns(self, values, step):
+        key1 = self.key1
+        key2 = self.key2
+        times = [v['timestamp'] / 1000 for v in values]
+        vals = [v[key1].get(key2, MISSING) if key1 in v else MISSING
+                for v in values]
+        return times, vals
@@ -0,0 +1,158 @@
+import collections
+import logging
+import threading
+import time
+
+from blueflood_graphite_finder.errors import BluefloodUnavailable, \
+    BluefloodOverloaded
+
+logger = logging.getLogger('blueflood_finder')
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the outcome of the last "window" requests to one Blueflood
+    endpoint.  Once at least "min_requests" have been seen and more than
+    "error_rate" of them failed (errors, 5xx responses or answers slower
+    than "slow_secs"), the circuit opens and requests fail fast for
+    "open_secs".  After that "probes" requests at a time are let through
+    (half-open); a success closes the circuit again, a failure reopens it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, window=20, min_requests=10, error_rate=0.5,
+                 slow_secs=10, open_secs=30, probes=1):
+        self.name = name
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_secs = slow_secs
+        self.open_secs = open_secs
+        self.probes = probes
+        self.lock = threading.Lock()
+        self.outcomes = collections.deque(maxlen=window)
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.probing = 0
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.open_secs:
+                    raise BluefloodUnavailable(
+                        "Blueflood %s circuit is open" % self.name)
+                logger.info("Blueflood %s circuit half-open", self.name)
+                self.state = self.HALF_OPEN
+                self.probing = 0
+            if self.state == self.HALF_OPEN:
+                if self.probing >= self.probes:
+                    raise BluefloodUnavailable(
+                        "Blueflood %s circuit is half-open" % self.name)
+                self.probing += 1
+
+    def record(self, ok, elapsed):
+        failed = not ok or \
+            (self.slow_secs is not None and elapsed > self.slow_secs)
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.probing -= 1
+                if failed:
+                    self.trip()
+                else:
+                    logger.info("Blueflood %s circuit closed", self.name)
+                    self.state = self.CLOSED
+                    self.outcomes.clear()
+                return
+            self.outcomes.append(failed)
+            if self.state == self.CLOSED and \
+                    len(self.outcomes) >= self.min_requests and \
+                    sum(self.outcomes) > self.error_rate * len(self.outcomes):
+                self.trip()
+
+    def trip(self):
+        # expects the lock to be held
+        logger.warning("Blueflood %s circuit open for %ss", self.name,
+                       self.open_secs)
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        self.outcomes.clear()
+
+
+class AdmissionQueue(object):
+    """
+    Lets at most "max_active" renders run at once, with up to "max_waiting"
+    more queued for at most "wait_secs".  Anything beyond that is shed with
+    BluefloodOverloaded instead of piling up.
+    """
+
+    def __init__(self, max_active, max_waiting=0, wait_secs=5):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.wait_secs = wait_secs
+        self.cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+
+    def __enter__(self):
+        with self.cond:
+            if self.active >= self.max_active:
+                if self.waiting >= self.max_waiting:
+                    raise BluefloodOverloaded(
+                        "Too many Blueflood renders in progress (%d active, "
+                        "%d queued)" % (self.active, self.waiting))
+                self.waiting += 1
+                deadline = time.time() + self.wait_secs
+                try:
+                    while self.active >= self.max_active:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise BluefloodOverloaded(
+                                "Timed out after %ss waiting for a Blueflood "
+                                "render slot" % self.wait_secs)
+                        self.cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+        return False
+
+    def after_fork(self):
+        # The renders in progress are the parent's
+        self.cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+
+
+class RateLimiter(object):
+    """
+    Lets "rate" requests a second through on average and up to "burst" at
+    once (a token bucket); acquire blocks until the next one may go.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = max(1, burst or rate)
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            # goes into debt, so that callers queue up one after the other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def after_fork(self):
+        self.lock = threading.Lock()
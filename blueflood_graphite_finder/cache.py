@@ -0,0 +1,105 @@
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded LRU cache whose entries can also expire.
+    Entries weigh 1 unless they are put with a weight, and the least
+    recently used ones are evicted once the total goes over "max_size".
+
+    With a "tenant_quota", keys must be tuples starting with the tenant and
+    no tenant may hold more than that much of the cache: a tenant over its
+    quota evicts its own entries rather than everyone else's.
+    """
+
+    def __init__(self, max_size, ttl=None, tenant_quota=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.tenant_quota = tenant_quota
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # tenant -> [size, OrderedDict of its keys]
+        self.tenants = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and \
+                    entry[1] is not None and entry[1] < time.time():
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            # re-insert to mark it as most recently used
+            del self.entries[key]
+            self.entries[key] = entry
+            if self.tenant_quota is not None:
+                keys = self.tenants[key[0]][1]
+                del keys[key]
+                keys[key] = True
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl=None, weight=1):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.time() + ttl
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (value, expires, weight)
+            self.size += weight
+            if self.tenant_quota is not None:
+                tenant = self.tenants.setdefault(
+                    key[0], [0, collections.OrderedDict()])
+                tenant[0] += weight
+                tenant[1][key] = True
+                while tenant[0] > self.tenant_quota:
+                    self.remove(next(iter(tenant[1])))
+                    self.evictions += 1
+            while self.size > self.max_size:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.remove(key)
+        return default if entry is None else entry[0]
+
+    def remove(self, key):
+        # expects the lock to be held
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+            if self.tenant_quota is not None:
+                tenant = self.tenants[key[0]]
+                tenant[0] -= entry[2]
+                del tenant[1][key]
+                if not tenant[1]:
+                    del self.tenants[key[0]]
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tenants.clear()
+            self.size = 0
+
+    def after_fork(self):
+        # The entries are still good, a lock held by another thread of the
+        # parent would never be released
+        self.lock = threading.Lock()
+
+    def stats(self):
+        return {'items': len(self.entries), 'size': self.size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
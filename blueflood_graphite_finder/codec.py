@@ -0,0 +1,64 @@
+import json
+import logging
+
+logger = logging.getLogger('blueflood_finder')
+
+
+def stdlib_codec():
+    return json.loads, json.dumps
+
+
+def simplejson_codec():
+    import simplejson
+    return simplejson.loads, simplejson.dumps
+
+
+def ujson_codec():
+    import ujson
+
+    def loads(s):
+        # ujson rounds floats unless asked not to
+        return ujson.loads(s, precise_float=True)
+
+    # old versions don't take the option
+    loads('[1.5]')
+    # ujson can't encode floats without losing digits, and all we encode
+    # are short lists of metric names anyway
+    return loads, json.dumps
+
+
+# Fastest first
+CODECS = (('ujson', ujson_codec),
+          ('simplejson', simplejson_codec),
+          ('json', stdlib_codec))
+
+name = None
+loads = None
+dumps = None
+
+
+def configure(codec=None):
+    # Picks the JSON library used to talk to Blueflood: "codec" if given,
+    # else the fastest one installed
+    global name, loads, dumps
+    for codec_name, make in CODECS:
+        if codec is not None and codec_name != codec:
+            continue
+        try:
+            loads, dumps = make()
+        except (ImportError, TypeError) as e:
+            if codec is not None:
+                raise ValueError("JSON codec %s unavailable: %s" % (codec, e))
+            continue
+        name = codec_name
+        logger.debug("Using %s to encode/decode JSON", name)
+        return
+    raise ValueError("Unknown JSON codec: %s" % codec)
+
+
+def decode(response):
+    # Decodes the body of a requests response
+    return loads(response.content)
+
+
+configure()
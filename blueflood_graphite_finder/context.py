@@ -0,0 +1,52 @@
+import time
+
+try:
+    from flask import g, has_request_context, request
+except ImportError:
+    # graphite-web (django) has no global request object
+    g = None
+    has_request_context = None
+    request = None
+
+
+def in_request():
+    return has_request_context is not None and has_request_context()
+
+
+def get_request_param(name, default=None):
+    # Returns a query/form parameter of the graphite-api request currently
+    # being served, or "default" when called outside of a request
+    if not in_request():
+        return default
+    value = request.args.get(name)
+    if value is None:
+        value = request.form.get(name)
+    if value is None:
+        return default
+    return value
+
+
+def get_request_header(name, default=None):
+    if not in_request():
+        return default
+    return request.headers.get(name, default)
+
+
+def request_start_time(default=None):
+    # When the finder first saw the request currently being served, so
+    # the find and fetch calls of one render share a deadline
+    if not in_request():
+        return default
+    start = getattr(g, 'blueflood_start_time', None)
+    if start is None:
+        start = g.blueflood_start_time = time.time()
+    return start
+
+
+def request_memo(name, compute):
+    # compute() once per graphite-api request, every time outside of one
+    if not in_request():
+        return compute()
+    if not hasattr(g, name):
+        setattr(g, name, compute())
+    return getattr(g, name)
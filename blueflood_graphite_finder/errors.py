@@ -0,0 +1,23 @@
+class BluefloodError(Exception):
+    # A request to Blueflood failed
+    pass
+
+
+class BluefloodUnavailable(BluefloodError):
+    # Raised instead of sending a request to a backend whose circuit is open
+    pass
+
+
+class BluefloodOverloaded(BluefloodError):
+    # Raised when a render is shed because too many are already waiting
+    pass
+
+
+class BluefloodDeadlineExceeded(BluefloodError):
+    # The time budget of the render ran out
+    pass
+
+
+class BluefloodQueryRejected(BluefloodError):
+    # The query would cost more than the configured limits allow
+    pass
@@ -0,0 +1,110 @@
+import bisect
+import threading
+import time
+
+from blueflood_graphite_finder.cache import LRUCache
+
+
+def event_key(event):
+    return repr(sorted(event.items()))
+
+
+def uncovered(ranges, start, end):
+    # Returns the parts of [start, end] not in the sorted, disjoint ranges
+    gaps = []
+    cursor = start
+    for s, e in ranges:
+        if e < cursor:
+            continue
+        if s > end:
+            break
+        if s > cursor:
+            gaps.append((cursor, s - 1))
+        cursor = max(cursor, e + 1)
+    if cursor <= end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+def merge_range(ranges, start, end):
+    # Adds [start, end] to the sorted, disjoint ranges
+    merged = []
+    for s, e in ranges:
+        if e + 1 < start or s > end + 1:
+            merged.append((s, e))
+        else:
+            start = min(start, s)
+            end = max(end, e)
+    merged.append((start, end))
+    merged.sort()
+    return merged
+
+
+class TagEvents(object):
+    # The events of one tag query and the time ranges they are complete for
+    __slots__ = ('ranges', 'whens', 'events', 'keys')
+
+    def __init__(self):
+        self.ranges = []
+        self.whens = []
+        self.events = []
+        self.keys = set()
+
+    def add(self, events, start, end):
+        for event in events:
+            key = event_key(event)
+            if key in self.keys:
+                continue
+            self.keys.add(key)
+            i = bisect.bisect_right(self.whens, event['when'])
+            self.whens.insert(i, event['when'])
+            self.events.insert(i, event)
+        if end >= start:
+            self.ranges = merge_range(self.ranges, start, end)
+
+    def between(self, start, end):
+        lo = bisect.bisect_left(self.whens, start)
+        hi = bisect.bisect_right(self.whens, end)
+        return self.events[lo:hi]
+
+
+class EventsCache(object):
+    """
+    Caches getEvents results per tenant and tag query.  Every entry knows
+    which time ranges it has all the events for, so a query only fetches
+    the parts of its range that aren't covered yet.  Entries weigh as many
+    events as they hold and the cache is bounded by "max_events".
+    """
+
+    def __init__(self, max_events=10000, ttl=3600, settle=60,
+                 tenant_quota=None):
+        self.entries = LRUCache(max_events, ttl, tenant_quota)
+        # New events can still show up for the most recent seconds, so
+        # those are never marked as covered
+        self.settle = settle
+        self.lock = threading.Lock()
+
+    def get(self, tenant, tags, start, end, fetch):
+        # fetch(start, end) fetches the events of a range from BF, with
+        # their "when" already in seconds
+        key = (tenant, repr(tags))
+        with self.lock:
+            entry = self.entries.get(key)
+            gaps = uncovered(entry.ranges, start, end) if entry else \
+                [(start, end)]
+            if not gaps:
+                return entry.between(start, end)
+        fetched = [(s, e, fetch(s, e)) for s, e in gaps]
+
+        complete_until = int(time.time()) - self.settle
+        with self.lock:
+            # another thread may have replaced the entry meanwhile
+            entry = self.entries.get(key) or entry or TagEvents()
+            for s, e, events in fetched:
+                entry.add(events, s, min(e, complete_until))
+            self.entries.put(key, entry, weight=max(len(entry.events), 1))
+            return entry.between(start, end)
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.entries.after_fork()
@@ -0,0 +1,101 @@
+import logging
+
+from blueflood_graphite_finder.errors import BluefloodQueryRejected
+
+logger = logging.getLogger('blueflood_finder')
+
+ACTIONS = ('reject', 'degrade', 'truncate')
+
+
+class Estimate(object):
+    """
+    What a fetch would cost: the series asked for ("nodes"), the Blueflood
+    metrics behind them ("paths"), the multiplot requests ("groups") and
+    the datapoints and bytes those would return at resolution "res".
+    """
+    __slots__ = ('nodes', 'paths', 'groups', 'res', 'points', 'bytes')
+
+    def __init__(self, nodes, paths, groups, res, points, bytes):
+        self.nodes = nodes
+        self.paths = paths
+        self.groups = groups
+        self.res = res
+        self.points = points
+        self.bytes = bytes
+
+    def describe(self):
+        return ("%d series, %d metrics in %d requests, %d %s points, "
+                "~%d bytes" % (self.nodes, self.paths, self.groups,
+                               self.points, self.res, self.bytes))
+
+
+class QueryGuard(object):
+    """
+    Limits what a fetch may cost.  Fetches estimated to go over any of
+    "max_nodes", "max_groups", "max_points" or "max_bytes" are, depending
+    on "action":
+
+    - reject: refused with BluefloodQueryRejected
+    - degrade: fetched at the finest coarser resolution that fits, or
+      refused if none does
+    - truncate: fetched for as many of the series as fit, the others
+      left out
+    """
+
+    def __init__(self, max_nodes=None, max_groups=None, max_points=None,
+                 max_bytes=None, action='reject', bytes_per_point=60):
+        if action not in ACTIONS:
+            raise ValueError("Unknown query guard action: %s" % action)
+        self.max_nodes = max_nodes
+        self.max_groups = max_groups
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.action = action
+        # about what a datapoint of a multiplot response takes in JSON
+        self.bytes_per_point = bytes_per_point
+        self.rejected = 0
+        self.degraded = 0
+        self.truncated = 0
+
+    def estimate(self, nodes, group_sizes, res, span, step):
+        paths = sum(group_sizes)
+        points = paths * -(-span // step)
+        return Estimate(nodes, paths, len(group_sizes), res, points,
+                        points * self.bytes_per_point)
+
+    def exceeded(self, est):
+        # The limits "est" goes over
+        over = []
+        for name, value, limit in (
+                ('max_nodes', est.nodes, self.max_nodes),
+                ('max_groups', est.groups, self.max_groups),
+                ('max_points', est.points, self.max_points),
+                ('max_bytes', est.bytes, self.max_bytes)):
+            if limit is not None and value > limit:
+                over.append('%s=%d' % (name, limit))
+        return over
+
+    def reject(self, est, over):
+        self.rejected += 1
+        logger.warning("Rejected fetch of %s: over %s", est.describe(),
+                       ', '.join(over))
+        raise BluefloodQueryRejected(
+            "Query too expensive (%s; limits %s), try fewer series or a "
+            "shorter time range" % (est.describe(), ', '.join(over)))
+
+    def paths_that_fit(self, group_sizes, span, step):
+        # How many of the paths, in order, can be fetched within the limits
+        keep = sum(group_sizes)
+        if self.max_groups is not None:
+            keep = min(keep, sum(group_sizes[:self.max_groups]))
+        per_path = -(-span // step)
+        if self.max_points is not None:
+            keep = min(keep, self.max_points // per_path)
+        if self.max_bytes is not None:
+            keep = min(keep, self.max_bytes //
+                       (per_path * self.bytes_per_point))
+        return keep
+
+    def stats(self):
+        return {'rejected': self.rejected, 'degraded': self.degraded,
+                'truncated': self.truncated}
@@ -0,0 +1,96 @@
+import time
+
+from blueflood_graphite_finder import lifecycle
+from blueflood_graphite_finder.cache import LRUCache
+
+try:
+    from graphite_api.intervals import Interval, IntervalSet
+except ImportError:
+    from graphite.intervals import Interval, IntervalSet
+
+
+class IntervalTracker(object):
+    """
+    Remembers, per metric and resolution, the most recent stretch of time
+    in which Blueflood is known to have no data for it.  The stretches come
+    from the first and last timestamps seen in multiplot responses, so a
+    long-dead series ends up with a gap running from its last datapoint up
+    to the last time it was fetched.  Rollups lag behind and raw data
+    expires before them, so a gap only says something about the
+    resolution ("step") it was seen at.
+    """
+
+    def __init__(self, max_items=100000, ttl=3600, settle=600,
+                 tenant_quota=None):
+        # {step: (start, end)} of each (tenant, metric)
+        self.gaps = LRUCache(max_items, ttl, tenant_quota)
+        # Datapoints may be ingested a little late, so the end of a
+        # stretch that reaches the present isn't trusted this many seconds
+        self.settle = settle
+
+    def observe(self, tenant, metric, start, end, points, step):
+        # Records the result of fetching [start, end) for a metric at a
+        # resolution of "step" seconds.  "points" are the BF datapoints
+        # that came back.
+        end = min(end, int(time.time()) - self.settle)
+        if points:
+            first = points[0]['timestamp'] / 1000
+            last = points[-1]['timestamp'] / 1000
+            empty = [(start, first), (last + step, end)]
+        else:
+            empty = [(start, end)]
+        key = (tenant, metric)
+        gaps = dict(self.gaps.get(key) or {})
+        gap = gaps.pop(step, None)
+        if gap is not None and points and first < gap[1] and last >= gap[0]:
+            # data showed up inside what we thought was empty
+            gap = None
+        for s, e in empty:
+            if e <= s:
+                continue
+            if gap is not None and s <= gap[1] and e >= gap[0]:
+                gap = (min(s, gap[0]), max(e, gap[1]))
+            elif gap is None or s >= gap[1]:
+                gap = (s, e)
+        if gap is not None:
+            gaps[step] = gap
+        if gaps:
+            self.gaps.put(key, gaps)
+        else:
+            self.gaps.pop(key)
+
+    def has_data(self, tenant, metric, start, end, step):
+        # False only when [start, end) is known to be empty at "step"
+        gap = (self.gaps.get((tenant, metric)) or {}).get(step)
+        return gap is None or not (gap[0] <= start and end <= gap[1])
+
+    def get_intervals(self, tenant, metric):
+        # Only what is empty at every resolution seen is left out
+        now = time.time()
+        gaps = (self.gaps.get((tenant, metric)) or {}).values()
+        if gaps:
+            start = max(g[0] for g in gaps)
+            end = min(g[1] for g in gaps)
+            if start < end:
+                return IntervalSet([Interval(0, start),
+                                    Interval(min(end, now), now)])
+        return IntervalSet([Interval(0, now)])
+
+    def after_fork(self):
+        self.gaps.after_fork()
+
+
+tracker = IntervalTracker()
+
+
+def set_tracker(new_tracker):
+    global tracker
+    tracker = new_tracker
+
+
+def after_fork():
+    if tracker is not None:
+        tracker.after_fork()
+
+
+lifecycle.register(after_fork)
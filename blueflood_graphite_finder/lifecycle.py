@@ -0,0 +1,55 @@
+import logging
+import os
+import threading
+import weakref
+
+logger = logging.getLogger('blueflood_finder')
+
+# Pre-fork servers (gunicorn with preload_app, uwsgi without lazy-apps)
+# set the finder up once and fork their workers from that process.  The
+# threads don't survive the fork, while pooled connections, locks held by
+# other threads and half-done batches would be inherited by every worker,
+# so workers reset all that before they use the finder.
+#
+# "hooks" are functions run in each new worker, "objects" have their
+# after_fork method called.
+hooks = []
+objects = weakref.WeakSet()
+# The process the hooks last ran in, or that imported this module
+pid = os.getpid()
+lock = threading.Lock()
+
+
+def register(hook):
+    hooks.append(hook)
+
+
+def register_object(obj):
+    objects.add(obj)
+
+
+def after_fork():
+    # Meant for the server's post-fork hook, e.g. gunicorn's post_fork
+    with lock:
+        run_hooks()
+
+
+def check():
+    # Runs the hooks if this process was forked since they last ran, for
+    # servers that have no post-fork hook or aren't set up to call it
+    if pid == os.getpid():
+        return
+    with lock:
+        if pid != os.getpid():
+            run_hooks()
+
+
+def run_hooks():
+    # expects the lock to be held
+    global pid
+    pid = os.getpid()
+    logger.debug("Setting up the finder in forked process %d", pid)
+    for hook in hooks:
+        hook()
+    for obj in list(objects):
+        obj.after_fork()
@@ -0,0 +1,148 @@
+import logging
+import multiprocessing
+import os
+import threading
+
+from blueflood_graphite_finder import codec, lifecycle, transport
+
+logger = logging.getLogger('blueflood_finder')
+
+# Fetches of at least "min_series" series have their responses decoded
+# and processed by a pool of "pool_size" processes instead of the request
+# thread, 0 disables.  The request thread waits at most "timeout" seconds
+# (less if the render's budget runs out first) for the pool before
+# processing the responses itself.
+pool_size = 0
+min_series = 100
+timeout = 30
+pool = None
+pool_pid = None
+pool_lock = threading.Lock()
+
+
+def configure(new_pool_size=0, new_min_series=100, new_timeout=30):
+    global pool_size, min_series, timeout
+    with pool_lock:
+        pool_size = new_pool_size
+        min_series = new_min_series
+        timeout = new_timeout
+        close()
+        start()
+
+
+def start():
+    # expects the lock to be held.  The pool is forked when the finder is
+    # set up and right after the server forks a worker, before any of the
+    # worker's threads could hold a lock the pool's processes would
+    # inherit taken.
+    global pool, pool_pid
+    if pool_size > 0:
+        pool = multiprocessing.Pool(pool_size)
+        pool_pid = os.getpid()
+
+
+def close():
+    # expects the lock to be held
+    global pool, pool_pid
+    if pool is not None and pool_pid == os.getpid():
+        pool.terminate()
+    pool = None
+    pool_pid = None
+
+
+def after_fork():
+    # The pool's processes are the parent's children, not ours
+    global pool, pool_pid, pool_lock
+    pool_lock = threading.Lock()
+    pool = None
+    pool_pid = None
+    with pool_lock:
+        start()
+
+
+lifecycle.register(after_fork)
+
+
+def get_pool():
+    # A pool forked from another process isn't ours to use, and it isn't
+    # replaced from a request thread
+    with pool_lock:
+        if pool_pid != os.getpid():
+            return None
+        return pool
+
+
+def wait_time():
+    # Seconds the request thread may wait for the pool
+    remaining = transport.remaining_time()
+    if remaining is None:
+        return timeout
+    return max(0, min(remaining, timeout))
+
+
+def should_offload(n_series):
+    return pool_size > 0 and n_series >= min_series
+
+
+clients = {}
+
+
+def get_client(settings):
+    # A client processing series like the finder's, one per process
+    from blueflood_graphite_finder.blueflood import BluefloodClient
+    client = clients.get(settings)
+    if client is None:
+        enable_submetrics, aliases, enable_statsd = settings
+        client = clients[settings] = BluefloodClient(
+            None, None, enable_submetrics, dict(aliases), enable_statsd)
+    return client
+
+
+def process_body(args, client=None):
+    # Runs in a pool process, or in the request thread with its "client"
+    # when the pool didn't answer: decodes a multiplot response and
+    # returns the series of "nodes" in it by path, and the first and last
+    # datapoints of each metric for the interval tracker if "observe"
+    from blueflood_graphite_finder.blueflood import trim_responses
+    settings, nodes, body, start_time, end_time, step, trim, observe = args
+    responses = codec.loads(body)['metrics']
+    if trim:
+        responses = trim_responses(responses, start_time, end_time)
+    ends = None
+    if observe:
+        ends = [{'metric': r['metric'],
+                 'data': r['data'][:1] + r['data'][-1:]} for r in responses]
+    client = client or get_client(settings)
+    return client.gen_dict(nodes, responses, start_time, end_time + step,
+                           step), ends
+
+
+def process_responses(client, bodies, start_time, end_time, step, trim,
+                      observe=False):
+    # Turns the (nodes, undecoded multiplot response) "bodies" into the
+    # series of the nodes on the pool, the way client.gen_dict would, and
+    # returns them by path along with the responses cut down to their
+    # first and last datapoints if "observe".  The request thread only
+    # pickles the bodies and unpickles the results.
+    settings = (client.enable_submetrics,
+                tuple(sorted((client.submetric_aliases or {}).items())),
+                client.enable_statsd)
+    tasks = [(settings, nodes, body, start_time, end_time, step, trim,
+              observe) for nodes, body in bodies]
+    results = None
+    pool = get_pool()
+    if pool is not None:
+        try:
+            results = pool.map_async(process_body, tasks, 1).get(wait_time())
+        except multiprocessing.TimeoutError:
+            logger.warning("Process pool didn't answer in time, processing "
+                           "%d responses in the request thread", len(tasks))
+    if results is None:
+        results = [process_body(task, client) for task in tasks]
+    dictionary = {}
+    ends = []
+    for series, body_ends in results:
+        dictionary.update(series)
+        if body_ends:
+            ends.extend(body_ends)
+    return dictionary, ends
@@ -5,6 +5,7 @@ from dateutil.parser import parse as dateparse
 from pytz import timezone
 
 import auth
+from blueflood_graphite_finder import tracing
 
 IDENTITY_ENDPOINT = 'https://identity.api.rackspacecloud.com/v2.0/'
 
@@ -34,8 +35,10 @@ class BluefloodAuth(object):
         payload = '{"auth":{"RAX-KSKEY:apiKeyCredentials"{' \
                   '"username":"%s","apiKey":"%s"}}}' % (
                     self.username, self.apiKey)
-        r = requests.post(IDENTITY_ENDPOINT + 'tokens', data=payload,
-                          headers=auth.headers())
+        with tracing.span('auth_refresh', user=self.username) as span:
+            r = requests.post(IDENTITY_ENDPOINT + 'tokens', data=payload,
+                              headers=auth.headers())
+            span.set(status=r.status_code)
         if r.status_code != 200:
             print "Error: code=%d, msg=%s" % (r.status_code, r.text)
         jsonObj = r.json()
@@ -0,0 +1,340 @@
+import errno
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger('blueflood_finder')
+
+# Only the coarse rollups are worth keeping on disk.  Their buckets are
+# finalized long before anyone graphs them and dashboards over weeks or
+# months ask for the same ones again and again.
+CACHED_RESOLUTIONS = {
+    'MIN240': 240 * 60,
+    'MIN1440': 1440 * 60}
+
+# Number of rollup slots stored in one cache bucket
+BUCKET_STEPS = 32
+
+# Datapoint fields we know how to store.  Points with anything else in
+# them (e.g. the nested "enum_values") are not cached.
+FIELDS = ('average', 'latest', 'sum', 'numPoints', 'min', 'max', 'variance')
+
+# A segment file is a sequence of records:
+#   header: magic, crc32 of the body, length of the body
+#   body:   resolution (secs), bucket start (secs), key length, field mask,
+#           point count, key (utf-8 "tenant\0metric\0select") and then for
+#           every point: timestamp (ms), int flags and one double for each
+#           field in the mask (NaN when the point doesn't have it)
+# Records are only ever appended, so other processes can follow a segment
+# by re-reading it from the last offset they parsed.
+MAGIC = 0xbf5e
+HEADER = struct.Struct('<HII')
+BODY = struct.Struct('<IqHBI')
+POINT = struct.Struct('<qB')
+SEGMENT_SUFFIX = '.seg'
+NAN = float('nan')
+
+
+def encode_points(points):
+    # Returns (field mask, packed points) or None if the points can't be
+    # represented
+    mask = 0
+    for p in points:
+        for k, v in p.items():
+            if k == 'timestamp':
+                continue
+            if k not in FIELDS or isinstance(v, bool) or \
+                    not isinstance(v, (int, long, float)):
+                return None
+            mask |= 1 << FIELDS.index(k)
+    fields = [f for i, f in enumerate(FIELDS) if mask & (1 << i)]
+    packed = []
+    for p in points:
+        ints = 0
+        values = []
+        for i, f in enumerate(fields):
+            v = p.get(f)
+            if v is None:
+                values.append(NAN)
+            else:
+                if not isinstance(v, float):
+                    ints |= 1 << i
+                values.append(float(v))
+        packed.append(POINT.pack(p['timestamp'], ints))
+        packed.append(struct.pack('<%dd' % len(values), *values))
+    return mask, ''.join(packed)
+
+
+def decode_points(buf, offset, count, mask):
+    fields = [f for i, f in enumerate(FIELDS) if mask & (1 << i)]
+    values_struct = struct.Struct('<%dd' % len(fields))
+    points = []
+    for _ in xrange(count):
+        ts, ints = POINT.unpack_from(buf, offset)
+        offset += POINT.size
+        values = values_struct.unpack_from(buf, offset)
+        offset += values_struct.size
+        point = {u'timestamp': ts}
+        for i, f in enumerate(fields):
+            v = values[i]
+            if v != v:
+                continue
+            point[f] = int(v) if ints & (1 << i) else v
+        points.append(point)
+    return points
+
+
+class Segment(object):
+    def __init__(self, path):
+        self.path = path
+        self.scanned = 0
+        self.size = 0
+        self.map = None
+        self.map_len = 0
+
+    def buffer(self, needed):
+        # Returns a memory map of the segment covering at least "needed"
+        # bytes, remapping it if the file has grown since the last read
+        if self.map is None or self.map_len < needed:
+            self.close()
+            with open(self.path, 'rb') as f:
+                length = os.fstat(f.fileno()).st_size
+                if length < needed:
+                    return None
+                self.map = mmap.mmap(f.fileno(), length,
+                                     access=mmap.ACCESS_READ)
+                self.map_len = length
+        return self.map
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.map_len = 0
+
+
+class RollupCache(object):
+    """
+    Persistent cache of finalized MIN240/MIN1440 rollup buckets, keyed by
+    tenant, metric, resolution and bucket.
+
+    Data lives in append-only segment files under "path".  Each process
+    appends to its own segments and indexes everybody's, so the directory
+    can be shared by all the workers on a host.  When the directory grows
+    past "max_bytes" the oldest segments are deleted.
+    """
+
+    def __init__(self, path, max_bytes=1 << 30, segment_bytes=16 << 20,
+                 settle=None, rescan_interval=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max(max_bytes / 4, 1))
+        # How long after a bucket ends before Blueflood is done rolling it
+        # up.  Defaults to one step of the resolution.
+        self.settle = settle
+        self.rescan_interval = rescan_interval
+        self.lock = threading.Lock()
+        self.segments = {}
+        self.index = {}
+        self.last_scan = 0
+        self.writer = None
+        self.writer_name = None
+        self.sequence = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with self.lock:
+            self.scan()
+
+    def cacheable(self, res):
+        return res in CACHED_RESOLUTIONS
+
+    def bucket_secs(self, res):
+        return CACHED_RESOLUTIONS[res] * BUCKET_STEPS
+
+    def closed_buckets(self, res, start, end, now=None):
+        # Returns the start times of the finalized buckets that hold the
+        # historical part of [start, end), the first one containing "start"
+        if not self.cacheable(res):
+            return []
+        if now is None:
+            now = time.time()
+        step = CACHED_RESOLUTIONS[res]
+        settle = step if self.settle is None else self.settle
+        size = self.bucket_secs(res)
+        cutoff = int(min(end, now - settle))
+        first = start - start % size
+        return range(first, cutoff - cutoff % size, size)
+
+    def key(self, tenant, metric, select):
+        return u'%s\0%s\0%s' % (tenant, metric, select or '')
+
+    def get_range(self, tenant, metric, select, res, buckets):
+        # Returns the concatenated points of all the buckets, or None if
+        # any of them isn't cached
+        key = self.key(tenant, metric, select)
+        step = CACHED_RESOLUTIONS[res]
+        points = []
+        with self.lock:
+            for b in buckets:
+                bucket_points = self.read(key, step, b)
+                if bucket_points is None:
+                    if time.time() - self.last_scan < self.rescan_interval:
+                        return None
+                    # maybe another worker has it
+                    self.scan()
+                    bucket_points = self.read(key, step, b)
+                    if bucket_points is None:
+                        return None
+                points.extend(bucket_points)
+        return points
+
+    def put_range(self, tenant, metric, select, res, buckets, points):
+        # Stores the points of a series fetched from the start of the first
+        # bucket, one record per bucket.  Empty buckets are stored too so
+        # that dead series are served from disk as well.
+        key = self.key(tenant, metric, select)
+        step = CACHED_RESOLUTIONS[res]
+        size = self.bucket_secs(res)
+        records = []
+        for b in buckets:
+            bucket_points = [p for p in points
+                             if b * 1000 <= p['timestamp'] < (b + size) * 1000]
+            encoded = encode_points(bucket_points)
+            if encoded is None:
+                return False
+            records.append((b, encoded, len(bucket_points)))
+        with self.lock:
+            for b, (mask, packed), count in records:
+                self.append(key, step, b, mask, packed, count)
+            self.evict()
+        return True
+
+    def read(self, key, step, bucket):
+        entry = self.index.get((key, step, bucket))
+        if entry is None:
+            return None
+        name, offset, length = entry
+        segment = self.segments.get(name)
+        try:
+            buf = segment and segment.buffer(offset + length)
+        except (IOError, OSError, ValueError):
+            buf = None
+        if buf is None:
+            self.drop(name)
+            return None
+        _, _, key_len, mask, count = BODY.unpack_from(buf, offset)
+        return decode_points(buf, offset + BODY.size + key_len, count, mask)
+
+    def append(self, key, step, bucket, mask, packed, count):
+        key_bytes = key.encode('utf-8')
+        body = BODY.pack(step, bucket, len(key_bytes), mask, count) + \
+            key_bytes + packed
+        record = HEADER.pack(MAGIC, zlib.crc32(body) & 0xffffffff,
+                             len(body)) + body
+        segment = self.writable_segment()
+        os.write(self.writer, record)
+        self.index[(key, step, bucket)] = (
+            self.writer_name, segment.size + HEADER.size, len(body))
+        segment.size += len(record)
+        segment.scanned = segment.size
+
+    def writable_segment(self):
+        segment = self.segments.get(self.writer_name)
+        if self.writer is not None and segment is not None and \
+                segment.size < self.segment_bytes and \
+                os.path.exists(segment.path):
+            return segment
+        if self.writer is not None:
+            os.close(self.writer)
+        # names sort by age, the pid keeps workers out of each other's files
+        self.sequence += 1
+        self.writer_name = '%013d-%d-%d%s' % (int(time.time() * 1000),
+                                              os.getpid(), self.sequence,
+                                              SEGMENT_SUFFIX)
+        path = os.path.join(self.path, self.writer_name)
+        self.writer = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                              0o644)
+        segment = Segment(path)
+        self.segments[self.writer_name] = segment
+        return segment
+
+    def after_fork(self):
+        # Every process appends to segments of its own, the one being
+        # written is left to the parent
+        self.lock = threading.Lock()
+        if self.writer is not None:
+            os.close(self.writer)
+        self.writer = None
+        self.writer_name = None
+
+    def scan(self):
+        # Indexes records that were appended since the last scan, by this
+        # or any other process
+        self.last_scan = time.time()
+        try:
+            names = sorted(n for n in os.listdir(self.path)
+                           if n.endswith(SEGMENT_SUFFIX))
+        except OSError:
+            return
+        for name in set(self.segments) - set(names):
+            self.drop(name)
+        for name in names:
+            segment = self.segments.get(name)
+            if segment is None:
+                segment = Segment(os.path.join(self.path, name))
+                self.segments[name] = segment
+            try:
+                self.scan_segment(name, segment)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self.drop(name)
+
+    def scan_segment(self, name, segment):
+        segment.size = os.path.getsize(segment.path)
+        if segment.size <= segment.scanned:
+            return
+        buf = segment.buffer(segment.size)
+        offset = segment.scanned
+        while offset + HEADER.size <= segment.size:
+            magic, crc, length = HEADER.unpack_from(buf, offset)
+            body_offset = offset + HEADER.size
+            if magic != MAGIC or body_offset + length > segment.size:
+                # a record still being written, come back later
+                break
+            if zlib.crc32(buf[body_offset:body_offset + length]) & \
+                    0xffffffff != crc:
+                break
+            step, bucket, key_len, _, _ = BODY.unpack_from(buf, body_offset)
+            key_offset = body_offset + BODY.size
+            key = buf[key_offset:key_offset + key_len].decode('utf-8')
+            self.index[(key, step, bucket)] = (name, body_offset, length)
+            offset = body_offset + length
+        segment.scanned = offset
+
+    def evict(self):
+        names = sorted(self.segments)
+        total = sum(s.size for s in self.segments.values())
+        while total > self.max_bytes and len(names) > 1:
+            name = names.pop(0)
+            total -= self.segments[name].size
+            logger.debug("RollupCache evicting segment %s", name)
+            try:
+                os.unlink(self.segments[name].path)
+            except OSError:
+                pass
+            self.drop(name)
+
+    def drop(self, name):
+        segment = self.segments.pop(name, None)
+        if segment is not None:
+            segment.close()
+        if name == self.writer_name and self.writer is not None:
+            os.close(self.writer)
+            self.writer = None
+        for k in [k for k, v in self.index.items() if v[0] == name]:
+            del self.index[k]
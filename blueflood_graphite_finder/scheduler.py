@@ -0,0 +1,279 @@
+import collections
+import contextlib
+import fnmatch
+import threading
+import time
+
+from blueflood_graphite_finder import context, lifecycle
+from blueflood_graphite_finder.errors import BluefloodOverloaded
+
+# The classes used when none are configured: people looking at
+# dashboards, alerting jobs and exports, and the cache warmer
+DEFAULT_CLASSES = {
+    'interactive': {'weight': 10},
+    'batch': {'weight': 2},
+    'background': {'weight': 1, 'max_active': 1},
+}
+
+# The Scheduler every request to Blueflood goes through, None if they
+# just go
+scheduler = None
+# The class each thread set with priority(), if any
+local = threading.local()
+
+
+class PriorityClass(object):
+    """
+    The requests of one class: up to "max_active" of them run at once
+    (default: as many as the scheduler allows) and up to "max_waiting"
+    queue for at most "wait_secs".
+    """
+
+    def __init__(self, name, weight=1, max_active=None, max_waiting=100,
+                 wait_secs=30):
+        self.name = name
+        self.weight = float(weight)
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.wait_secs = wait_secs
+        self.queue = collections.deque()
+        self.active = 0
+        # virtual time: grows by 1/weight for each request let through
+        self.vtime = 0.0
+        self.granted = 0
+        self.shed = 0
+
+    def runnable(self):
+        return self.queue and (self.max_active is None or
+                               self.active < self.max_active)
+
+    def stats(self):
+        return {'active': self.active, 'waiting': len(self.queue),
+                'granted': self.granted, 'shed': self.shed}
+
+
+class Waiter(object):
+    __slots__ = ('granted',)
+
+    def __init__(self):
+        self.granted = False
+
+
+class Scheduler(object):
+    """
+    Lets at most "max_active" requests to Blueflood run at once and
+    decides whose go next when they are all taken.  Each class has its own
+    queue; the runnable class that got the least so far, relative to its
+    weight, goes first (weighted fair queuing), so a class of weight 10
+    gets ten requests through for each one of a class of weight 1 while
+    both have requests waiting, and all of them when it's the only one.
+    """
+
+    def __init__(self, max_active=8, classes=None, default='interactive'):
+        self.max_active = max_active
+        self.classes = {}
+        for name, options in (classes or DEFAULT_CLASSES).items():
+            self.classes[name] = PriorityClass(name, **options)
+        if default not in self.classes:
+            raise ValueError("Unknown default priority class: %s" % default)
+        self.default = default
+        self.cond = threading.Condition()
+        self.active = 0
+
+    def get_class(self, name):
+        return self.classes.get(name) or self.classes[self.default]
+
+    @contextlib.contextmanager
+    def slot(self, name, timeout=None):
+        cls = self.acquire(name, timeout)
+        try:
+            yield cls
+        finally:
+            self.release(cls)
+
+    def acquire(self, name, timeout=None):
+        # Waits for the turn of a request of class "name", at most the
+        # class' wait_secs or "timeout"
+        cls = self.get_class(name)
+        waiter = Waiter()
+        with self.cond:
+            if len(cls.queue) >= cls.max_waiting and not self.free(cls):
+                cls.shed += 1
+                raise BluefloodOverloaded(
+                    "Too many %s requests to Blueflood queued (%d)" %
+                    (cls.name, len(cls.queue)))
+            if not cls.queue and cls.active == 0:
+                # idle classes don't bank the turns they didn't take
+                cls.vtime = max(cls.vtime, self.min_vtime())
+            cls.queue.append(waiter)
+            self.dispatch()
+            wait = cls.wait_secs
+            if timeout is not None:
+                wait = min(wait, timeout)
+            deadline = time.time() + wait
+            while not waiter.granted:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    cls.queue.remove(waiter)
+                    cls.shed += 1
+                    raise BluefloodOverloaded(
+                        "Timed out after %.1fs waiting to send a %s request "
+                        "to Blueflood" % (wait, cls.name))
+                self.cond.wait(remaining)
+        return cls
+
+    def release(self, cls):
+        with self.cond:
+            self.active -= 1
+            cls.active -= 1
+            self.dispatch()
+
+    def free(self, cls):
+        # True if a request of "cls" could start right away
+        return self.active < self.max_active and \
+            (cls.max_active is None or cls.active < cls.max_active)
+
+    def min_vtime(self):
+        # expects the lock to be held
+        busy = [c.vtime for c in self.classes.values()
+                if c.queue or c.active]
+        return min(busy) if busy else 0.0
+
+    def dispatch(self):
+        # Hands the free slots to the waiters of the runnable classes,
+        # least virtual time first.  Expects the lock to be held.
+        granted = False
+        while self.active < self.max_active:
+            runnable = [c for c in self.classes.values() if c.runnable()]
+            if not runnable:
+                break
+            cls = min(runnable, key=lambda c: (c.vtime, -c.weight))
+            cls.queue.popleft().granted = True
+            cls.vtime += 1 / cls.weight
+            cls.active += 1
+            cls.granted += 1
+            self.active += 1
+            granted = True
+        if granted:
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return dict((c.name, c.stats()) for c in self.classes.values())
+
+    def after_fork(self):
+        # The requests running and queued are the parent's
+        self.cond = threading.Condition()
+        self.active = 0
+        for c in self.classes.values():
+            c.queue.clear()
+            c.active = 0
+
+
+class Rule(object):
+    """
+    Puts the graphite-api requests it matches in class "name".  It
+    matches requests whose "header" is set (to a value matching the glob
+    "value", if given), whose User-Agent matches "user_agent" and whose
+    render "target" matches that glob, whichever of those are given.
+    """
+
+    def __init__(self, name, header=None, value=None, user_agent=None,
+                 target=None):
+        self.name = name
+        self.header = header
+        self.value = value
+        self.user_agent = user_agent
+        self.target = target
+
+    def matches(self):
+        if self.header is not None:
+            v = context.get_request_header(self.header)
+            if v is None or (self.value is not None and
+                             not fnmatch.fnmatchcase(v, self.value)):
+                return False
+        if self.user_agent is not None and not fnmatch.fnmatchcase(
+                context.get_request_header('User-Agent', ''),
+                self.user_agent):
+            return False
+        if self.target is not None and not fnmatch.fnmatchcase(
+                context.get_request_param('target', ''), self.target):
+            return False
+        return True
+
+
+# The header graphite-api clients can name their class with, and the
+# rules for those that don't
+header = None
+rules = []
+
+
+def configure(options=None):
+    """
+    Sets up the scheduler from the "scheduler" option: its max_active,
+    default class, header and classes, and the rules classifying requests.
+    None turns it off.
+    """
+    global scheduler, header, rules
+    if not options:
+        scheduler = None
+        header = None
+        rules = []
+        return
+    options = dict(options)
+    header = options.pop('header', None)
+    rules = [Rule(r.pop('class'), **r)
+             for r in (dict(r) for r in options.pop('rules', []))]
+    scheduler = Scheduler(**options)
+
+
+def classify():
+    # The class of the graphite-api request being served, None outside
+    # of one
+    if not context.in_request():
+        return None
+    if header is not None:
+        name = context.get_request_header(header)
+        if name is not None and name in scheduler.classes:
+            return name
+    for rule in rules:
+        if rule.matches():
+            return rule.name
+    return None
+
+
+def current_class():
+    # The class of the requests the current thread makes
+    name = getattr(local, 'priority', None)
+    if name is None:
+        name = context.request_memo('blueflood_priority', classify)
+    return name
+
+
+@contextlib.contextmanager
+def priority(name):
+    # Requests made inside this block are of class "name"
+    previous = getattr(local, 'priority', None)
+    local.priority = name
+    try:
+        yield
+    finally:
+        local.priority = previous
+
+
+@contextlib.contextmanager
+def slot(timeout=None):
+    # Waits for the turn of the current thread's next request
+    if scheduler is None:
+        yield None
+        return
+    with scheduler.slot(current_class(), timeout) as cls:
+        yield cls
+
+
+def after_fork():
+    if scheduler is not None:
+        scheduler.after_fork()
+
+
+lifecycle.register(after_fork)
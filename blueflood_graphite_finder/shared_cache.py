@@ -0,0 +1,580 @@
+import collections
+import contextlib
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from blueflood_graphite_finder import codec, lifecycle
+from blueflood_graphite_finder.cache import LRUCache
+from blueflood_graphite_finder.rollup_cache import decode_points, \
+    encode_points
+
+logger = logging.getLogger('blueflood_finder')
+
+# Cached values are a type byte, a flags byte and the payload, which is
+# zlib compressed when that saves something:
+#   N: search results, a line per node: "1" or "0" for leaf, then the name
+#   M: metrics with their enum values, a line per metric: the name, then
+#      a tab and the tab separated enum values if it has any
+#   P: datapoints encoded like in the rollup cache: field mask, count,
+#      packed points
+#   J: datapoints that can't be packed, as JSON
+COMPRESSED = 1
+COMPRESS_MIN = 512
+POINTS = struct.Struct('<BI')
+
+
+def pack(kind, payload):
+    flags = 0
+    if len(payload) >= COMPRESS_MIN:
+        compressed = zlib.compress(payload, 1)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= COMPRESSED
+    return kind + chr(flags) + payload
+
+
+def unpack(data):
+    payload = data[2:]
+    if ord(data[1]) & COMPRESSED:
+        payload = zlib.decompress(payload)
+    return data[0], payload
+
+
+def encode_nodes(nodes):
+    # "nodes" as the metric_name search returns them: [{name: is_leaf}]
+    lines = []
+    for node in nodes:
+        for name, is_leaf in node.items():
+            lines.append(('1' if is_leaf else '0') + name.encode('utf-8'))
+    return pack('N', '\n'.join(lines))
+
+
+def decode_nodes(data):
+    kind, payload = unpack(data)
+    if kind != 'N' or not payload:
+        return None
+    return [{line[1:].decode('utf-8'): line[0] == '1'}
+            for line in payload.split('\n')]
+
+
+def encode_metrics(metrics):
+    # "metrics" as find_metrics_with_enum_values returns them:
+    # {name: enum values or None}
+    lines = []
+    for name, enums in metrics.items():
+        line = name.encode('utf-8')
+        if enums is not None:
+            line += '\t' + '\t'.join(e.encode('utf-8') for e in enums)
+        lines.append(line)
+    return pack('M', '\n'.join(lines))
+
+
+def decode_metrics(data):
+    kind, payload = unpack(data)
+    if kind != 'M' or not payload:
+        return None
+    metrics = {}
+    for line in payload.split('\n'):
+        parts = line.decode('utf-8').split('\t')
+        enums = None
+        if len(parts) > 1:
+            enums = [e for e in parts[1:] if e]
+        metrics[parts[0]] = enums
+    return metrics
+
+
+def encode_series(points):
+    encoded = encode_points(points)
+    if encoded is None:
+        return pack('J', codec.dumps(points))
+    mask, packed = encoded
+    return pack('P', POINTS.pack(mask, len(points)) + packed)
+
+
+def decode_series(data):
+    kind, payload = unpack(data)
+    if kind == 'J':
+        return codec.loads(payload)
+    if kind != 'P':
+        return None
+    mask, count = POINTS.unpack_from(payload)
+    return decode_points(payload, POINTS.size, count, mask)
+
+
+class LocalBackend(object):
+    """
+    Keeps the values in this process, "max_bytes" of them at most.  Only
+    useful with one worker, or to try things out.
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        self.entries = LRUCache(max_bytes)
+        self.lock = threading.Lock()
+        lifecycle.register_object(self)
+
+    def get_multi(self, keys):
+        found = {}
+        for k in keys:
+            v = self.entries.get(k)
+            if v is not None:
+                found[k] = v
+        return found
+
+    def set_multi(self, values, ttl):
+        for k, v in values.items():
+            self.entries.put(k, v, ttl, len(v))
+
+    def add(self, key, value, ttl):
+        with self.lock:
+            if self.entries.get(key) is not None:
+                return False
+            self.entries.put(key, value, ttl, len(value))
+            return True
+
+    def delete(self, key):
+        self.entries.pop(key)
+
+    def after_fork(self):
+        # a forked worker has a copy of the values, which is fine
+        self.lock = threading.Lock()
+        self.entries.after_fork()
+
+
+class SharedMemoryBackend(object):
+    """
+    Keeps the values in a memory mapped file, by default in /dev/shm, that
+    all the processes of a host share.  The file is "slots" slots of
+    "slot_bytes"; a key can live in either of two slots and a new value
+    takes whichever of them holds the same key, nothing, or expires first.
+    Values that don't fit a slot aren't cached.  Slots are locked with
+    fcntl against other processes and thread locks against other threads.
+    """
+    # key hash, expiry (epoch), key length, value length
+    SLOT = struct.Struct('<QdHI')
+    LOCK_STRIPES = 64
+
+    def __init__(self, path='/dev/shm/blueflood-finder-cache', slots=4096,
+                 slot_bytes=16 << 10):
+        self.path = path
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        size = slots * slot_bytes
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size != size:
+            # a file with another layout is of no use to us
+            with self.locked_file():
+                if os.fstat(self.fd).st_size != size:
+                    os.ftruncate(self.fd, 0)
+                    os.ftruncate(self.fd, size)
+        self.buf = mmap.mmap(self.fd, size)
+        self.thread_locks = [threading.Lock()
+                             for _ in range(self.LOCK_STRIPES)]
+        lifecycle.register_object(self)
+
+    @contextlib.contextmanager
+    def locked_file(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def locked(self, slots, exclusive):
+        # "slots" must be sorted, so everyone locks in the same order
+        locks = sorted(set(s % self.LOCK_STRIPES for s in slots))
+        for i in locks:
+            self.thread_locks[i].acquire()
+        mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            for s in slots:
+                fcntl.lockf(self.fd, mode, self.slot_bytes,
+                            s * self.slot_bytes)
+            try:
+                yield
+            finally:
+                for s in slots:
+                    fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slot_bytes,
+                                s * self.slot_bytes)
+        finally:
+            for i in reversed(locks):
+                self.thread_locks[i].release()
+
+    def hash(self, key):
+        return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+    def candidates(self, h):
+        return sorted(set([h % self.slots, (h >> 32) % self.slots]))
+
+    def read(self, slot, h, key, now):
+        # The value of "key" in "slot", if it is there and current
+        offset = slot * self.slot_bytes
+        slot_hash, expires, key_len, value_len = \
+            self.SLOT.unpack_from(self.buf, offset)
+        if slot_hash != h or expires < now or value_len == 0:
+            return None
+        start = offset + self.SLOT.size
+        if self.buf[start:start + key_len] != key:
+            return None
+        return self.buf[start + key_len:start + key_len + value_len]
+
+    def write(self, slot, h, key, value, expires):
+        offset = slot * self.slot_bytes
+        self.buf[offset + self.SLOT.size:
+                 offset + self.SLOT.size + len(key) + len(value)] = \
+            key + value
+        self.SLOT.pack_into(self.buf, offset, h, expires, len(key),
+                            len(value))
+
+    def choose(self, slots, h, key, now):
+        # The slot a new value of "key" goes to
+        best = None
+        best_expires = None
+        for s in slots:
+            slot_hash, expires, _, value_len = self.SLOT.unpack_from(
+                self.buf, s * self.slot_bytes)
+            if slot_hash == h and self.read(s, h, key, -1) is not None:
+                return s
+            if value_len == 0 or expires < now:
+                expires = 0
+            if best is None or expires < best_expires:
+                best, best_expires = s, expires
+        return best
+
+    def fits(self, key, value):
+        return self.SLOT.size + len(key) + len(value) <= self.slot_bytes
+
+    def get_multi(self, keys):
+        found = {}
+        now = time.time()
+        for k in keys:
+            h = self.hash(k)
+            slots = self.candidates(h)
+            with self.locked(slots, False):
+                for s in slots:
+                    v = self.read(s, h, k, now)
+                    if v is not None:
+                        found[k] = v
+                        break
+        return found
+
+    def set_multi(self, values, ttl):
+        now = time.time()
+        for k, v in values.items():
+            if not self.fits(k, v):
+                continue
+            h = self.hash(k)
+            slots = self.candidates(h)
+            with self.locked(slots, True):
+                self.write(self.choose(slots, h, k, now), h, k, v,
+                           now + ttl)
+
+    def add(self, key, value, ttl):
+        now = time.time()
+        h = self.hash(key)
+        slots = self.candidates(h)
+        with self.locked(slots, True):
+            if any(self.read(s, h, key, now) is not None for s in slots):
+                return False
+            self.write(self.choose(slots, h, key, now), h, key, value,
+                       now + ttl)
+            return True
+
+    def delete(self, key):
+        h = self.hash(key)
+        slots = self.candidates(h)
+        with self.locked(slots, True):
+            for s in slots:
+                if self.read(s, h, key, -1) is not None:
+                    self.SLOT.pack_into(self.buf, s * self.slot_bytes,
+                                        0, 0, 0, 0)
+
+    def after_fork(self):
+        # the mapping is shared with the parent, which is the point
+        self.thread_locks = [threading.Lock()
+                             for _ in range(self.LOCK_STRIPES)]
+
+
+class MemcachedError(Exception):
+    pass
+
+
+class MemcachedConnection(object):
+    def __init__(self, address, timeout):
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile('rb')
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self):
+        line = self.file.readline()
+        if not line.endswith('\r\n'):
+            raise MemcachedError("Connection closed")
+        return line[:-2]
+
+    def read(self, n):
+        data = self.file.read(n + 2)
+        if len(data) != n + 2:
+            raise MemcachedError("Connection closed")
+        return data[:-2]
+
+    def close(self):
+        try:
+            self.file.close()
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class MemcachedBackend(object):
+    """
+    Keeps the values in memcached (or anything speaking its text
+    protocol), which every worker of every host can share.  Keys are
+    spread over "servers" by hash.  A server that can't be reached is
+    skipped for "retry_secs": its keys are misses and nothing is stored.
+    Values over "max_value" bytes, which memcached would refuse, aren't
+    cached.
+    """
+
+    def __init__(self, servers=('127.0.0.1:11211',), timeout=0.5,
+                 retry_secs=5, max_idle=10, max_value=1000000):
+        self.servers = []
+        for server in servers:
+            host, _, port = server.rpartition(':')
+            self.servers.append((host or '127.0.0.1', int(port or 11211)))
+        self.timeout = timeout
+        self.retry_secs = retry_secs
+        self.max_idle = max_idle
+        self.max_value = max_value
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+        self.down_until = {}
+        lifecycle.register_object(self)
+
+    def server(self, key):
+        return self.servers[zlib.crc32(key) % len(self.servers)]
+
+    def connect(self, server):
+        with self.lock:
+            if self.idle[server]:
+                return self.idle[server].pop()
+            if self.down_until.get(server, 0) > time.time():
+                return None
+        try:
+            return MemcachedConnection(server, self.timeout)
+        except socket.error as e:
+            self.failed(server, None, e)
+            return None
+
+    def release(self, server, conn):
+        with self.lock:
+            if len(self.idle[server]) < self.max_idle:
+                self.idle[server].append(conn)
+                return
+        conn.close()
+
+    def failed(self, server, conn, error):
+        logger.warning("memcached %s:%d failed: %s", server[0], server[1],
+                       error)
+        if conn is not None:
+            conn.close()
+        with self.lock:
+            self.down_until[server] = time.time() + self.retry_secs
+
+    def call(self, server, f, default):
+        # Runs f(conn) on a connection to "server", "default" if it fails
+        conn = self.connect(server)
+        if conn is None:
+            return default
+        try:
+            result = f(conn)
+        except (socket.error, MemcachedError) as e:
+            self.failed(server, conn, e)
+            return default
+        self.release(server, conn)
+        return result
+
+    def get_multi(self, keys):
+        by_server = collections.defaultdict(list)
+        for k in keys:
+            by_server[self.server(k)].append(k)
+        found = {}
+        for server, server_keys in by_server.items():
+            found.update(self.call(server, lambda c, ks=server_keys:
+                                   self.get_keys(c, ks), {}))
+        return found
+
+    def get_keys(self, conn, keys):
+        conn.send('get %s\r\n' % ' '.join(keys))
+        found = {}
+        while True:
+            line = conn.readline()
+            if line == 'END':
+                return found
+            parts = line.split()
+            if len(parts) < 4 or parts[0] != 'VALUE':
+                raise MemcachedError("Unexpected answer: %r" % line[:100])
+            found[parts[1]] = conn.read(int(parts[3]))
+
+    def set_multi(self, values, ttl):
+        by_server = collections.defaultdict(list)
+        for k, v in values.items():
+            if len(v) > self.max_value:
+                continue
+            by_server[self.server(k)].append(
+                'set %s 0 %d %d noreply\r\n%s\r\n' % (k, int(ttl), len(v), v))
+        for server, commands in by_server.items():
+            self.call(server, lambda c, cs=commands: c.send(''.join(cs)),
+                      None)
+
+    def add(self, key, value, ttl):
+        def add(conn):
+            conn.send('add %s 0 %d %d\r\n%s\r\n' % (key, int(ttl),
+                                                    len(value), value))
+            return conn.readline() == 'STORED'
+        # when memcached is down everyone goes ahead
+        return self.call(self.server(key), add, True)
+
+    def delete(self, key):
+        self.call(self.server(key),
+                  lambda c: c.send('delete %s noreply\r\n' % key), None)
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = collections.defaultdict(list)
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def after_fork(self):
+        # the sockets are the parent's
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+
+
+BACKENDS = {'local': LocalBackend,
+            'shm': SharedMemoryBackend,
+            'memcached': MemcachedBackend}
+
+
+class SharedCache(object):
+    """
+    Search and datapoint results cached in a backend that can be shared by
+    processes and hosts.  When several callers miss the same entry at once
+    only one of them computes it, the others wait up to "lock_wait"
+    seconds for it to show up in the cache (stampede protection).
+    """
+
+    def __init__(self, backend, find_ttl=60, fetch_ttl=30, lock_ttl=10,
+                 lock_wait=2, poll=0.02, prefix='bf'):
+        self.backend = backend
+        self.find_ttl = find_ttl
+        self.fetch_ttl = fetch_ttl
+        self.lock_ttl = lock_ttl
+        self.lock_wait = lock_wait
+        self.poll = poll
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def key(self, *parts):
+        # Short keys without spaces, as memcached wants them
+        raw = '\0'.join(p.encode('utf-8') if isinstance(p, unicode)
+                        else str(p) for p in parts)
+        return '%s:%s' % (self.prefix, hashlib.sha1(raw).hexdigest())
+
+    def get_multi(self, keys, decode):
+        found = {}
+        for k, data in self.backend.get_multi(keys).items():
+            value = decode(data)
+            if value is not None:
+                found[k] = value
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set_multi(self, values, ttl):
+        # "values" are already encoded
+        if values:
+            self.backend.set_multi(values, ttl)
+
+    def single_flight(self, lock_key, compute, encode, ttl):
+        """
+        Returns (True, compute()) if nobody else is computing "lock_key",
+        caching the entries encode() makes of the value, {key: data},
+        before letting go of the lock.  Else waits until they are done, at
+        most "lock_wait" seconds, and returns (False, None): what they
+        computed is in the cache then.
+        """
+        lock_key += ':lock'
+        if self.backend.add(lock_key, '1', self.lock_ttl):
+            try:
+                value = compute()
+                # the waiters look in the cache as soon as the lock goes
+                self.set_multi(encode(value), ttl)
+                return True, value
+            finally:
+                self.backend.delete(lock_key)
+        self.waits += 1
+        deadline = time.time() + self.lock_wait
+        while time.time() < deadline and \
+                self.backend.get_multi([lock_key]):
+            time.sleep(self.poll)
+        return False, None
+
+    def fetch(self, key, compute, encode, decode, ttl):
+        """
+        The value of "key", computed and cached if it isn't there.  encode
+        returns None for values that shouldn't be cached.
+        """
+        found = self.get_multi([key], decode)
+        if key in found:
+            return found[key]
+
+        def entries(value):
+            data = encode(value)
+            return {} if data is None else {key: data}
+        computed, value = self.single_flight(key, compute, entries, ttl)
+        if not computed:
+            found = self.get_multi([key], decode)
+            if key in found:
+                return found[key]
+            value = compute()
+            self.set_multi(entries(value), ttl)
+        return value
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'waits': self.waits}
+
+
+def make_cache(options):
+    """
+    Makes the SharedCache described by the "shared_cache" option: the
+    name of the backend and the arguments of SharedCache and the backend.
+    """
+    options = dict(options)
+    backend = options.pop('backend', 'local')
+    if backend not in BACKENDS:
+        raise ValueError("Unknown shared cache backend: %s" % backend)
+    cache_args = {}
+    for name in ('find_ttl', 'fetch_ttl', 'lock_ttl', 'lock_wait', 'poll',
+                 'prefix'):
+        if name in options:
+            cache_args[name] = options.pop(name)
+    return SharedCache(BACKENDS[backend](**options), **cache_args)
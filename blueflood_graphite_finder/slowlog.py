@@ -0,0 +1,176 @@
+import contextlib
+import cProfile
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger('blueflood_finder')
+
+# Queries taking at least "threshold" seconds are logged, None disables.
+# "profile_rate" of all queries are profiled, and the profiles of the slow
+# ones are kept in "profile_dir", which holds at most "profile_keep".
+threshold = None
+profile_rate = 0
+profile_dir = None
+profile_keep = 100
+# The query each thread is working on
+local = threading.local()
+# Tells apart the profiles saved within the same millisecond
+sequence = itertools.count()
+
+
+def configure(new_threshold=None, new_profile_rate=0, new_profile_dir=None,
+              new_profile_keep=100):
+    global threshold, profile_rate, profile_dir, profile_keep
+    threshold = new_threshold
+    profile_rate = new_profile_rate
+    profile_dir = new_profile_dir
+    profile_keep = new_profile_keep
+    if profile_dir and not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+
+
+def enabled():
+    return threshold is not None
+
+
+class Query(object):
+    """
+    What is known about one find_nodes or fetch_multi call: its fields
+    (pattern, node count, ...), the time spent in each phase and the
+    number and size of the Blueflood requests it made.
+    """
+
+    def __init__(self, kind, **fields):
+        self.kind = kind
+        self.fields = fields
+        self.started = time.time()
+        self.phases = {}
+        self.phase_name = None
+        self.phase_start = None
+        self.requests = 0
+        self.request_secs = 0
+        self.bytes = 0
+        self.profile = None
+        if profile_dir and random.random() < profile_rate:
+            self.profile = cProfile.Profile()
+
+    def phase(self, name):
+        now = time.time()
+        if self.phase_name is not None:
+            self.phases[self.phase_name] = self.phases.get(
+                self.phase_name, 0) + now - self.phase_start
+        self.phase_name = name
+        self.phase_start = now
+
+    def count(self, name, n=1):
+        self.fields[name] = self.fields.get(name, 0) + n
+
+    def describe(self, elapsed):
+        fields = ' '.join('%s=%s' % kv for kv in sorted(self.fields.items()))
+        phases = ' '.join('%s=%.3f' % kv for kv in sorted(self.phases.items()))
+        return ("slow %s %.3fs: %s requests=%d request_secs=%.3f bytes=%d "
+                "phases: %s" % (self.kind, elapsed, fields, self.requests,
+                                self.request_secs, self.bytes, phases))
+
+
+def current():
+    return getattr(local, 'query', None)
+
+
+@contextlib.contextmanager
+def active(query):
+    # Makes "query" the one this thread is working on for the duration of
+    # the block, nested blocks count towards the outer query
+    if query is None or current() is not None:
+        yield
+        return
+    local.query = query
+    if query.profile is not None:
+        query.profile.enable()
+    try:
+        yield
+    finally:
+        if query.profile is not None:
+            query.profile.disable()
+        query.phase(None)
+        local.query = None
+
+
+def start(kind, **fields):
+    if threshold is None or current() is not None:
+        return None
+    return Query(kind, **fields)
+
+
+def finish(query):
+    if query is None:
+        return
+    elapsed = time.time() - query.started
+    if elapsed < threshold:
+        return
+    message = query.describe(elapsed)
+    if query.profile is not None:
+        message += ' profile=%s' % save_profile(query)
+    logger.warning(message)
+
+
+@contextlib.contextmanager
+def timed(kind, **fields):
+    query = start(kind, **fields)
+    try:
+        with active(query):
+            yield query
+    except Exception as e:
+        if query is not None:
+            query.fields['error'] = type(e).__name__
+        raise
+    finally:
+        finish(query)
+
+
+def save_profile(query):
+    name = '%013d-%s-%d-%d.prof' % (query.started * 1000, query.kind,
+                                    os.getpid(), next(sequence))
+    path = os.path.join(profile_dir, name)
+    query.profile.dump_stats(path)
+    # only keep the latest ones
+    profiles = sorted(f for f in os.listdir(profile_dir)
+                      if f.endswith('.prof'))
+    for f in profiles[:-profile_keep]:
+        try:
+            os.remove(os.path.join(profile_dir, f))
+        except OSError:
+            pass
+    return path
+
+
+def phase(name):
+    # Starts a new phase of the current query
+    query = current()
+    if query is not None:
+        query.phase(name)
+
+
+def add(**fields):
+    query = current()
+    if query is not None:
+        query.fields.update(fields)
+
+
+def count(name, n=1):
+    query = current()
+    if query is not None:
+        query.count(name, n)
+
+
+def request(secs, size):
+    # Records a Blueflood request made for the current query
+    query = current()
+    if query is not None:
+        query.requests += 1
+        query.request_secs += secs
+        query.bytes += size
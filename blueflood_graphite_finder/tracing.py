@@ -0,0 +1,250 @@
+import binascii
+import contextlib
+import importlib
+import logging
+import os
+import random
+import threading
+import time
+
+from blueflood_graphite_finder import context
+
+logger = logging.getLogger('blueflood_finder')
+
+# Where finished spans go, None turns tracing off
+exporter = None
+# The share of the graphite-api requests traced, unless the caller
+# decided already (W3C traceparent header)
+sample_rate = 1.0
+# The header carrying the id of the graphite-api request to Blueflood,
+# taken from the request if it has one
+request_id_header = None
+# The spans each thread is in, innermost last
+local = threading.local()
+
+
+def new_id(size):
+    return binascii.hexlify(os.urandom(size))
+
+
+class Span(object):
+    """
+    A timed piece of work of a trace, with "attributes" describing it.
+    Used as a context manager it is the current span of the thread, the
+    parent of the spans started inside it, and is exported when it ends.
+    """
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start', 'end',
+                 'attributes', 'error')
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id(8)
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.end = None
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def traceparent(self):
+        return '00-%s-%s-01' % (self.trace_id, self.span_id)
+
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    @contextlib.contextmanager
+    def active(self):
+        # Makes this the current span for the duration of the block
+        stack = spans()
+        stack.append(self)
+        try:
+            yield self
+        finally:
+            stack.pop()
+
+    def finish(self, error=None):
+        self.end = time.time()
+        if error is not None:
+            self.error = '%s: %s' % (type(error).__name__, error)
+        export(self)
+
+    def __enter__(self):
+        spans().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        spans().pop()
+        self.finish(exc)
+        return False
+
+
+class NoopSpan(object):
+    # What span() returns when tracing is off or the trace isn't sampled
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NOOP = NoopSpan()
+
+
+class LogExporter(object):
+    # Logs each span on one line, for trying things out or log pipelines
+
+    def __init__(self, level='info'):
+        self.level = getattr(logging, level.upper())
+
+    def export(self, span):
+        attributes = ' '.join('%s=%s' % kv
+                              for kv in sorted(span.attributes.items()))
+        logger.log(self.level, "span %s %.3fs trace=%s span=%s parent=%s "
+                   "%s%s", span.name, span.duration(), span.trace_id,
+                   span.span_id, span.parent_id, attributes,
+                   ' error=%s' % span.error if span.error else '')
+
+
+def configure(options=None):
+    """
+    Sets up tracing from the "tracing" option: the "exporter" class
+    (module.Class) and its "exporter_options", the "sample_rate" and the
+    "request_id_header".  None turns it off.
+    """
+    global exporter, sample_rate, request_id_header
+    options = dict(options or {})
+    exporter = None
+    name = options.get('exporter')
+    if name:
+        module, cls = name.rsplit('.', 1)
+        exporter = getattr(importlib.import_module(module), cls)(
+            **options.get('exporter_options', {}))
+    sample_rate = options.get('sample_rate', 1.0)
+    request_id_header = options.get('request_id_header')
+
+
+def set_exporter(new_exporter):
+    global exporter
+    exporter = new_exporter
+
+
+def enabled():
+    return exporter is not None
+
+
+def spans():
+    stack = getattr(local, 'spans', None)
+    if stack is None:
+        stack = local.spans = []
+    return stack
+
+
+def current():
+    stack = getattr(local, 'spans', None)
+    return stack[-1] if stack else None
+
+
+def request_trace():
+    # (trace id, parent span id, sampled, request id) of the graphite-api
+    # request being served, made up for work done outside of one
+    return context.request_memo('blueflood_trace', start_trace)
+
+
+def start_trace():
+    trace_id = parent_id = None
+    parent = context.get_request_header('traceparent')
+    if parent is not None:
+        parts = parent.split('-')
+        if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+            trace_id, parent_id = parts[1], parts[2]
+            try:
+                sampled = bool(int(parts[3], 16) & 1)
+            except ValueError:
+                trace_id = None
+    if trace_id is None:
+        trace_id = new_id(16)
+        parent_id = None
+        sampled = random.random() < sample_rate
+    request_id = None
+    if request_id_header is not None:
+        request_id = context.get_request_header(request_id_header)
+    return trace_id, parent_id, sampled, request_id or trace_id
+
+
+def span(name, **attributes):
+    """
+    A new Span, child of the current one, to be used as a context
+    manager.  Costs next to nothing when tracing is off.
+    """
+    if exporter is None:
+        return NOOP
+    parent = current()
+    if parent is not None:
+        return Span(name, parent.trace_id, parent.span_id, attributes)
+    trace_id, parent_id, sampled, request_id = request_trace()
+    if not sampled:
+        return NOOP
+    attributes['request_id'] = request_id
+    return Span(name, trace_id, parent_id, attributes)
+
+
+def traced(name, make, **attributes):
+    """
+    Generates the items of the iterable make() returns in a span, which is
+    only the current span while the iterable is working (for the lazy
+    results of find_nodes).
+    """
+    s = span(name, **attributes)
+    if s is NOOP:
+        return make()
+    return _traced(s, make)
+
+
+def _traced(s, make):
+    items = 0
+    error = None
+    try:
+        with s.active():
+            it = iter(make())
+        while True:
+            with s.active():
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+            items += 1
+            yield item
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        s.set(items=items)
+        s.finish(error)
+
+
+def export(s):
+    try:
+        exporter.export(s)
+    except Exception:
+        logger.exception("Can't export span %s", s.name)
+
+
+def inject(headers):
+    # The headers of a Blueflood request, with the request id and the
+    # current span added
+    if exporter is None and request_id_header is None:
+        return headers
+    headers = dict(headers or {})
+    if request_id_header is not None:
+        headers[request_id_header] = request_trace()[3]
+    s = current()
+    if s is not None:
+        headers['traceparent'] = s.traceparent()
+    return headers
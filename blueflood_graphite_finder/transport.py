@@ -0,0 +1,236 @@
+import contextlib
+import logging
+import random
+import threading
+import time
+import urlparse
+
+import requests
+
+from blueflood_graphite_finder import auth, context, lifecycle, scheduler, \
+    slowlog, tracing
+from blueflood_graphite_finder.breaker import CircuitBreaker
+from blueflood_graphite_finder.errors import BluefloodDeadlineExceeded
+
+logger = logging.getLogger('blueflood_finder')
+
+# All requests to Blueflood go through one session, so connections are
+# pooled and kept alive across requests, tenants and threads
+pool_size = 10
+session = None
+session_lock = threading.Lock()
+# Seconds to wait for Blueflood to connect/answer, None waits forever
+timeout = 60
+# Keyword arguments for the CircuitBreaker of each (host, kind of request),
+# None disables them
+breaker_options = None
+breakers = {}
+# Failed requests are retried up to "max_retries" times, waiting a random
+# time of up to retry_backoff * 2^attempt (at most "retry_max_backoff")
+# seconds in between.  Every request we make is a read, so all of them
+# are safe to retry.
+max_retries = 2
+retry_backoff = 0.1
+retry_max_backoff = 2
+RETRY_STATUSES = frozenset([502, 503, 504])
+# Holds the deadline of the render being served by each thread, and the
+# RateLimiter its requests must wait for, if any
+local = threading.local()
+
+
+def configure(new_pool_size=10, new_timeout=60, new_breaker_options=None,
+              new_max_retries=2, new_retry_backoff=0.1,
+              new_retry_max_backoff=2):
+    global pool_size, session, timeout, breaker_options
+    global max_retries, retry_backoff, retry_max_backoff
+    with session_lock:
+        pool_size = new_pool_size
+        session = None
+        timeout = new_timeout
+        breaker_options = new_breaker_options
+        breakers.clear()
+        max_retries = new_max_retries
+        retry_backoff = new_retry_backoff
+        retry_max_backoff = new_retry_max_backoff
+
+
+@contextlib.contextmanager
+def budget(secs):
+    # Requests made inside this block, retries included, must be done
+    # within "secs" of the start of the graphite-api request (or of
+    # entering the block, outside of one).  Nested budgets can only
+    # shorten the deadline.
+    previous = getattr(local, 'deadline', None)
+    if secs is not None:
+        deadline = context.request_start_time(time.time()) + secs
+        if previous is None or deadline < previous:
+            local.deadline = deadline
+    try:
+        yield
+    finally:
+        local.deadline = previous
+
+
+@contextlib.contextmanager
+def limited(limiter):
+    # Requests made inside this block first wait for "limiter"
+    previous = getattr(local, 'limiter', None)
+    local.limiter = limiter
+    try:
+        yield
+    finally:
+        local.limiter = previous
+
+
+def remaining_time():
+    # Seconds left in the current budget, None if there is none
+    deadline = getattr(local, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def get_session():
+    global session
+    with session_lock:
+        if session is None:
+            s = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                    pool_maxsize=pool_size)
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            session = s
+        return session
+
+
+def after_fork():
+    # The parent's connections and breakers are its own
+    global session, session_lock
+    session_lock = threading.Lock()
+    session = None
+    breakers.clear()
+
+
+lifecycle.register(after_fork)
+
+
+def get_breaker(url, kind):
+    if breaker_options is None:
+        return None
+    parts = urlparse.urlsplit(url)
+    key = (parts.scheme, parts.netloc, kind)
+    with session_lock:
+        breaker = breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker('%s://%s %s' % key, **breaker_options)
+            breakers[key] = breaker
+        return breaker
+
+
+def send(method, url, params, data, headers, kind):
+    limiter = getattr(local, 'limiter', None)
+    if limiter is not None:
+        limiter.acquire()
+    # waits for its turn among the requests of all priority classes
+    with scheduler.slot(remaining_time()):
+        return send_now(method, url, params, data, headers, kind)
+
+
+def send_now(method, url, params, data, headers, kind):
+    left = remaining_time()
+    if left is not None and left <= 0:
+        raise BluefloodDeadlineExceeded(
+            "No time left to request %s" % url)
+    breaker = get_breaker(url, kind)
+    if breaker is not None:
+        breaker.allow()
+    with tracing.span('blueflood_request', method=method, url=url,
+                      kind=kind) as span:
+        headers = tracing.inject(headers)
+        start = time.time()
+        ok = False
+        r = None
+        try:
+            r = get_session().request(method, url, params=params, data=data,
+                                      headers=headers,
+                                      timeout=min_timeout(timeout, left))
+            ok = r.status_code < 500
+            span.set(status=r.status_code, bytes=len(r.content))
+            return r
+        finally:
+            elapsed = time.time() - start
+            if breaker is not None:
+                breaker.record(ok, elapsed)
+            slowlog.request(elapsed, 0 if r is None else len(r.content))
+
+
+def min_timeout(a, b):
+    # None means no timeout
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+
+def retry_delay(attempt):
+    # Seconds to wait before retry number "attempt", None to give up
+    if attempt > max_retries:
+        return None
+    delay = random.uniform(0, min(retry_max_backoff,
+                                  retry_backoff * 2 ** (attempt - 1)))
+    left = remaining_time()
+    if left is not None and delay >= left:
+        return None
+    return delay
+
+
+def request(method, url, params=None, data=None, headers=None,
+            kind='search'):
+    # Sends an authenticated request, getting a new token and retrying
+    # once if the current one is refused.  "kind" is the type of endpoint
+    # (search, views or events), each has its own circuit breaker.
+    # Connection errors, timeouts and 502/503/504 responses are retried
+    # with backoff while the budget lasts.
+    if headers is None:
+        headers = auth.headers()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            r = send_authenticated(method, url, params, data, headers, kind)
+            if r.status_code not in RETRY_STATUSES:
+                return r
+            error = r.status_code
+        except (requests.ConnectionError, requests.Timeout) as e:
+            r = None
+            error = e
+        delay = retry_delay(attempt)
+        if delay is not None:
+            logger.info("Retrying %s %s in %.2fs after: %s", method, url,
+                        delay, error)
+            time.sleep(delay)
+        left = remaining_time()
+        if delay is None or (left is not None and left <= 0):
+            if r is None:
+                raise error
+            return r
+
+
+def send_authenticated(method, url, params, data, headers, kind):
+    if auth.is_active():
+        headers['X-Auth-Token'] = auth.get_token(False)
+    r = send(method, url, params, data, headers, kind)
+    if r.status_code == 401 and auth.is_active():
+        headers['X-Auth-Token'] = auth.get_token(True)
+        r = send(method, url, params, data, headers, kind)
+    return r
+
+
+def get(url, params=None, headers=None, kind='search'):
+    return request('GET', url, params=params, headers=headers, kind=kind)
+
+
+def post(url, params=None, data=None, headers=None, kind='views'):
+    return request('POST', url, params=params, data=data, headers=headers,
+                   kind=kind)
@@ -0,0 +1,203 @@
+import logging
+import threading
+import time
+
+from blueflood_graphite_finder import lifecycle, scheduler, transport
+from blueflood_graphite_finder.breaker import RateLimiter
+
+try:
+    from graphite_api.storage import FindQuery
+except ImportError:
+    from graphite.storage import FindQuery
+
+logger = logging.getLogger('blueflood_finder')
+
+
+class Target(object):
+    """
+    Something to keep warm: the nodes matching "pattern" and, with a
+    "window", the datapoints of its leaves over the last "window" seconds.
+    "tenant" is only set for the tenants of multi_tenant: header.
+    """
+    __slots__ = ('pattern', 'window', 'tenant')
+
+    def __init__(self, pattern, window=None, tenant=None):
+        self.pattern = pattern
+        self.window = window
+        self.tenant = tenant
+
+    def key(self):
+        return (self.tenant, self.pattern, self.window)
+
+    def __repr__(self):
+        return 'Target(%r, %r, %r)' % self.key()
+
+
+def parse_target(spec):
+    # A configured target: a find pattern, or a dict with "target" and
+    # optionally "window" and "tenant"
+    if isinstance(spec, basestring):
+        return Target(spec)
+    return Target(spec['target'], spec.get('window'), spec.get('tenant'))
+
+
+class CacheWarmer(object):
+    """
+    Runs the finds and fetches of the configured targets every "interval"
+    seconds, plus those of the "learn" targets most used lately, so the
+    caches are hot when the dashboards that need them are opened.
+
+    Its requests to Blueflood go at most "rate" a second, in the
+    "priority" class of the scheduler, and targets are skipped while every
+    render slot is taken.  What it warms goes to the finder's shared
+    cache, whose entries are kept at least one "interval", and each target
+    is warmed by one worker a round.  The thread is only started once the
+    finder is used, so the master of a pre-fork server doesn't warm
+    anything.
+    """
+
+    def __init__(self, finder, targets=(), interval=60, rate=1, burst=None,
+                 learn=0, learn_size=1000, decay=0.5, min_hits=2,
+                 max_nodes=1000, priority='background'):
+        cache = finder.shared_cache
+        if cache is None:
+            # renders don't see what a warmer fetches without one
+            raise ValueError("cache_warmer needs a shared_cache")
+        # warmed entries last until the next round
+        cache.find_ttl = max(cache.find_ttl, interval)
+        cache.fetch_ttl = max(cache.fetch_ttl, interval)
+        self.finder = finder
+        self.targets = [parse_target(t) for t in targets]
+        self.interval = interval
+        self.limiter = RateLimiter(rate, burst)
+        self.learn = learn
+        self.learn_size = learn_size
+        self.decay = decay
+        self.min_hits = min_hits
+        self.max_nodes = max_nodes
+        self.priority = priority
+        self.lock = threading.Lock()
+        # hits of the targets seen in traffic, decayed every round
+        self.seen = {}
+        self.thread = None
+        self.stopped = threading.Event()
+        self.rounds = 0
+        self.warmed = 0
+        self.skipped = 0
+        self.errors = 0
+        lifecycle.register_object(self)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='blueflood-warmer')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def after_fork(self):
+        # Started again once the new process uses the finder
+        self.lock = threading.Lock()
+        self.limiter.after_fork()
+        self.thread = None
+
+    def observe(self, query, tenant=None):
+        """
+        Notes a find_nodes query of a render ending about now: the
+        dashboards of tomorrow are those of today.
+        """
+        if not self.learn or query.startTime is None or \
+                query.endTime is None or query.endTime < time.time() - 300:
+            return
+        # renders a few seconds apart are the same target
+        window = int(round((query.endTime - query.startTime) / 60.0)) * 60
+        key = (tenant, query.pattern, window or None)
+        with self.lock:
+            if key in self.seen or len(self.seen) < self.learn_size:
+                self.seen[key] = self.seen.get(key, 0) + 1
+
+    def learned(self):
+        # The "learn" targets with the most hits, decaying the hits of all
+        with self.lock:
+            top = sorted((hits, key) for key, hits in self.seen.items()
+                         if hits >= self.min_hits)
+            for key, hits in self.seen.items():
+                hits *= self.decay
+                if hits < 1:
+                    del self.seen[key]
+                else:
+                    self.seen[key] = hits
+        return [Target(p, w, t) for _, (t, p, w) in top[-self.learn:]]
+
+    def current_targets(self):
+        targets = list(self.targets)
+        keys = set(t.key() for t in targets)
+        for t in self.learned():
+            if t.key() not in keys:
+                targets.append(t)
+        return targets
+
+    def run(self):
+        logger.debug("Cache warmer started")
+        while not self.stopped.wait(self.interval):
+            try:
+                self.warm()
+            except Exception:
+                logger.exception("Cache warming failed")
+
+    def warm(self):
+        # One round over the targets
+        self.rounds += 1
+        with transport.limited(self.limiter), \
+                scheduler.priority(self.priority):
+            for target in self.current_targets():
+                if self.stopped.is_set():
+                    return
+                if self.busy() or not self.claim(target):
+                    self.skipped += 1
+                    continue
+                try:
+                    self.warm_target(target)
+                    self.warmed += 1
+                except Exception as e:
+                    self.errors += 1
+                    logger.info("Can't warm %s: %s", target, e)
+
+    def busy(self):
+        # Renders come first
+        admission = self.finder.admission
+        return admission is not None and \
+            admission.active >= admission.max_active
+
+    def claim(self, target):
+        # Whoever claims a target first warms it
+        cache = self.finder.shared_cache
+        key = cache.key('warm', *target.key())
+        return cache.backend.add(key, '1', max(1, self.interval - 1))
+
+    def warm_target(self, target):
+        end = int(time.time())
+        start = end - (target.window or 0)
+        query = FindQuery(target.pattern, start, end)
+        finder = self.finder
+        if finder.multi_tenant == 'header':
+            finder = finder.for_tenant(target.tenant or finder.tenant)
+            nodes = finder.find_tenant_nodes(query)
+        else:
+            nodes = finder.find_query_nodes(query)
+        leaves = []
+        for node in nodes:
+            if node.is_leaf and len(leaves) < self.max_nodes:
+                leaves.append(node)
+        if target.window and leaves:
+            finder.fetch_multi(leaves, start, end)
+
+    def stats(self):
+        return {'rounds': self.rounds, 'warmed': self.warmed,
+                'skipped': self.skipped, 'errors': self.errors,
+                'learned': len(self.seen)}
@@ -0,0 +1,8 @@
+from blueflood_graphite_finder.blueflood import TenantBluefloodFinder
+
+
+def make_finder(**options):
+    # A finder of tenant "t" at http://dummy.com, with the given options
+    # of the "blueflood" section
+    options.update(urls=['http://dummy.com'], tenant='t')
+    return TenantBluefloodFinder({'blueflood': options})
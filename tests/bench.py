@@ -0,0 +1,386 @@
+"""
+Microbenchmarks for the finder's hot paths: series processing, grouping of
+multiplot requests, gen_dict, calc_res and the filtering done by
+find_nodes_with_submetrics, and what a big fetch costs the request's
+process with and without the process pool.  Inputs are synthetic and
+nothing is sent to Blueflood.
+
+    PYTHONPATH=. python tests/bench.py --save baseline.json
+    ... change things ...
+    PYTHONPATH=. python tests/bench.py --compare baseline.json --threshold 10
+
+With --compare the exit status is 1 if any benchmark got more than
+"threshold" percent slower than in the baseline.  --full adds the biggest
+inputs (up to a million points and 100k paths), which take a while, and
+--fixture runs more on a tenant written by generate_tenant.py.
+"""
+import argparse
+import gc
+import json
+import logging
+import platform
+import random
+import sys
+import time
+
+from blueflood_graphite_finder import codec, offload
+from blueflood_graphite_finder.blueflood import TenantBluefloodFinder, \
+    TenantBluefloodReader, TenantBluefloodLeafNode, calc_res
+from generate_tenant import load_names, load_series
+
+try:
+    from graphite_api.storage import FindQuery
+except ImportError:
+    from graphite.storage import FindQuery
+
+STEP = 60
+START = 1400000000
+ALIASES = {'_avg': 'average', '_sum': 'sum', '_enum': 'enum'}
+ENUMS = ['v%d' % i for i in range(8)]
+
+
+def make_finder(enable_submetrics=False):
+    # The finder's background thread only waits on its queue, it never
+    # talks to Blueflood unless asked to
+    return TenantBluefloodFinder({'blueflood': {
+        'urls': ['http://bench.invalid'],
+        'tenant': 'bench',
+        'enable_submetrics': enable_submetrics,
+        'submetric_aliases': ALIASES}})
+
+
+def metric_names(n_paths):
+    # Names of varying depth and length, a service, a host and a metric
+    return ['svc%d.host%d.metric_%s_%d' % (i % 20, i % 500,
+                                           'x' * (i % 30), i)
+            for i in xrange(n_paths)]
+
+
+def datapoints(n_points, mode='plain', gaps=0.05):
+    # BF datapoints a step apart with "gaps" of them left out, in the
+    # shape multiplot returns for plain, submetric and enum metrics
+    rnd = random.Random(n_points)
+    points = []
+    for i in xrange(n_points):
+        if rnd.random() < gaps:
+            continue
+        point = {'timestamp': (START + i * STEP) * 1000, 'numPoints': 1}
+        if mode == 'enum':
+            point['enum_values'] = dict((e, rnd.randint(0, 100))
+                                        for e in ENUMS[:3])
+        else:
+            point['average'] = rnd.random() * 100
+            point['sum'] = rnd.randint(0, 1000)
+        points.append(point)
+    return points
+
+
+def leaf(finder, path, metric=None, enum_value=None):
+    return TenantBluefloodLeafNode(path, TenantBluefloodReader(
+        metric or path, finder.tenant, finder.bf_query_endpoint,
+        finder.enable_submetrics, finder.submetric_aliases, enum_value))
+
+
+def bench_process_path(n_points):
+    client = make_finder().client
+    values = datapoints(n_points)
+    data_key = client.gen_data_key(values)
+    end = START + n_points * STEP
+
+    def run():
+        client.process_path(values, START, end, STEP, data_key)
+    return run
+
+
+def bench_gen_groups(names):
+    finder = make_finder()
+    nodes = [leaf(finder, name) for name in names]
+
+    def run():
+        finder.client.gen_groups(nodes)
+    return run
+
+
+def bench_gen_dict(n_paths, n_points, mode='plain'):
+    finder = make_finder(mode == 'submetrics')
+    names = metric_names(n_paths)
+    if mode == 'enum':
+        nodes = [leaf(finder, name + '.' + ENUMS[i % 3], name,
+                      ENUMS[i % 3]) for i, name in enumerate(names)]
+    elif mode == 'submetrics':
+        nodes = [leaf(finder, name + '._avg', name) for name in names]
+    else:
+        nodes = [leaf(finder, name) for name in names]
+    points = datapoints(n_points, 'enum' if mode == 'enum' else 'plain')
+    responses = [{'metric': name, 'data': points} for name in names]
+    end = START + n_points * STEP
+
+    def run():
+        finder.client.gen_dict(nodes, responses, START, end, STEP)
+    return run
+
+
+def process_cpu():
+    # CPU seconds used by this process, all of its threads included
+    return time.clock()
+
+
+def bench_offload(n_paths, n_points, pool):
+    # What decoding the multiplot responses of a big fetch and turning them
+    # into series costs the request's process, done inline or by the
+    # process pool.  Timed in CPU seconds of this process, so the pool's
+    # work doesn't count.
+    finder = make_finder()
+    client = finder.client
+    nodes = [leaf(finder, name) for name in metric_names(n_paths)]
+    points = datapoints(n_points)
+    size = client.maxmetrics_per_req
+    bodies = []
+    for i in xrange(0, n_paths, size):
+        group = nodes[i:i + size]
+        bodies.append((group, codec.dumps({'metrics': [
+            {'metric': n.path, 'data': points} for n in group]})))
+    end = START + n_points * STEP
+    if pool:
+        offload.configure(4, 1)
+
+        def run():
+            offload.process_responses(client, bodies, START, end, STEP,
+                                      False)
+    else:
+        def run():
+            for group, body in bodies:
+                client.gen_dict(group, codec.loads(body)['metrics'], START,
+                                end + STEP, STEP)
+    run.clock = process_cpu
+    return run
+
+
+def bench_calc_res(n_calls):
+    rnd = random.Random(n_calls)
+    ranges = []
+    for _ in xrange(n_calls):
+        length = rnd.randint(60, 86400 * 365)
+        ranges.append((START, START + length, rnd.choice([None, 800])))
+
+    def run():
+        for start, end, max_points in ranges:
+            calc_res(start, end, max_points)
+    return run
+
+
+def bench_fixture_dict(names, series):
+    # gen_dict on the series of a fixture, with a node for each enum value
+    finder = make_finder()
+    nodes = []
+    for response in series:
+        metric = response['metric']
+        for e in names[metric] or [None]:
+            if e is None:
+                nodes.append(leaf(finder, metric))
+            else:
+                nodes.append(leaf(finder, metric + '.' + e, metric, e))
+    times = [p['timestamp'] / 1000 for r in series for p in r['data']]
+    start = min(times)
+    end = max(times) + STEP
+
+    def run():
+        finder.client.gen_dict(nodes, series, start, end, STEP)
+    return run
+
+
+def canned_result(n_paths):
+    names = metric_names(n_paths)
+    # a tenth are longer than the query asks for, so they become branches
+    return dict((name + ('.deeper' if i % 10 == 0 else ''), ENUMS)
+                for i, name in enumerate(names))
+
+
+def bench_submetrics_filter(result, query):
+    # find_nodes_with_submetrics on a canned search result, so only the
+    # filtering and node building are measured
+    finder = make_finder(True)
+    finder.find_metrics_with_enum_values = lambda pattern: result
+    find_query = FindQuery(query, START, START + 3600)
+
+    def run():
+        list(finder.find_nodes_with_submetrics(find_query))
+    return run
+
+
+def benchmarks(full):
+    # (name, function making the callable to time)
+    points = [10000, 100000] + ([1000000] if full else [])
+    paths = [100, 10000] + ([100000] if full else [])
+    cases = []
+    for n in points:
+        cases.append(('process_path[points=%d]' % n,
+                      lambda n=n: bench_process_path(n)))
+    for n in paths:
+        cases.append(('gen_groups[paths=%d]' % n,
+                      lambda n=n: bench_gen_groups(metric_names(n))))
+    # the same number of points in total, spread over more or fewer paths
+    dict_sizes = [(100, 1000), (10000, 10)] + \
+        ([(100000, 10), (1000, 1000)] if full else [])
+    for mode in ('plain', 'submetrics', 'enum'):
+        for n_paths, n_points in dict_sizes:
+            cases.append(('gen_dict[%s,paths=%d,points=%d]'
+                          % (mode, n_paths, n_points),
+                          lambda a=n_paths, b=n_points, m=mode:
+                          bench_gen_dict(a, b, m)))
+    for pool in (False, True):
+        cases.append(('offload[%s,paths=200,points=1440]'
+                      % ('pool' if pool else 'inline'),
+                      lambda p=pool: bench_offload(200, 1440, p)))
+    cases.append(('calc_res[calls=10000]', lambda: bench_calc_res(10000)))
+    for n in paths:
+        for label, query in (('list', 'svc*.*.*.*'),
+                             ('alias', 'svc*.*.*._avg'),
+                             ('branch', 'svc*.*'),
+                             ('enum', 'svc1.*.*.v*._enum')):
+            cases.append(('submetrics_filter[%s,paths=%d]' % (label, n),
+                          lambda n=n, q=query:
+                          bench_submetrics_filter(canned_result(n), q)))
+    return cases
+
+
+def fixture_benchmarks(path, max_series):
+    # Benchmarks on a tenant written by generate_tenant.py
+    names = load_names(path)
+    depth = len(next(iter(names)).split('.'))
+    series = list(load_series(path, max_series))
+    label = 'paths=%d' % len(names)
+    cases = [('gen_groups[fixture,%s]' % label,
+              lambda: bench_gen_groups(list(names))),
+             ('gen_dict[fixture,paths=%d]' % len(series),
+              lambda: bench_fixture_dict(names, series))]
+    # enum searches only find enum metrics
+    enums = dict((name, e) for name, e in names.items() if e)
+    for kind, query, result in (
+            ('list', ['*'] * (depth + 1), names),
+            ('alias', ['*'] * depth + ['_avg'], names),
+            ('branch', ['*'] * 2, names),
+            ('enum', ['*'] * (depth + 1) + ['_enum'], enums)):
+        cases.append(('submetrics_filter[fixture,%s,%s]' % (kind, label),
+                      lambda q='.'.join(query), r=result:
+                      bench_submetrics_filter(r, q)))
+    return cases
+
+
+def timed(run, calls, clock=time.time):
+    start = clock()
+    for _ in xrange(calls):
+        run()
+    return clock() - start
+
+
+def measure(run, repeat, min_time):
+    # Best and median of "repeat" timings, each averaged over enough calls
+    # to take "min_time" seconds.  Timed with the run's "clock", if it
+    # has one.
+    calls = 1
+    elapsed = timed(run, calls)
+    while elapsed < min_time and calls < 1000:
+        calls = min(1000, max(calls * 2,
+                              int(calls * min_time / max(elapsed, 1e-6))))
+        elapsed = timed(run, calls)
+    # the calibration runs only warm things up
+    timings = []
+    clock = getattr(run, 'clock', time.time)
+    # collections of earlier garbage shouldn't be charged to this one
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in xrange(repeat):
+            timings.append(timed(run, calls, clock) / calls)
+    finally:
+        gc.enable()
+    timings.sort()
+    return timings[0], timings[len(timings) // 2]
+
+
+def run_benchmarks(cases, repeat, min_time):
+    results = {}
+    for name, setup in cases:
+        run = setup()
+        best, median = measure(run, repeat, min_time)
+        results[name] = {'best': best, 'median': median}
+        print "%-50s %10.3f ms %10.3f ms" % (
+            name, best * 1000, median * 1000)
+        sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Prints the change of each benchmark against the baseline and returns
+    # the names of those more than "threshold" percent slower
+    regressions = []
+    print
+    print "%-50s %10s %10s %8s" % ('benchmark', 'base ms', 'now ms',
+                                   'change')
+    for name in sorted(results):
+        now = results[name]['best']
+        if name not in baseline:
+            print "%-50s %10s %10.3f %8s" % (name, '-', now * 1000, 'new')
+            continue
+        base = baseline[name]['best']
+        change = (now - base) / base * 100 if base else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print "%-50s %10.3f %10.3f %+7.1f%%%s" % (name, base * 1000,
+                                                  now * 1000, change, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the finder hot paths')
+    parser.add_argument('--full', action='store_true',
+                        help='include the biggest inputs')
+    parser.add_argument('--fixture', help='also run benchmarks on a tenant '
+                                          'written by generate_tenant.py')
+    parser.add_argument('--fixture-series', type=int, default=10000,
+                        help='series of the fixture to give gen_dict')
+    parser.add_argument('--only', help='only run benchmarks whose name '
+                                       'contains this')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timings per benchmark, the best one counts')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds each timing should last at least')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline file to compare with')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='percent slower than the baseline that fails '
+                             '--compare')
+    args = parser.parse_args()
+
+    logging.getLogger('blueflood_finder').setLevel(logging.WARNING)
+    cases = benchmarks(args.full)
+    if args.fixture:
+        cases += fixture_benchmarks(args.fixture, args.fixture_series)
+    if args.only:
+        cases = [(name, setup) for name, setup in cases
+                 if args.only in name]
+    print "%-50s %13s %13s" % ('benchmark', 'best', 'median')
+    results = run_benchmarks(cases, args.repeat, args.min_time)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'machine': platform.node(),
+                       'time': int(time.time()),
+                       'benchmarks': results}, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['benchmarks']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print "%d benchmarks regressed more than %g%%" % (
+                len(regressions), args.threshold)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""
+Makes up a tenant big enough to show how the finder scales: a tree of
+metric names of the given depth and fan-out, some of them enums, with a
+series of datapoints for each.  Everything is derived from --seed, so the
+same arguments always give the same tenant.
+
+The tenant is either ingested into a local Blueflood:
+
+    PYTHONPATH=. python tests/generate_tenant.py --depth 4 --fanout 30 \\
+        --ingest http://localhost:19000 --tenant 836986
+
+or written as fixture files that benchmarks load without a Blueflood:
+
+    PYTHONPATH=. python tests/generate_tenant.py --depth 4 --fanout 30 \\
+        --out /tmp/tenant
+    PYTHONPATH=. python tests/bench.py --fixture /tmp/tenant
+
+A fixture directory has "names.txt", one metric a line followed by its
+enum values if it has any, and "series.jsonl", one multiplot answer
+({"metric": ..., "data": [...]}) a line with the rollups of each metric.
+
+--skew makes some branches much bigger than others, as they are in real
+tenants: the number of children of each branch follows a Pareto
+distribution averaging --fanout, heavier tailed the closer skew is to 1.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+
+import requests
+
+# Names given to the components at each depth, the last one to leaves
+LEVELS = ['app', 'dc', 'cluster', 'host', 'service', 'instance']
+LEAVES = ['requests', 'latency', 'errors', 'cpu', 'memory', 'queue_depth',
+          'connections', 'bytes_in', 'bytes_out', 'gc_time']
+TTL = 172800
+
+
+def children(rnd, fanout, skew):
+    # How many children a branch has
+    if not skew:
+        return fanout
+    # a Pareto variate with shape 1/skew averages 1/(1 - skew)
+    n = fanout * (1 - skew) * rnd.paretovariate(1 / skew)
+    return max(1, min(int(round(n)), fanout * 100))
+
+
+def component(depth, i, leaf):
+    if leaf:
+        return '%s_%d' % (LEAVES[i % len(LEAVES)], i // len(LEAVES))
+    return '%s%02d' % (LEVELS[depth % len(LEVELS)], i)
+
+
+def metric_names(depth, fanout, skew=0, seed=0, limit=None):
+    """
+    Generates the names of the metrics of a tree "depth" components deep,
+    depth first and without building the tree, so millions are fine.
+    """
+    rnd = random.Random(seed)
+    names = _subtree('', 0, depth, fanout, skew, rnd)
+    return itertools.islice(names, limit) if limit else names
+
+
+def _subtree(prefix, level, depth, fanout, skew, rnd):
+    leaf = level == depth - 1
+    for i in xrange(children(rnd, fanout, skew)):
+        name = prefix + component(level, i, leaf)
+        if leaf:
+            yield name
+        else:
+            for n in _subtree(name + '.', level + 1, depth, fanout, skew,
+                              rnd):
+                yield n
+
+
+def enum_values(rnd, enum_fraction, max_enums):
+    # The enum values of a metric, or None for a numeric one
+    if rnd.random() >= enum_fraction:
+        return None
+    return ['ev%d' % i for i in xrange(rnd.randint(2, max_enums))]
+
+
+def tenant(depth, fanout, skew=0, enum_fraction=0, max_enums=5, seed=0,
+           limit=None):
+    # Generates (name, enum values or None) for each metric of the tenant
+    rnd = random.Random(seed + 1)
+    for name in metric_names(depth, fanout, skew, seed, limit):
+        yield name, enum_values(rnd, enum_fraction, max_enums)
+
+
+def raw_values(rnd, points):
+    # A random walk, the kind of thing gauges do
+    value = rnd.uniform(0, 100)
+    for _ in xrange(points):
+        value = max(0, value + rnd.gauss(0, 5))
+        yield value
+
+
+def rollups(name, enums, points, step, end, gaps=0.02):
+    """
+    The datapoints of a metric as multiplot returns them at a "step"
+    seconds resolution, with "gaps" of them missing: every rollup of
+    numbers (average, min, max, sum, latest, numPoints) or the counts of
+    the enum values.
+    """
+    rnd = random.Random(name)
+    per_point = max(1, step // 60)
+    start = end - end % step - points * step
+    data = []
+    for i, value in enumerate(raw_values(rnd, points)):
+        if rnd.random() < gaps:
+            continue
+        point = {'timestamp': (start + i * step) * 1000,
+                 'numPoints': per_point}
+        if enums:
+            point['enum_values'] = dict(
+                (e, rnd.randint(0, per_point)) for e in enums)
+        else:
+            spread = rnd.uniform(0, value / 10 + 1)
+            rollup = {'average': value, 'min': max(0, value - spread),
+                      'max': value + spread, 'sum': value * per_point,
+                      'latest': value + rnd.uniform(-spread, spread)}
+            # with the few digits real gauges have
+            for k, v in rollup.items():
+                point[k] = round(v, 3)
+        data.append(point)
+    return data
+
+
+def write_fixture(out, metrics, points, step, end):
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    count = 0
+    with open(os.path.join(out, 'names.txt'), 'w') as names, \
+            open(os.path.join(out, 'series.jsonl'), 'w') as series:
+        for name, enums in metrics:
+            names.write('\t'.join([name] + (enums or [])) + '\n')
+            if points:
+                series.write(json.dumps(
+                    {'metric': name, 'data': rollups(name, enums, points,
+                                                     step, end)},
+                    separators=(',', ':')) + '\n')
+            count += 1
+    return count
+
+
+def load_names(path):
+    """
+    The metrics of a fixture directory as find_metrics_with_enum_values
+    returns them: a dict of name to enum values or None.
+    """
+    metrics = {}
+    with open(os.path.join(path, 'names.txt')) as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            metrics[parts[0]] = parts[1:] or None
+    return metrics
+
+
+def load_series(path, limit=None):
+    # Generates the multiplot answers of a fixture directory
+    from blueflood_graphite_finder import codec
+    with open(os.path.join(path, 'series.jsonl')) as f:
+        for line in itertools.islice(f, limit):
+            yield codec.loads(line)
+
+
+def post(url, payload):
+    r = requests.post(url, data=json.dumps(payload))
+    if r.status_code != 200:
+        raise Exception("Ingestion to [%s] failed with status [%s]: %s"
+                        % (url, r.status_code, r.text[:200]))
+
+
+def ingest(url, tenant_id, metrics, points, step, end, batch_size=1000):
+    """
+    Sends the raw datapoints of the metrics to Blueflood's ingestion
+    endpoints, "batch_size" at a time; Blueflood computes the rollups.
+    """
+    ingest_url = '%s/v2.0/%s/ingest/multi' % (url, tenant_id)
+    enum_url = '%s/v2.0/%s/ingest/aggregated/multi' % (url, tenant_id)
+    start = (end - points * step) * 1000
+    batch = []
+    enum_batch = []
+    count = 0
+    for name, enums in metrics:
+        rnd = random.Random(name)
+        for i, value in enumerate(raw_values(rnd, max(1, points))):
+            ts = start + i * step * 1000
+            if enums:
+                enum_batch.append({
+                    'tenantId': tenant_id,
+                    'timestamp': ts,
+                    'enums': [{'name': name, 'value': rnd.choice(enums)}]})
+            else:
+                batch.append({'tenantId': tenant_id,
+                              'collectionTime': ts,
+                              'ttlInSeconds': TTL,
+                              'metricValue': value,
+                              'metricName': name})
+        if len(batch) >= batch_size:
+            post(ingest_url, batch)
+            batch = []
+        if len(enum_batch) >= batch_size:
+            post(enum_url, enum_batch)
+            enum_batch = []
+        count += 1
+        if count % 10000 == 0:
+            print "%d metrics ingested" % count
+    if batch:
+        post(ingest_url, batch)
+    if enum_batch:
+        post(enum_url, enum_batch)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic Blueflood tenant')
+    parser.add_argument('--depth', type=int, default=4,
+                        help='components in each metric name')
+    parser.add_argument('--fanout', type=int, default=10,
+                        help='average children of each branch')
+    parser.add_argument('--skew', type=float, default=0,
+                        help='0 for even branches, up to 1 (excluded) for '
+                             'very uneven ones')
+    parser.add_argument('--enum-fraction', type=float, default=0.05,
+                        help='share of the metrics that are enums')
+    parser.add_argument('--max-enums', type=int, default=5,
+                        help='most enum values an enum metric has')
+    parser.add_argument('--limit', type=int,
+                        help='stop after this many metrics')
+    parser.add_argument('--points', type=int, default=60,
+                        help='datapoints in each series, 0 for names only')
+    parser.add_argument('--step', type=int, default=60,
+                        help='seconds between datapoints')
+    parser.add_argument('--end', type=int,
+                        help='epoch of the last datapoint, now by default')
+    parser.add_argument('--seed', type=int, default=0)
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument('--out', help='fixture directory to write')
+    output.add_argument('--ingest',
+                        help='Blueflood ingestion URL, like '
+                             'http://localhost:19000')
+    parser.add_argument('--tenant', default='836986')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='datapoints per ingestion request')
+    args = parser.parse_args()
+
+    if not 0 <= args.skew < 1:
+        parser.error('--skew must be at least 0 and less than 1')
+    metrics = tenant(args.depth, args.fanout, args.skew, args.enum_fraction,
+                     args.max_enums, args.seed, args.limit)
+    end = args.end or int(time.time())
+    started = time.time()
+    if args.out:
+        count = write_fixture(args.out, metrics, args.points, args.step, end)
+        print "Wrote %d metrics to %s" % (count, args.out)
+    else:
+        count = ingest(args.ingest, args.tenant, metrics, args.points,
+                       args.step, end, args.batch_size)
+        print "Ingested %d metrics into tenant %s" % (count, args.tenant)
+    print "in %.1fs" % (time.time() - started)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+"""
+Replays a log of graphite-api requests against TenantBluefloodFinder and
+reports how long they took and what they cost Blueflood.
+
+The log can be any text file with one request per line, like an access
+log: every "/metrics/find?..." and "/render?..." URL found in it is
+replayed.  Lines can also be JSON objects with the "url" and the
+"headers" of a request.  Finds call find_nodes(query), renders find the
+nodes of each target and fetch them all with one fetch_multi, as
+graphite-api does, inside a request context with the logged parameters
+and headers (maxDataPoints, tenant and priority headers...).
+
+    PYTHONPATH=. python tests/replay.py access.log \\
+        --url http://blueflood:20000 \\
+        --tenant 836986 --concurrency 8 --rate 20
+
+With --fake, requests go to a local stand-in for Blueflood that makes up
+metric names and datapoints, so only the finder's own cost is measured.
+"""
+import BaseHTTPServer
+import Queue
+import SocketServer
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import urlparse
+
+import flask
+
+from blueflood_graphite_finder import slowlog
+from blueflood_graphite_finder.batching import glob_to_regex
+from blueflood_graphite_finder.blueflood import TenantBluefloodFinder
+
+try:
+    from graphite_api.storage import FindQuery
+except ImportError:
+    from graphite.storage import FindQuery
+
+REQUEST_RE = re.compile(r'(/metrics/find|/render)/?\?([^\s"]+)')
+# Metric patterns inside a render target: anything with a dot that isn't
+# a number or a quoted string
+COMPONENT = r'(?:[\w\-*?\[\]]|\{[^}]*\})+'
+PATTERN_RE = re.compile(
+    r'''(?<!['"\w])(%s(?:\.%s)+)''' % (COMPONENT, COMPONENT))
+UNITS = {'s': 1, 'min': 60, 'h': 3600, 'd': 86400, 'w': 604800,
+         'mon': 2592000, 'y': 31536000}
+
+
+def parse_time(value, now):
+    # Understands the graphite from/until forms replayed logs usually have:
+    # "now", epoch seconds and relative times like "-6h"
+    if value is None or value == 'now':
+        return now
+    if value.isdigit():
+        return int(value)
+    m = re.match(r'^-(\d+)([a-z]+)$', value)
+    if m and m.group(2) in UNITS:
+        return now - int(m.group(1)) * UNITS[m.group(2)]
+    raise ValueError("Can't replay time %r" % value)
+
+
+def target_patterns(target):
+    return [p for p in PATTERN_RE.findall(target)
+            if not re.match(r'^[\d.]+$', p)]
+
+
+def read_log(path):
+    # Returns (kind, params, headers) for each request found in the log
+    requests = []
+    with open(path) as f:
+        for line in f:
+            headers = {}
+            if line.startswith('{'):
+                logged = json.loads(line)
+                line = logged.get('url', '')
+                headers = logged.get('headers') or {}
+            m = REQUEST_RE.search(line)
+            if m is None:
+                continue
+            kind = 'find' if m.group(1) == '/metrics/find' else 'render'
+            requests.append((kind, urlparse.parse_qs(m.group(2)), headers))
+    return requests
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.requests = {}
+        self.bytes = {}
+
+    def record(self, kind, latency, requests, size, error):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(latency)
+            if error:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+            self.requests[kind] = self.requests.get(kind, 0) + requests
+            self.bytes[kind] = self.bytes.get(kind, 0) + size
+
+    def report(self, elapsed):
+        print "%-13s %6s %6s %8s %8s %8s %8s %8s %8s %10s" % (
+            'call', 'count', 'errors', 'per sec', 'p50 ms', 'p90 ms',
+            'p99 ms', 'max ms', 'bf reqs', 'bf bytes')
+        for kind in sorted(self.latencies):
+            latencies = sorted(self.latencies[kind])
+
+            def pct(p):
+                return latencies[min(len(latencies) - 1,
+                                     int(p * len(latencies)))] * 1000
+            print "%-13s %6d %6d %8.1f %8.1f %8.1f %8.1f %8.1f %8d %10d" % (
+                kind, len(latencies), self.errors.get(kind, 0),
+                len(latencies) / elapsed, pct(0.5), pct(0.9), pct(0.99),
+                latencies[-1] * 1000, self.requests[kind], self.bytes[kind])
+
+
+class Measured(object):
+    # Calls made for one replayed request
+    def __init__(self, stats):
+        self.stats = stats
+        self.requests = 0
+        self.bytes = 0
+        self.error = False
+
+    def call(self, kind, f, *args):
+        # Calls f, recording its time and the Blueflood requests it made
+        query = slowlog.Query(kind)
+        error = False
+        start = time.time()
+        try:
+            with slowlog.active(query):
+                return f(*args)
+        except Exception as e:
+            print "%s failed: %s" % (kind, e)
+            error = self.error = True
+        finally:
+            self.stats.record(kind, time.time() - start, query.requests,
+                              query.bytes, error)
+            self.requests += query.requests
+            self.bytes += query.bytes
+
+
+def replay_find(finder, measured, params, now):
+    query = FindQuery(params['query'][0],
+                      parse_time(params.get('from', [None])[0], now),
+                      parse_time(params.get('until', [None])[0], now))
+    measured.call('find_nodes', lambda: list(finder.find_nodes(query)))
+
+
+def replay_render(finder, measured, params, now):
+    start = parse_time(params.get('from', ['-1d'])[0], now)
+    end = parse_time(params.get('until', [None])[0], now)
+    patterns = [p for t in params.get('target', [])
+                for p in target_patterns(t)]
+
+    def find_all():
+        nodes = []
+        for p in patterns:
+            nodes.extend(n for n in finder.find_nodes(FindQuery(p, start, end))
+                         if n.is_leaf)
+        return nodes
+    nodes = measured.call('find_nodes', find_all)
+    if nodes:
+        measured.call('fetch_multi', finder.fetch_multi, nodes, start, end)
+
+
+def worker(finder, app, stats, work, now):
+    while True:
+        item = work.get()
+        if item is None:
+            return
+        kind, params, headers, queued = item
+        measured = Measured(stats)
+        try:
+            # what the finder reads of the request it serves
+            with app.test_request_context(query_string=params,
+                                          headers=headers):
+                if kind == 'find':
+                    replay_find(finder, measured, params, now)
+                else:
+                    replay_render(finder, measured, params, now)
+        except Exception as e:
+            print "can't replay %s %s: %s" % (kind, params, e)
+            measured.error = True
+        # the whole request, time spent waiting for a thread included
+        stats.record(kind, time.time() - queued, measured.requests,
+                     measured.bytes, measured.error)
+
+
+def replay(finder, requests, concurrency, rate, now, headers=None):
+    # Feeds the requests to "concurrency" threads, with Poisson arrivals
+    # averaging "rate" a second, or as fast as they are taken if no rate.
+    # "headers" are added to those of every request.
+    stats = Stats()
+    app = flask.Flask('replay')
+    work = Queue.Queue(concurrency if rate is None else 0)
+    threads = [threading.Thread(target=worker,
+                                args=(finder, app, stats, work, now))
+               for _ in range(concurrency)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    start = time.time()
+    for kind, params, logged in requests:
+        if rate:
+            time.sleep(random.expovariate(rate))
+        request_headers = dict(headers or {})
+        request_headers.update(logged)
+        work.put((kind, params, request_headers, time.time()))
+    for t in threads:
+        work.put(None)
+    for t in threads:
+        t.join()
+    return stats, time.time() - start
+
+
+class FakeBlueflood(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers searches with made-up names: every glob component matches
+    "fanout" names, and names at "leaf_depth" components are leaves.
+    Multiplot answers have a datapoint every step for every metric.
+    """
+    fanout = 5
+    leaf_depth = 4
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body):
+        body = json.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def expand(self, component):
+        if not any(c in component for c in '*?[{'):
+            return [component]
+        names = []
+        for i in range(self.fanout):
+            name = re.sub(r'\{([^,}]*)[^}]*\}', r'\1', component)
+            name = re.sub(r'\[!?(.)[^\]]*\]', r'\1', name)
+            name = name.replace('*', str(i), 1).replace('*', '')
+            names.append(name.replace('?', 'x'))
+        regex = glob_to_regex(component)
+        return sorted(set(n for n in names if regex.match(n)))
+
+    def names(self, pattern):
+        names = ['']
+        for part in pattern.split('.'):
+            names = [(n + '.' + c).lstrip('.') for n in names
+                     for c in self.expand(part)]
+        return names
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        params = urlparse.parse_qs(url.query)
+        pattern = params.get('query', [''])[0]
+        if url.path.endswith('/metric_name/search'):
+            leaf = len(pattern.split('.')) >= self.leaf_depth
+            self.reply([{n: leaf} for n in self.names(pattern)])
+        elif url.path.endswith('/metrics/search'):
+            self.reply([{'metric': n} for n in self.names(pattern)])
+        elif url.path.endswith('/getEvents'):
+            self.reply([])
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlparse.urlsplit(self.path)
+        params = urlparse.parse_qs(url.query)
+        length = int(self.headers.getheader('Content-Length', 0))
+        metrics = json.loads(self.rfile.read(length))
+        start = int(params['from'][0]) / 1000
+        end = int(params['to'][0]) / 1000
+        step = {'FULL': 60, 'MIN5': 300, 'MIN20': 1200, 'MIN60': 3600,
+                'MIN240': 14400, 'MIN1440': 86400}[params['resolution'][0]]
+        data = [{'timestamp': ts * 1000, 'numPoints': 1,
+                 'average': random.random() * 100}
+                for ts in range(start - start % step, end, step)]
+        self.reply({'metrics': [{'metric': m, 'unit': 'unknown',
+                                 'type': 'number', 'data': data}
+                                for m in metrics]})
+
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_fake(fanout, leaf_depth):
+    FakeBlueflood.fanout = fanout
+    FakeBlueflood.leaf_depth = leaf_depth
+    server = ThreadedServer(('127.0.0.1', 0), FakeBlueflood)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay graphite-api requests against the finder')
+    parser.add_argument('log', help='file with the requests to replay')
+    parser.add_argument('--config', help='graphite-api YAML config to use')
+    parser.add_argument('--url', help='Blueflood query URL')
+    parser.add_argument('--tenant', default='836986')
+    parser.add_argument('--fake', action='store_true',
+                        help='use a local stand-in for Blueflood')
+    parser.add_argument('--fanout', type=int, default=5,
+                        help='names per glob component with --fake')
+    parser.add_argument('--leaf-depth', type=int, default=4,
+                        help='depth of the leaves with --fake')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float,
+                        help='requests a second, as fast as possible if '
+                             'not given')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='times to replay the log')
+    parser.add_argument('--now', type=int,
+                        help='epoch the relative times are relative to')
+    parser.add_argument('--header', action='append', default=[],
+                        help='"Name: value" header of every request, '
+                             'unless logged')
+    args = parser.parse_args()
+    headers = {}
+    for header in args.header:
+        name, _, value = header.partition(':')
+        headers[name.strip()] = value.strip()
+
+    config = {'blueflood': {}}
+    if args.config:
+        import yaml
+        with open(args.config) as f:
+            config = yaml.safe_load(f)
+    bf_config = config.setdefault('blueflood', {})
+    if args.fake:
+        bf_config['urls'] = [start_fake(args.fanout, args.leaf_depth)]
+    elif args.url:
+        bf_config['urls'] = [args.url]
+    bf_config.setdefault('tenant', args.tenant)
+    if not bf_config.get('urls'):
+        parser.error('one of --url, --fake or --config is needed')
+
+    requests = read_log(args.log) * args.repeat
+    print "Replaying %d requests against %s" % (len(requests),
+                                                bf_config['urls'][0])
+    finder = TenantBluefloodFinder(config)
+    stats, elapsed = replay(finder, requests, args.concurrency, args.rate,
+                            args.now or int(time.time()), headers)
+    print "%d requests in %.1fs" % (len(requests), elapsed)
+    stats.report(elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import json
+import threading
+import time
+from unittest import TestCase
+
+import requests_mock
+from graphite_api.storage import FindQuery
+
+from blueflood_graphite_finder.batching import Batcher, cover_patterns, \
+    glob_to_regex
+from blueflood_graphite_finder.blueflood import TenantBluefloodFinder, \
+    TenantBluefloodLeafNode, TenantBluefloodReader
+
+
+class TestGlobs(TestCase):
+    def test_glob_to_regex(self):
+        def match(pattern, name):
+            return glob_to_regex(pattern).match(name) is not None
+
+        self.assertTrue(match('a.*.c', 'a.bb.c'))
+        self.assertFalse(match('a.*', 'a.b.c'))
+        self.assertTrue(match('a.b?', 'a.bc'))
+        self.assertTrue(match('a.[bx]c', 'a.xc'))
+        self.assertFalse(match('a.[!bx]c', 'a.xc'))
+        self.assertTrue(match('a.{cpu,mem}.x', 'a.mem.x'))
+        self.assertFalse(match('a.{cpu,mem}.x', 'a.disk.x'))
+        self.assertTrue(match('a+b(c)', 'a+b(c)'))
+
+    def test_cover_patterns(self):
+        self.assertEqual(
+            cover_patterns(['app.prod.*.cpu', 'app.prod.*.mem',
+                            'app.dev.*.cpu', 'app.prod.*.cpu', 'x.y']),
+            [('app.prod.*.{cpu,mem}', ['app.prod.*.cpu', 'app.prod.*.mem']),
+             ('app.dev.*.cpu', ['app.dev.*.cpu']),
+             ('x.y', ['x.y'])])
+        self.assertEqual(cover_patterns(['a.b', 'a.c', 'a.d'], 2),
+                         [('a.{b,c}', ['a.b', 'a.c']), ('a.d', ['a.d'])])
+        # existing alternatives aren't nested
+        self.assertEqual(len(cover_patterns(['a.{b,c}', 'a.d'])), 2)
+
+
+class TestBatcher(TestCase):
+    def test_batches(self):
+        calls = []
+
+        def run(key, items):
+            calls.append((key, list(items)))
+            return [i * 2 for i in items]
+
+        batcher = Batcher(0.05, run)
+        results = {}
+
+        def submit(i):
+            results[i] = batcher.submit('k', i)
+
+        threads = [threading.Thread(target=submit, args=(i,))
+                   for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, {i: i * 2 for i in range(5)})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(calls[0][1]), range(5))
+
+        # a full batch doesn't wait for the window
+        batcher = Batcher(10, run, max_items=1)
+        start = time.time()
+        self.assertEqual(batcher.submit('k', 3), 6)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_errors(self):
+        def run(key, items):
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            Batcher(0, run).submit('k', 1)
+
+
+class TestFindBatching(TestCase):
+    def test_find_nodes_from_bf(self):
+        finder = TenantBluefloodFinder({'blueflood': {
+            'urls': ['http://dummy.com'],
+            'tenant': 'dummyTenant',
+            'find_batch_window': 0.1}})
+        endpoint = finder.find_nodes_endpoint(finder.bf_query_endpoint,
+                                              finder.tenant)
+        results = {}
+
+        def find(pattern):
+            results[pattern] = finder.find_nodes_from_bf(
+                FindQuery(pattern, 1, 2))
+
+        with requests_mock.mock() as m:
+            m.get(endpoint, json=[{'app.prod.h1.cpu': True},
+                                  {'app.prod.h1.mem': True},
+                                  {'app.prod.h2.cpu': True}])
+            threads = [threading.Thread(target=find, args=(p,))
+                       for p in ('app.prod.*.cpu', 'app.prod.*.mem')]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual(m.last_request.qs['query'],
+                             ['app.prod.*.{cpu,mem}'])
+        self.assertEqual(results['app.prod.*.cpu'],
+                         [{'app.prod.h1.cpu': True},
+                          {'app.prod.h2.cpu': True}])
+        self.assertEqual(results['app.prod.*.mem'],
+                         [{'app.prod.h1.mem': True}])
+
+
+class TestFetchBatching(TestCase):
+    def test_fetch_multi(self):
+        finder = TenantBluefloodFinder({'blueflood': {
+            'urls': ['http://dummy.com'],
+            'tenant': 'dummyTenant',
+            'fetch_batch_window': 0.1}})
+        client = finder.client
+        endpoint = client.get_multi_endpoint(finder.bf_query_endpoint,
+                                             finder.tenant)
+
+        def node(path):
+            return TenantBluefloodLeafNode(path, TenantBluefloodReader(
+                path, finder.tenant, finder.bf_query_endpoint, False, {},
+                None))
+
+        start = 1426120000
+        results = {}
+
+        def fetch(paths):
+            results[paths] = client.fetch_multi(
+                [node(p) for p in paths], start, start + 600)[1]
+
+        def json_callback(request, context):
+            return {'metrics': [
+                {'metric': m, 'data': [{'timestamp': start * 1000,
+                                        'numPoints': 1, 'average': 1}]}
+                for m in json.loads(request.text)]}
+
+        with requests_mock.mock() as m:
+            m.post(endpoint, json=json_callback)
+            threads = [threading.Thread(target=fetch, args=(paths,))
+                       for paths in (('a.b',), ('a.b', 'c.d'))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual(sorted(json.loads(m.last_request.text)),
+                             ['a.b', 'c.d'])
+        self.assertEqual(results[('a.b',)].keys(), ['a.b'])
+        self.assertEqual(sorted(results[('a.b', 'c.d')]), ['a.b', 'c.d'])
+        self.assertEqual(results[('a.b',)]['a.b'][0], 1)
@@ -38,6 +38,17 @@ class TestBlueFlood(TestCase):
     def test_resolution_14400min(self):
         self.assertEquals('MIN1440', bf.calc_res(0, 801 * 240 * 60))
 
+    def test_resolution_max_points(self):
+        # 6 hours at FULL is 360 points, MIN5 would only be 72
+        self.assertEquals('FULL', bf.calc_res(0, 6 * 3600, 300))
+        # 60 hours defaults to MIN5 (720 points), MIN20 still gives 180
+        self.assertEquals('MIN20', bf.calc_res(0, 60 * 3600, 150))
+        self.assertEquals('MIN60', bf.calc_res(0, 60 * 3600, 60))
+        self.assertEquals('MIN1440', bf.calc_res(0, 60 * 3600, 1))
+
+    def test_resolution_max_points_never_finer(self):
+        self.assertEquals('MIN5', bf.calc_res(0, 401 * 60, 100000))
+
     def test_find_metrics_endpoint(self):
         config = {'blueflood': {'urls': ['xxx']}}
 
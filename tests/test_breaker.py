@@ -0,0 +1,93 @@
+import threading
+import time
+from unittest import TestCase
+
+import requests_mock
+
+from blueflood_graphite_finder import transport
+from blueflood_graphite_finder.breaker import CircuitBreaker, \
+    AdmissionQueue, BluefloodUnavailable, BluefloodOverloaded
+
+
+class TestCircuitBreaker(TestCase):
+    def test_trips_and_recovers(self):
+        b = CircuitBreaker('test', window=4, min_requests=4, error_rate=0.5,
+                           slow_secs=1, open_secs=0.05)
+        for ok in (True, False, True, False):
+            b.allow()
+            b.record(ok, 0)
+        self.assertEqual(b.state, b.CLOSED)
+        b.allow()
+        # too slow counts as a failure
+        b.record(True, 2)
+        self.assertEqual(b.state, b.OPEN)
+        with self.assertRaises(BluefloodUnavailable):
+            b.allow()
+
+        time.sleep(0.06)
+        b.allow()
+        self.assertEqual(b.state, b.HALF_OPEN)
+        # only one probe at a time
+        with self.assertRaises(BluefloodUnavailable):
+            b.allow()
+        b.record(False, 0)
+        self.assertEqual(b.state, b.OPEN)
+
+        time.sleep(0.06)
+        b.allow()
+        b.record(True, 0)
+        self.assertEqual(b.state, b.CLOSED)
+        b.allow()
+
+    def test_transport(self):
+        transport.configure(new_breaker_options={
+            'window': 2, 'min_requests': 2, 'open_secs': 60},
+            new_max_retries=0)
+        url = 'http://dummybf.com/v2.0/t/views'
+        with requests_mock.mock() as m:
+            m.post(url, status_code=503)
+            # search has its own breaker
+            m.get('http://dummybf.com/v2.0/t/metric_name/search', json=[])
+            transport.post(url)
+            transport.post(url)
+            with self.assertRaises(BluefloodUnavailable):
+                transport.post(url)
+            self.assertEqual(m.call_count, 2)
+            transport.get('http://dummybf.com/v2.0/t/metric_name/search')
+        transport.configure()
+
+
+class TestAdmissionQueue(TestCase):
+    def test_sheds(self):
+        q = AdmissionQueue(1, max_waiting=1, wait_secs=0.5)
+        release = threading.Event()
+        results = []
+
+        def render():
+            try:
+                with q:
+                    release.wait()
+                results.append('ok')
+            except BluefloodOverloaded:
+                results.append('shed')
+
+        threads = [threading.Thread(target=render) for _ in range(2)]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        # one running, one waiting, the third is shed right away
+        render()
+        self.assertEqual(results, ['shed'])
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['shed', 'ok', 'ok'])
+
+    def test_wait_timeout(self):
+        q = AdmissionQueue(1, max_waiting=1, wait_secs=0.01)
+        with q:
+            with self.assertRaises(BluefloodOverloaded):
+                with q:
+                    pass
+        with q:
+            pass
@@ -0,0 +1,31 @@
+from unittest import TestCase
+
+import requests_mock
+import requests
+
+from blueflood_graphite_finder import codec
+
+
+class TestCodec(TestCase):
+    def tearDown(self):
+        codec.configure()
+
+    def test_codecs(self):
+        data = {'metrics': [{'metric': 'a/b.c', 'data': [
+            {'timestamp': 1426120000000, 'average': 64211.8},
+            {'timestamp': 1426120300000, 'average': 86434.02222222222}]}]}
+        for name, _ in codec.CODECS:
+            try:
+                codec.configure(name)
+            except ValueError:
+                continue
+            self.assertEqual(codec.name, name)
+            self.assertEqual(codec.loads(codec.dumps(data)), data)
+            with requests_mock.mock() as m:
+                m.get('http://dummy.com', json=data)
+                self.assertEqual(
+                    codec.decode(requests.get('http://dummy.com')), data)
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            codec.configure('nosuchjson')
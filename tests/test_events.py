@@ -0,0 +1,116 @@
+import time
+from unittest import TestCase
+
+import requests_mock
+
+import blueflood_graphite_finder.blueflood as bf
+from blueflood_graphite_finder import events as events_module
+from blueflood_graphite_finder.events import EventsCache, uncovered, \
+    merge_range
+
+
+class FrozenTime(object):
+    # Stands in for the time module so the cache sees a fixed "now"
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class TestEventsCache(TestCase):
+    def test_ranges(self):
+        self.assertEqual(uncovered([], 0, 10), [(0, 10)])
+        self.assertEqual(uncovered([(3, 5), (8, 9)], 0, 10),
+                         [(0, 2), (6, 7), (10, 10)])
+        self.assertEqual(uncovered([(0, 10)], 2, 5), [])
+        self.assertEqual(merge_range([(0, 5), (10, 20)], 6, 9), [(0, 20)])
+        self.assertEqual(merge_range([(0, 5), (10, 20)], 30, 40),
+                         [(0, 5), (10, 20), (30, 40)])
+
+    def setUp(self):
+        self.real_time = events_module.time
+
+    def tearDown(self):
+        events_module.time = self.real_time
+
+    def test_get(self):
+        now = int(time.time())
+        events_module.time = FrozenTime(now)
+        events = [{'when': now - 3000 + i * 200, 'what': 'deploy %d' % i,
+                   'tags': 'deploy'} for i in range(20)]
+        calls = []
+
+        def fetch(start, end):
+            calls.append((start, end))
+            return [e for e in events if start <= e['when'] <= end]
+
+        cache = EventsCache(settle=60)
+        self.assertEqual(cache.get('t', 'deploy', now - 3000, now - 1000,
+                                   fetch), events[:11])
+        self.assertEqual(cache.get('t', 'deploy', now - 2000, now - 500,
+                                   fetch), events[5:13])
+        self.assertEqual(calls, [(now - 3000, now - 1000),
+                                 (now - 999, now - 500)])
+        # fully covered, nothing fetched
+        cache.get('t', 'deploy', now - 2500, now - 600, fetch)
+        self.assertEqual(len(calls), 2)
+        # the most recent seconds are always fetched again
+        cache.get('t', 'deploy', now - 2500, now, fetch)
+        cache.get('t', 'deploy', now - 2500, now, fetch)
+        self.assertEqual(calls[2:], [(now - 499, now), (now - 59, now)])
+        # other tags and tenants are separate
+        cache.get('t', 'other', now - 2500, now - 600, fetch)
+        cache.get('t2', 'deploy', now - 2500, now - 600, fetch)
+        self.assertEqual(len(calls), 6)
+
+    def test_bounded(self):
+        cache = EventsCache(max_events=10)
+
+        def fetch(start, end):
+            return [{'when': w, 'what': 'x'} for w in range(start, end + 1)]
+
+        cache.get('t', 'a', 0, 5, fetch)
+        cache.get('t', 'b', 0, 5, fetch)
+        self.assertTrue(cache.entries.size <= 10)
+        self.assertEqual(len(cache.get('t', 'b', 0, 5, fetch)), 6)
+
+
+class TestGetEvents(TestCase):
+    def test_get_events(self):
+        finder = bf.TenantBluefloodFinder({'blueflood': {
+            'urls': ['http://dummy'], 'tenant': 'tenant'}})
+        endpoint = finder.find_events_endpoint('http://dummy', 'tenant')
+        now = int(time.time())
+        with requests_mock.mock() as m:
+            m.get(endpoint, json=[{'when': (now - 1000) * 1000,
+                                   'what': 'deploy', 'tags': 'deploy'}])
+            events = finder.getEvents(now - 3600, now - 600, 'deploy')
+            self.assertEqual(events, [{'when': now - 1000, 'what': 'deploy',
+                                       'tags': 'deploy'}])
+            self.assertEqual(finder.getEvents(now - 3000, now - 600,
+                                              'deploy'), events)
+            self.assertEqual(m.call_count, 1)
+
+    def test_whole_seconds(self):
+        # the cache covers whole seconds, up to the last millisecond of
+        # each range
+        finder = bf.TenantBluefloodFinder({'blueflood': {
+            'urls': ['http://dummy'], 'tenant': 'tenant'}})
+        endpoint = finder.find_events_endpoint('http://dummy', 'tenant')
+        event = {'when': 1000500, 'what': 'deploy', 'tags': 'deploy'}
+
+        def events(request, context):
+            start = int(request.qs['from'][0])
+            end = int(request.qs['until'][0])
+            return [dict(event)] if start <= event['when'] <= end else []
+
+        with requests_mock.mock() as m:
+            m.get(endpoint, json=events)
+            self.assertEqual(finder.getEvents(900, 999, 'deploy'), [])
+            self.assertEqual(finder.getEvents(1001, 1100, 'deploy'), [])
+            self.assertEqual(finder.getEvents(900, 1100, 'deploy'),
+                             [{'when': 1000, 'what': 'deploy',
+                               'tags': 'deploy'}])
+            self.assertEqual(m.last_request.qs['from'], ['1000000'])
+            self.assertEqual(m.last_request.qs['until'], ['1000999'])
@@ -0,0 +1,90 @@
+import json
+import random
+from unittest import TestCase
+
+import requests_mock
+
+from blueflood_graphite_finder.blueflood import TenantBluefloodLeafNode, \
+    TenantBluefloodReader
+from blueflood_graphite_finder.errors import BluefloodQueryRejected
+from blueflood_graphite_finder.guard import QueryGuard
+from . import make_finder
+
+VIEWS_URL = 'http://dummy.com/v2.0/t/views'
+START = 1426120000
+# 6 hours: 360 FULL points, 72 MIN5 ones
+END = START + 6 * 3600
+
+
+def make_nodes(finder, n):
+    nodes = []
+    for i in range(n):
+        path = 'a.b.metric%d' % i
+        reader = TenantBluefloodReader(path, 't', finder.bf_query_endpoint,
+                                       False, {}, None)
+        nodes.append(TenantBluefloodLeafNode(path, reader))
+    return nodes
+
+
+def multiplot(request, context):
+    return {'metrics': [{'metric': m, 'data': []}
+                        for m in json.loads(request.body)]}
+
+
+class TestQueryGuard(TestCase):
+    def test_group_sizes(self):
+        finder = make_finder(query_guard={'max_points': 1})
+        rnd = random.Random(0)
+        paths = ['x' * rnd.randint(1, 300) for _ in range(1000)]
+        client = finder.client
+        self.assertEqual(client.group_sizes(paths),
+                         [len(g) for g in client.group_paths(paths)])
+
+    def test_estimate(self):
+        guard = QueryGuard(max_points=1000)
+        est = guard.estimate(10, [100, 50], 'MIN5', 3600, 300)
+        self.assertEqual((est.paths, est.groups, est.points, est.bytes),
+                         (150, 2, 1800, 1800 * 60))
+        self.assertEqual(guard.exceeded(est), ['max_points=1000'])
+        self.assertRaises(ValueError, QueryGuard, action='explode')
+
+    def test_reject(self):
+        finder = make_finder(query_guard={'max_points': 1000})
+        with requests_mock.mock() as m:
+            m.post(VIEWS_URL, json=multiplot)
+            with self.assertRaises(BluefloodQueryRejected) as cm:
+                finder.fetch_multi(make_nodes(finder, 3), START, END)
+            self.assertEqual(m.call_count, 0)
+            self.assertIn('1080 FULL points', str(cm.exception))
+            # within the limits
+            finder.fetch_multi(make_nodes(finder, 2), START, END)
+            self.assertEqual(m.call_count, 1)
+        self.assertEqual(finder.cache_stats()['guard']['rejected'], 1)
+
+    def test_degrade(self):
+        finder = make_finder(query_guard={'max_points': 1000,
+                                          'action': 'degrade'})
+        with requests_mock.mock() as m:
+            m.post(VIEWS_URL, json=multiplot)
+            time_info, series = finder.fetch_multi(make_nodes(finder, 10),
+                                                   START, END)
+            self.assertEqual(m.last_request.qs['resolution'], ['min5'])
+        self.assertEqual(time_info, (START, END + 300, 300))
+        self.assertEqual(len(series), 10)
+        # nothing fits 100 nodes
+        finder.guard.max_nodes = 50
+        with self.assertRaises(BluefloodQueryRejected):
+            finder.fetch_multi(make_nodes(finder, 100), START, END)
+
+    def test_truncate(self):
+        finder = make_finder(query_guard={'max_groups': 1,
+                                          'action': 'truncate'})
+        nodes = make_nodes(finder, 150)
+        with requests_mock.mock() as m:
+            m.post(VIEWS_URL, json=multiplot)
+            time_info, series = finder.fetch_multi(nodes, START, END)
+            self.assertEqual(m.call_count, 1)
+        # the first ones
+        self.assertEqual(sorted(series),
+                         sorted(n.path for n in nodes[:100]))
+        self.assertEqual(finder.guard.truncated, 1)
@@ -0,0 +1,131 @@
+import time
+from unittest import TestCase
+
+import requests_mock
+
+import blueflood_graphite_finder.blueflood as bf
+from blueflood_graphite_finder import intervals
+from blueflood_graphite_finder.intervals import IntervalTracker
+
+
+class TestIntervalTracker(TestCase):
+    def setUp(self):
+        self.now = int(time.time())
+        self.tracker = IntervalTracker(settle=600)
+
+    def point(self, ts):
+        return {u'timestamp': ts * 1000, u'average': 1}
+
+    def test_unknown_metric(self):
+        self.assertTrue(self.tracker.has_data('t', 'm', 0, self.now, 60))
+        i = self.tracker.get_intervals('t', 'm').intervals
+        self.assertEqual(len(i), 1)
+        self.assertEqual(i[0].start, 0)
+
+    def test_dead_metric(self):
+        start = self.now - 86400
+        self.tracker.observe('t', 'm', start, self.now,
+                             [self.point(start), self.point(start + 60)], 60)
+        self.assertFalse(self.tracker.has_data('t', 'm', start + 3600,
+                                               self.now - 3600, 60))
+        self.assertTrue(self.tracker.has_data('t', 'm', start,
+                                              self.now - 3600, 60))
+        # the last settle seconds are never known to be empty
+        self.assertTrue(self.tracker.has_data('t', 'm', start + 3600,
+                                              self.now, 60))
+        i = self.tracker.get_intervals('t', 'm').intervals
+        self.assertEqual(i[0].tuple, (0, start + 120))
+
+        # an empty fetch right after extends the gap
+        self.tracker.observe('t', 'm', self.now - 3600, self.now + 3600, [],
+                             60)
+        self.assertFalse(self.tracker.has_data('t', 'm', start + 3600,
+                                               self.now - 1200, 60))
+
+    def test_data_shows_up(self):
+        start = self.now - 86400
+        self.tracker.observe('t', 'm', start, self.now, [], 60)
+        self.assertFalse(self.tracker.has_data('t', 'm', start, start + 60,
+                                               60))
+        self.tracker.observe('t', 'm', start, start + 120,
+                             [self.point(start + 60)], 60)
+        self.assertTrue(self.tracker.has_data('t', 'm', start, start + 120,
+                                              60))
+        self.assertTrue(self.tracker.has_data('t', 'm', start + 120,
+                                              self.now - 3600, 60))
+
+
+class TestFetchSkipsDeadMetrics(TestCase):
+    def setUp(self):
+        intervals.set_tracker(IntervalTracker())
+
+    def tearDown(self):
+        intervals.set_tracker(IntervalTracker())
+
+    def test_fetch_multi(self):
+        client = bf.BluefloodClient('http://dummy', 'tenant', False, {},
+                                    False, skip_dead_metrics=True)
+        reader = bf.TenantBluefloodReader('a.b.c', 'tenant', 'http://dummy',
+                                          False, {}, None)
+        nodes = [bf.TenantBluefloodLeafNode('a.b.c', reader)]
+        end = int(time.time()) - 7200
+        start = end - 3600
+        endpoint = client.get_multi_endpoint('http://dummy', 'tenant')
+        with requests_mock.mock() as m:
+            m.post(endpoint, json={'metrics': [{'metric': 'a.b.c',
+                                                'data': []}]})
+            first = client.fetch_multi(nodes, start, end)
+            self.assertEqual(m.call_count, 1)
+            second = client.fetch_multi(nodes, start, end)
+            self.assertEqual(m.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(reader.get_intervals().intervals[-1].start, end)
+
+    def test_coarse_then_fine(self):
+        # the newest MIN60 rollups aren't there yet, but the raw data is
+        client = bf.BluefloodClient('http://dummy', 'tenant', False, {},
+                                    False, skip_dead_metrics=True)
+        reader = bf.TenantBluefloodReader('a.b.c', 'tenant', 'http://dummy',
+                                          False, {}, None)
+        nodes = [bf.TenantBluefloodLeafNode('a.b.c', reader)]
+        end = int(time.time()) - 3600
+        end -= end % 3600
+        start = end - 14 * 86400
+        zoom = end - 4 * 3600
+        full = [{'timestamp': ts * 1000, 'average': 1}
+                for ts in range(zoom, zoom + 3600, 60)]
+
+        def multiplot(request, context):
+            if request.qs['resolution'] == ['min60']:
+                data = [{'timestamp': ts * 1000, 'average': 1}
+                        for ts in range(start, zoom - 3600, 3600)]
+            else:
+                data = full
+            return {'metrics': [{'metric': 'a.b.c', 'data': data}]}
+
+        endpoint = client.get_multi_endpoint('http://dummy', 'tenant')
+        with requests_mock.mock() as m:
+            m.post(endpoint, json=multiplot)
+            client.fetch_multi(nodes, start, end)
+            self.assertEqual(m.last_request.qs['resolution'], ['min60'])
+            time_info, series = client.fetch_multi(nodes, zoom, zoom + 3600)
+            self.assertEqual(m.call_count, 2)
+            self.assertEqual(m.last_request.qs['resolution'], ['full'])
+        self.assertEqual(series['a.b.c'][:60], [1] * 60)
+
+    def test_skipping_is_opt_in(self):
+        client = bf.BluefloodClient('http://dummy', 'tenant', False, {},
+                                    False)
+        reader = bf.TenantBluefloodReader('a.b.c', 'tenant', 'http://dummy',
+                                          False, {}, None)
+        nodes = [bf.TenantBluefloodLeafNode('a.b.c', reader)]
+        end = int(time.time()) - 7200
+        endpoint = client.get_multi_endpoint('http://dummy', 'tenant')
+        with requests_mock.mock() as m:
+            m.post(endpoint, json={'metrics': [{'metric': 'a.b.c',
+                                                'data': []}]})
+            client.fetch_multi(nodes, end - 3600, end)
+            client.fetch_multi(nodes, end - 3600, end)
+            self.assertEqual(m.call_count, 2)
+        # the gap is still reported
+        self.assertEqual(reader.get_intervals().intervals[-1].start, end)
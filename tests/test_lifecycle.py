@@ -0,0 +1,91 @@
+import json
+import os
+import time
+from unittest import TestCase
+
+import requests_mock
+from graphite_api.storage import FindQuery
+
+from blueflood_graphite_finder import lifecycle, offload, transport
+from . import make_finder
+
+SEARCH_URL = 'http://dummy.com/v2.0/t/metric_name/search'
+
+
+class TestLifecycle(TestCase):
+    def tearDown(self):
+        transport.configure()
+
+    def test_check(self):
+        calls = []
+        lifecycle.register(lambda: calls.append(os.getpid()))
+        try:
+            lifecycle.check()
+            self.assertEqual(calls, [])
+            # as if this process had been forked
+            lifecycle.pid = -1
+            lifecycle.check()
+            lifecycle.check()
+            self.assertEqual(calls, [os.getpid()])
+        finally:
+            lifecycle.hooks.pop()
+
+    def test_after_fork(self):
+        finder = make_finder(find_batch_window=0.01,
+                             fetch_batch_window=0.01,
+                             max_concurrent_renders=2)
+        finder.negative_cache.put(('t', 'nodes', 'a.*'), 200)
+        # taken by threads that don't exist in the child
+        finder.negative_cache.lock.acquire()
+        finder.find_batcher.pending['k'] = object()
+        finder.admission.active = 2
+        session = transport.get_session()
+        thread = finder.background
+
+        lifecycle.pid = -1
+        lifecycle.check()
+        self.assertIsNone(transport.session)
+        self.assertIsNot(transport.get_session(), session)
+        self.assertIsNone(offload.pool)
+        self.assertTrue(finder.known_empty('nodes', 'a.*'))
+        self.assertEqual(finder.find_batcher.pending, {})
+        self.assertEqual(finder.admission.active, 0)
+        self.assertIsNot(finder.background, thread)
+        self.assertTrue(finder.background.is_alive())
+
+    def test_fork(self):
+        finder = make_finder()
+        session = transport.get_session()
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # the child reports what it sees and leaves without cleaning up
+            try:
+                lifecycle.check()
+                os.write(write, json.dumps(
+                    [transport.session is not session,
+                     finder.background.is_alive()]))
+            finally:
+                os._exit(0)
+        os.close(write)
+        try:
+            self.assertEqual(json.loads(os.read(read, 100)), [True, True])
+        finally:
+            os.close(read)
+            os.waitpid(pid, 0)
+        # the parent still has everything it had
+        self.assertIs(transport.session, session)
+
+    def test_prewarm(self):
+        with requests_mock.mock() as m:
+            m.get(SEARCH_URL, json=[{'a.b': True}])
+            finder = make_finder(prewarm_patterns=['a.*', 'x.*'])
+            self.assertEqual(m.call_count, 2)
+            query = FindQuery('a.*', 0, 1)
+            nodes = list(finder.find_nodes(query))
+            self.assertEqual([n.path for n in nodes], ['a.b'])
+            self.assertEqual(m.call_count, 2)
+            # only for "prewarm_ttl" seconds
+            finder.prewarmed_until = time.time() - 1
+            list(finder.find_nodes(query))
+            self.assertEqual(m.call_count, 3)
@@ -0,0 +1,92 @@
+from unittest import TestCase
+
+import flask
+import requests_mock
+from graphite_api import storage
+
+import blueflood_graphite_finder.blueflood as bf
+from blueflood_graphite_finder import transport
+from blueflood_graphite_finder.cache import LRUCache
+
+
+class TestMultiTenant(TestCase):
+    def setUp(self):
+        self.url = 'http://dummybf.com'
+
+    def finder(self, mode, **options):
+        config = {'blueflood': {'urls': [self.url], 'tenant': 'default',
+                                'multi_tenant': mode}}
+        config['blueflood'].update(options)
+        return bf.TenantBluefloodFinder(config)
+
+    def find(self, finder, pattern):
+        return sorted((n.path, n.is_leaf) for n in
+                      finder.find_nodes(storage.FindQuery(pattern, 1, 2)))
+
+    def test_prefix_find(self):
+        finder = self.finder('prefix', tenants=['t1', 't2', 'other'])
+        with requests_mock.mock() as m:
+            m.get(self.url + '/v2.0/t1/metric_name/search',
+                  json=[{'a.b': True}, {'a.c': False}])
+            m.get(self.url + '/v2.0/t2/metric_name/search',
+                  json=[{'a.d': True}])
+            self.assertEqual(self.find(finder, 't*'),
+                             [('t1', False), ('t2', False)])
+            self.assertEqual(self.find(finder, 't1.a.*'),
+                             [('t1.a.b', True), ('t1.a.c', False)])
+            self.assertEqual(self.find(finder, 't*.a.*'),
+                             [('t1.a.b', True), ('t1.a.c', False),
+                              ('t2.a.d', True)])
+            self.assertEqual(m.last_request.qs['query'], ['a.*'])
+            # tenants that aren't configured can't be queried
+            self.assertEqual(self.find(finder, 'nope.a.*'), [])
+
+    def test_prefix_fetch(self):
+        finder = self.finder('prefix')
+        start = 1426120000
+        with requests_mock.mock() as m:
+            m.get(self.url + '/v2.0/t1/metric_name/search',
+                  json=[{'a.b': True}])
+            m.get(self.url + '/v2.0/t2/metric_name/search',
+                  json=[{'a.b': True}])
+            nodes = list(finder.find_nodes(storage.FindQuery('t1.a.*', 1, 2)))
+            nodes += list(finder.find_nodes(storage.FindQuery('t2.a.*', 1, 2)))
+            for t, value in (('t1', 1), ('t2', 2)):
+                m.post(self.url + '/v2.0/%s/views' % t,
+                       json={'metrics': [{'metric': 'a.b', 'data': [
+                           {'timestamp': start * 1000, 'average': value}]}]})
+            time_info, series = finder.fetch_multi(nodes, start, start + 120)
+        self.assertEqual(time_info, (start, start + 180, 60))
+        self.assertEqual(series, {'t1.a.b': [1, None, None],
+                                  't2.a.b': [2, None, None]})
+        # both tenants share the connection pool and the caches
+        t1 = finder.for_tenant('t1')
+        self.assertIs(t1, finder.for_tenant('t1'))
+        self.assertIs(t1.events_cache, finder.events_cache)
+        self.assertIs(t1.client.rollup_cache, finder.client.rollup_cache)
+        self.assertIsNotNone(transport.session)
+
+    def test_header_find(self):
+        finder = self.finder('header', tenant_header='X-Tenant')
+        app = flask.Flask(__name__)
+        with requests_mock.mock() as m:
+            m.get(self.url + '/v2.0/t1/metric_name/search',
+                  json=[{'a.b': True}])
+            m.get(self.url + '/v2.0/default/metric_name/search',
+                  json=[{'a.c': True}])
+            with app.test_request_context(headers={'X-Tenant': 't1'}):
+                nodes = list(finder.find_nodes(
+                    storage.FindQuery('a.*', 1, 2)))
+            self.assertEqual([n.path for n in nodes], ['a.b'])
+            self.assertEqual(nodes[0].reader.tenant, 't1')
+            self.assertEqual(self.find(finder, 'a.*'), [('a.c', True)])
+
+    def test_tenant_quota(self):
+        cache = LRUCache(10, tenant_quota=4)
+        for i in range(10):
+            cache.put(('noisy', i), i)
+        cache.put(('quiet', 0), 0)
+        self.assertEqual(cache.get(('quiet', 0)), 0)
+        self.assertEqual(len(cache), 5)
+        self.assertIsNone(cache.get(('noisy', 0)))
+        self.assertEqual(cache.get(('noisy', 9)), 9)
@@ -0,0 +1,106 @@
+import logging.config
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import requests_mock
+
+import blueflood_graphite_finder.blueflood as bf
+from blueflood_graphite_finder.rollup_cache import RollupCache, BUCKET_STEPS
+
+logging_file = os.path.join(os.path.dirname(__file__), 'logging.ini')
+logging.config.fileConfig(logging_file)
+
+DAY = 1440 * 60
+BUCKET = DAY * BUCKET_STEPS
+
+
+class TestRollupCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = RollupCache(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def points(self, start, count):
+        return [{u'timestamp': (start + i * DAY) * 1000,
+                 u'average': 1.5 * i, u'numPoints': i}
+                for i in range(count)]
+
+    def test_closed_buckets(self):
+        now = 10 * BUCKET + DAY
+        self.assertEqual(
+            self.cache.closed_buckets('MIN1440', BUCKET + 5, 20 * BUCKET,
+                                      now),
+            range(BUCKET, 10 * BUCKET, BUCKET))
+        # the bucket that ends at "now" isn't settled yet
+        self.assertEqual(
+            self.cache.closed_buckets('MIN1440', 0, now, 10 * BUCKET + 10),
+            range(0, 9 * BUCKET, BUCKET))
+        self.assertEqual(self.cache.closed_buckets('FULL', 0, now, now), [])
+
+    def test_put_get(self):
+        buckets = [0, BUCKET]
+        points = self.points(0, 2 * BUCKET_STEPS)
+        self.assertTrue(self.cache.put_range('t', 'a.b', None, 'MIN1440',
+                                             buckets, points))
+        self.assertEqual(self.cache.get_range('t', 'a.b', None, 'MIN1440',
+                                              buckets), points)
+        self.assertIsNone(self.cache.get_range('t', 'a.b', None, 'MIN1440',
+                                               [0, BUCKET, 2 * BUCKET]))
+        self.assertIsNone(self.cache.get_range('t2', 'a.b', None, 'MIN1440',
+                                               buckets))
+        # types are preserved
+        value = self.cache.get_range('t', 'a.b', None, 'MIN1440', [0])[0]
+        self.assertIsInstance(value['numPoints'], int)
+        self.assertIsInstance(value['average'], float)
+
+        # another process sees the same data
+        other = RollupCache(self.dir)
+        self.assertEqual(other.get_range('t', 'a.b', None, 'MIN1440',
+                                         buckets), points)
+
+    def test_uncacheable_points(self):
+        points = [{u'timestamp': 0, u'enum_values': {u'v1': 1}}]
+        self.assertFalse(self.cache.put_range('t', 'a.b', None, 'MIN1440',
+                                              [0], points))
+        self.assertIsNone(self.cache.get_range('t', 'a.b', None, 'MIN1440',
+                                               [0]))
+
+    def test_eviction(self):
+        cache = RollupCache(self.dir, max_bytes=4096, segment_bytes=1024)
+        for i in range(50):
+            cache.put_range('t', 'm%d' % i, None, 'MIN1440', [0],
+                            self.points(0, 10))
+        total = sum(os.path.getsize(os.path.join(self.dir, n))
+                    for n in os.listdir(self.dir))
+        self.assertTrue(total <= 4096 + 1024)
+        self.assertIsNone(cache.get_range('t', 'm0', None, 'MIN1440', [0]))
+        self.assertIsNotNone(cache.get_range('t', 'm49', None, 'MIN1440',
+                                             [0]))
+
+    def test_fetch_multi(self):
+        client = bf.BluefloodClient('http://dummy', 'tenant', False, {},
+                                    False, rollup_cache=self.cache)
+        reader = bf.TenantBluefloodReader('a.b.c', 'tenant', 'http://dummy',
+                                          False, {}, None)
+        nodes = [bf.TenantBluefloodLeafNode('a.b.c', reader)]
+        start = BUCKET
+        end = start + 200 * DAY
+        endpoint = client.get_multi_endpoint('http://dummy', 'tenant')
+        data = self.points(start, 200)
+        with requests_mock.mock() as m:
+            m.post(endpoint, json={'metrics': [{'metric': 'a.b.c',
+                                                'data': data}]})
+            first = client.fetch_multi(nodes, start, end)
+            self.assertEqual(m.last_request.qs['from'], [str(start * 1000)])
+
+            m.post(endpoint, json={'metrics': [{'metric': 'a.b.c',
+                                                'data': data[192:]}]})
+            second = client.fetch_multi(nodes, start, end)
+            # only the open tail is requested the second time
+            self.assertEqual(m.last_request.qs['from'],
+                             [str((start + 6 * BUCKET) * 1000)])
+        self.assertEqual(first, second)
@@ -0,0 +1,112 @@
+import threading
+import time
+from unittest import TestCase
+
+import flask
+import requests_mock
+
+from blueflood_graphite_finder import scheduler, transport
+from blueflood_graphite_finder.errors import BluefloodOverloaded
+from blueflood_graphite_finder.scheduler import Scheduler
+
+SEARCH_URL = 'http://dummy.com/v2.0/t/metric_name/search'
+
+
+def wait_for(condition):
+    deadline = time.time() + 5
+    while not condition() and time.time() < deadline:
+        time.sleep(0.001)
+
+
+class TestScheduler(TestCase):
+    def test_weighted(self):
+        s = Scheduler(1, {'a': {'weight': 3}, 'b': {'weight': 1}}, 'a')
+        order = []
+
+        def request(name):
+            with s.slot(name):
+                order.append(name)
+
+        held = s.acquire('b')
+        threads = []
+        for name in 'aaaabbbb':
+            t = threading.Thread(target=request, args=(name,))
+            t.start()
+            threads.append(t)
+            # queued in this order
+            wait_for(lambda: sum(len(c.queue) for c in s.classes.values())
+                     == len(threads))
+        s.release(held)
+        for t in threads:
+            t.join()
+        # three of "a" for one of "b" while both wait
+        self.assertEqual(order, list('abaaabbb'))
+        self.assertEqual(s.stats()['a'], {'active': 0, 'waiting': 0,
+                                          'granted': 4, 'shed': 0})
+
+    def test_class_limits(self):
+        s = Scheduler(3, {'a': {},
+                          'b': {'max_active': 1, 'wait_secs': 0.01}}, 'a')
+        held = s.acquire('b')
+        # b has its one slot, a still has two
+        self.assertRaises(BluefloodOverloaded, s.acquire, 'b')
+        first = s.acquire('a')
+        s.acquire('nope')
+        self.assertEqual(s.stats()['a']['active'], 2)
+        s.release(held)
+        s.release(first)
+        s.acquire('b')
+        self.assertEqual(s.stats()['b'], {'active': 1, 'waiting': 0,
+                                          'granted': 2, 'shed': 1})
+
+    def test_queue_full(self):
+        s = Scheduler(1, {'a': {'max_waiting': 0}}, 'a')
+        s.acquire('a')
+        with self.assertRaises(BluefloodOverloaded):
+            s.acquire('a', timeout=5)
+
+    def test_unknown_default(self):
+        self.assertRaises(ValueError, Scheduler, 1, {'a': {}}, 'b')
+
+
+class TestClassify(TestCase):
+    def tearDown(self):
+        scheduler.configure()
+
+    def test_rules(self):
+        scheduler.configure({
+            'header': 'X-Priority',
+            'rules': [{'class': 'batch', 'user_agent': 'alerter/*'},
+                      {'class': 'batch', 'header': 'X-Export'},
+                      {'class': 'background', 'target': 'warm.*'}]})
+        app = flask.Flask(__name__)
+        for headers, target, name in (
+                ({}, 'a.b', None),
+                ({'User-Agent': 'alerter/1.0'}, 'a.b', 'batch'),
+                ({'X-Export': 'yes'}, 'a.b', 'batch'),
+                ({}, 'warm.up', 'background'),
+                ({'X-Priority': 'background'}, 'a.b', 'background'),
+                # not a class
+                ({'X-Priority': 'urgent'}, 'a.b', None)):
+            with app.test_request_context('/render?target=' + target,
+                                          headers=headers):
+                self.assertEqual(scheduler.current_class(), name)
+                with scheduler.priority('interactive'):
+                    self.assertEqual(scheduler.current_class(),
+                                     'interactive')
+        self.assertIsNone(scheduler.current_class())
+
+    def test_transport(self):
+        scheduler.configure({'max_active': 1, 'classes': {
+            'interactive': {}, 'batch': {'wait_secs': 0.01}}})
+        held = scheduler.scheduler.acquire('interactive')
+        with requests_mock.mock() as m:
+            m.get(SEARCH_URL, json=[])
+            with scheduler.priority('batch'):
+                self.assertRaises(BluefloodOverloaded, transport.get,
+                                  SEARCH_URL)
+            self.assertEqual(m.call_count, 0)
+            scheduler.scheduler.release(held)
+            transport.get(SEARCH_URL)
+            self.assertEqual(m.call_count, 1)
+        self.assertEqual(scheduler.scheduler.stats()['batch']['shed'], 1)
@@ -0,0 +1,317 @@
+import SocketServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+import requests_mock
+from graphite_api.storage import FindQuery
+
+from blueflood_graphite_finder.blueflood import TenantBluefloodFinder, \
+    TenantBluefloodLeafNode, TenantBluefloodReader
+from blueflood_graphite_finder.shared_cache import LocalBackend, \
+    MemcachedBackend, SharedCache, SharedMemoryBackend, decode_metrics, \
+    decode_nodes, decode_series, encode_metrics, encode_nodes, \
+    encode_series, make_cache
+
+
+class FakeMemcachedHandler(SocketServer.StreamRequestHandler):
+    # Enough of the memcached text protocol for MemcachedBackend
+    def handle(self):
+        server = self.server
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if parts[0] == 'get':
+                out = []
+                for k in parts[1:]:
+                    v = server.get(k)
+                    if v is not None:
+                        out.append('VALUE %s 0 %d\r\n%s\r\n' % (k, len(v), v))
+                self.wfile.write(''.join(out) + 'END\r\n')
+            elif parts[0] in ('set', 'add'):
+                key, ttl, size = parts[1], int(parts[3]), int(parts[4])
+                value = self.rfile.read(size + 2)[:-2]
+                with server.lock:
+                    stored = parts[0] == 'set' or server.get(key) is None
+                    if stored:
+                        server.data[key] = (value, time.time() + ttl)
+                if parts[-1] != 'noreply':
+                    self.wfile.write('STORED\r\n' if stored
+                                     else 'NOT_STORED\r\n')
+            elif parts[0] == 'delete':
+                server.data.pop(parts[1], None)
+                if parts[-1] != 'noreply':
+                    self.wfile.write('DELETED\r\n')
+
+
+class FakeMemcached(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0),
+                                        FakeMemcachedHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        t = threading.Thread(target=self.serve_forever, args=(0.01,))
+        t.daemon = True
+        t.start()
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None or entry[1] < time.time():
+            return None
+        return entry[0]
+
+    def address(self):
+        return '127.0.0.1:%d' % self.server_address[1]
+
+
+class TestEncoding(TestCase):
+    def test_nodes(self):
+        nodes = [{u'a.b': True}, {u'a.c\xe9': False}]
+        self.assertEqual(decode_nodes(encode_nodes(nodes)), nodes)
+        many = [{u'metric.%d' % i: i % 2 == 0} for i in range(1000)]
+        data = encode_nodes(many)
+        # compressed
+        self.assertTrue(len(data) < sum(len(next(iter(n))) for n in many))
+        self.assertEqual(decode_nodes(data), many)
+
+    def test_metrics(self):
+        metrics = {u'a.b': None, u'a.c': [u'v1', u'v2'], u'a.d': []}
+        self.assertEqual(decode_metrics(encode_metrics(metrics)), metrics)
+
+    def test_series(self):
+        points = [{u'timestamp': 60000, u'numPoints': 2, u'average': 1.5},
+                  {u'timestamp': 120000, u'numPoints': 1, u'average': 7}]
+        data = encode_series(points)
+        self.assertEqual(data[0], 'P')
+        self.assertEqual(decode_series(data), points)
+        enums = [{u'timestamp': 60000, u'enum_values': {u'v1': 3}}]
+        self.assertEqual(decode_series(encode_series(enums)), enums)
+        self.assertEqual(decode_series(encode_series([])), [])
+
+
+class BackendTests(object):
+    def test_get_set(self):
+        b = self.backend
+        self.assertEqual(b.get_multi(['k1', 'k2']), {})
+        b.set_multi({'k1': 'v1', 'k2': 'v2' * 100}, 10)
+        self.assertEqual(b.get_multi(['k1', 'k2', 'k3']),
+                         {'k1': 'v1', 'k2': 'v2' * 100})
+        b.set_multi({'k1': 'new'}, 10)
+        self.assertEqual(b.get_multi(['k1']), {'k1': 'new'})
+        b.delete('k1')
+        self.assertEqual(b.get_multi(['k1']), {})
+
+    def test_add(self):
+        b = self.backend
+        self.assertTrue(b.add('lock', '1', 10))
+        self.assertFalse(b.add('lock', '1', 10))
+        b.delete('lock')
+        self.assertTrue(b.add('lock', '1', 10))
+
+    def test_expiry(self):
+        b = self.backend
+        b.set_multi({'k': 'v'}, -1)
+        self.assertEqual(b.get_multi(['k']), {})
+        self.assertTrue(b.add('k', 'v', 10))
+
+
+class TestLocalBackend(TestCase, BackendTests):
+    def setUp(self):
+        self.backend = LocalBackend(1 << 20)
+
+
+class TestSharedMemoryBackend(TestCase, BackendTests):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache')
+        self.backend = SharedMemoryBackend(self.path, slots=64,
+                                           slot_bytes=1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_too_big(self):
+        self.backend.set_multi({'k': 'x' * 2000}, 10)
+        self.assertEqual(self.backend.get_multi(['k']), {})
+
+    def test_shared(self):
+        # another process sees what this one stores, and the other way
+        other = SharedMemoryBackend(self.path, slots=64, slot_bytes=1024)
+        self.backend.set_multi({'k': 'v'}, 10)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if other.get_multi(['k']) == {'k': 'v'}:
+                    other.set_multi({'child': 'yes'}, 10)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.backend.get_multi(['child']), {'child': 'yes'})
+
+    def test_many_keys(self):
+        values = dict(('k%d' % i, 'v%d' % i) for i in range(32))
+        self.backend.set_multi(values, 10)
+        found = self.backend.get_multi(values.keys())
+        # every value found is right, and two slots a key keep most of them
+        self.assertTrue(all(values[k] == v for k, v in found.items()))
+        self.assertTrue(len(found) > 20)
+
+
+class TestMemcachedBackend(TestCase, BackendTests):
+    def setUp(self):
+        self.servers = [FakeMemcached(), FakeMemcached()]
+        self.backend = MemcachedBackend([s.address() for s in self.servers])
+
+    def tearDown(self):
+        self.backend.close()
+        for s in self.servers:
+            s.shutdown()
+            s.server_close()
+
+    def test_spread(self):
+        self.backend.set_multi(dict(('k%d' % i, 'v') for i in range(20)), 10)
+        self.assertEqual(len(self.backend.get_multi(
+            ['k%d' % i for i in range(20)])), 20)
+        self.assertTrue(all(s.data for s in self.servers))
+
+    def test_down(self):
+        backend = MemcachedBackend(['127.0.0.1:1'], timeout=0.1)
+        self.assertEqual(backend.get_multi(['k']), {})
+        backend.set_multi({'k': 'v'}, 10)
+        # nobody can take locks, so everyone goes ahead
+        self.assertTrue(backend.add('lock', '1', 10))
+
+
+class TestSharedCache(TestCase):
+    def test_stampede(self):
+        cache = SharedCache(LocalBackend(), poll=0.01)
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return [{u'a.b': True}]
+
+        def fetch():
+            results.append(cache.fetch(cache.key('nodes', 't', 'a.*'),
+                                       compute, encode_nodes, decode_nodes,
+                                       60))
+
+        threads = [threading.Thread(target=fetch) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [[{u'a.b': True}]] * 5)
+        self.assertEqual(cache.waits, 4)
+
+    def test_published_before_unlock(self):
+        backend = LocalBackend()
+        cache = SharedCache(backend)
+        key = cache.key('nodes', 't', 'a.*')
+        calls = []
+        waited = []
+
+        def compute():
+            calls.append(1)
+            return [{u'a.b': True}]
+
+        def delete(lock_key):
+            del backend.delete
+            backend.delete(lock_key)
+            # a waiter sees the lock go and looks in the cache
+            waited.append(cache.fetch(key, compute, encode_nodes,
+                                      decode_nodes, 60))
+
+        backend.delete = delete
+        cache.fetch(key, compute, encode_nodes, decode_nodes, 60)
+        self.assertEqual(waited, [[{u'a.b': True}]])
+        self.assertEqual(len(calls), 1)
+
+    def test_make_cache(self):
+        cache = make_cache({'backend': 'local', 'max_bytes': 1000,
+                            'find_ttl': 5})
+        self.assertEqual(cache.find_ttl, 5)
+        self.assertEqual(cache.backend.entries.max_size, 1000)
+        self.assertRaises(ValueError, make_cache, {'backend': 'nope'})
+
+
+class TestFinderSharedCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.config = {'blueflood': {
+            'urls': ['http://dummy.com'],
+            'tenant': 't',
+            'shared_cache': {'backend': 'shm',
+                             'path': os.path.join(self.dir, 'cache'),
+                             'slots': 256}}}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_find(self):
+        # two finders are as good as two workers
+        finders = [TenantBluefloodFinder(self.config) for _ in range(2)]
+        with requests_mock.mock() as m:
+            m.get('http://dummy.com/v2.0/t/metric_name/search',
+                  json=[{'a.b': True}, {'a.c': False}])
+            for f in finders:
+                nodes = list(f.find_nodes(FindQuery('a.*', 0, 1)))
+                self.assertEqual([(n.path, n.is_leaf) for n in nodes],
+                                 [('a.b', True), ('a.c', False)])
+            self.assertEqual(m.call_count, 1)
+
+    def test_fetch(self):
+        finders = [TenantBluefloodFinder(self.config) for _ in range(2)]
+        data = [{'timestamp': 1200000, 'numPoints': 1, 'average': 5},
+                {'timestamp': 1260000, 'numPoints': 1, 'average': 6}]
+        with requests_mock.mock() as m:
+            m.post('http://dummy.com/v2.0/t/views',
+                   json={'metrics': [{'metric': 'a.b', 'data': data}]})
+            results = []
+            for i, f in enumerate(finders):
+                node = TenantBluefloodLeafNode('a.b', TenantBluefloodReader(
+                    'a.b', 't', f.bf_query_endpoint, False, {}, None))
+                # a few seconds apart, in the same steps
+                results.append(f.fetch_multi([node], 1200 + i, 1300 + i))
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual(json.loads(m.request_history[0].body), ['a.b'])
+            self.assertEqual(m.request_history[0].qs['from'], ['1200000'])
+        # each lined up with its own range
+        self.assertEqual(results[0], ((1200, 1360, 60),
+                                      {'a.b': [5, 6, None]}))
+        self.assertEqual(results[1], ((1201, 1361, 60),
+                                      {'a.b': [6, None, None]}))
+
+    def test_fetch_published_before_unlock(self):
+        finders = [TenantBluefloodFinder(self.config) for _ in range(2)]
+        data = [{'timestamp': 1200000, 'numPoints': 1, 'average': 5}]
+        backend = finders[0].client.shared_cache.backend
+        results = []
+
+        def delete(lock_key):
+            del backend.delete
+            backend.delete(lock_key)
+            # the other worker was waiting for the lock to go
+            results.append(finders[1].fetch_multi([node], 1200, 1300))
+
+        backend.delete = delete
+        node = TenantBluefloodLeafNode('a.b', TenantBluefloodReader(
+            'a.b', 't', finders[0].bf_query_endpoint, False, {}, None))
+        with requests_mock.mock() as m:
+            m.post('http://dummy.com/v2.0/t/views',
+                   json={'metrics': [{'metric': 'a.b', 'data': data}]})
+            results.append(finders[0].fetch_multi([node], 1200, 1300))
+            self.assertEqual(m.call_count, 1)
+        self.assertEqual(results[0], results[1])
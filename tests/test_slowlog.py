@@ -0,0 +1,91 @@
+import logging
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import requests_mock
+from graphite_api.storage import FindQuery
+
+from blueflood_graphite_finder import slowlog
+from blueflood_graphite_finder.blueflood import TenantBluefloodFinder
+from blueflood_graphite_finder.errors import BluefloodError
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestSlowLog(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.finder = TenantBluefloodFinder({'blueflood': {
+            'urls': ['http://dummy.com'],
+            'tenant': 'dummyTenant',
+            'interval_cache_size': 0,
+            'slow_query_threshold': 0,
+            'slow_query_profile_rate': 1,
+            'slow_query_profile_dir': self.dir,
+            'slow_query_profile_keep': 2}})
+        self.handler = ListHandler()
+        logging.getLogger('blueflood_finder').addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger('blueflood_finder').removeHandler(self.handler)
+        slowlog.configure()
+        shutil.rmtree(self.dir)
+
+    def slow_messages(self):
+        return [m for m in self.handler.messages if m.startswith('slow ')]
+
+    def test_fetch_multi(self):
+        client = self.finder.client
+        endpoint = client.get_multi_endpoint(self.finder.bf_query_endpoint,
+                                             self.finder.tenant)
+        find_endpoint = self.finder.find_nodes_endpoint(
+            self.finder.bf_query_endpoint, self.finder.tenant)
+        with requests_mock.mock() as m:
+            m.get(find_endpoint, json=[{'a.b': True}, {'a.c': True}])
+            nodes = list(self.finder.find_nodes(FindQuery('a.*', 1, 2)))
+            m.post(endpoint, json={'metrics': [
+                {'metric': 'a.b', 'data': [{'timestamp': 1426120000000,
+                                            'average': 1}]}]})
+            for _ in range(3):
+                self.finder.fetch_multi(nodes, 1426120000, 1426120600)
+
+        messages = self.slow_messages()
+        self.assertEqual(len(messages), 4)
+        self.assertIn('slow find_nodes', messages[0])
+        self.assertIn('nodes=2 pattern=a.*', messages[0])
+        self.assertIn('requests=1', messages[0])
+        self.assertIn('slow fetch_multi', messages[1])
+        for field in ('dead_nodes=0', 'groups=1', 'nodes=2', 'res=FULL',
+                      'requests=1', 'plan=', 'fetch=', 'process=',
+                      'profile=' + self.dir):
+            self.assertIn(field, messages[1])
+        self.assertNotIn('bytes=0', messages[1])
+        # only the latest profiles are kept
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+
+    def test_errors(self):
+        slowlog.configure(0)
+        endpoint = self.finder.client.get_multi_endpoint(
+            self.finder.bf_query_endpoint, self.finder.tenant)
+        find_endpoint = self.finder.find_nodes_endpoint(
+            self.finder.bf_query_endpoint, self.finder.tenant)
+        with requests_mock.mock() as m:
+            m.get(find_endpoint, json=[{'a.b': True}])
+            nodes = list(self.finder.find_nodes(FindQuery('a.*', 1, 2)))
+            m.post(endpoint, status_code=400)
+            with self.assertRaises(BluefloodError):
+                self.finder.fetch_multi(nodes, 1426120000, 1426120600)
+        messages = self.slow_messages()
+        self.assertEqual(len(messages), 2)
+        self.assertIn('error=BluefloodError', messages[1])
+        self.assertNotIn('profile=', messages[1])
+        self.assertIsNone(slowlog.current())
@@ -0,0 +1,144 @@
+from unittest import TestCase
+
+import flask
+import requests_mock
+from graphite_api.storage import FindQuery
+
+from blueflood_graphite_finder import rax_auth, tracing, transport
+from blueflood_graphite_finder.blueflood import TenantBluefloodLeafNode, \
+    TenantBluefloodReader
+from . import make_finder
+
+SEARCH_URL = 'http://dummy.com/v2.0/t/metric_name/search'
+VIEWS_URL = 'http://dummy.com/v2.0/t/views'
+EVENTS_URL = 'http://dummy.com/v2.0/t/events/getEvents'
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+EXPORTER = 'tests.test_tracing.ListExporter'
+
+
+class ListExporter(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+        if self.fail:
+            raise IOError("collector down")
+
+    def named(self, name):
+        return [s for s in self.spans if s.name == name]
+
+
+class TestTracing(TestCase):
+    def setUp(self):
+        self.app = flask.Flask(__name__)
+
+    def tearDown(self):
+        tracing.configure()
+
+    def test_off(self):
+        tracing.configure()
+        self.assertIs(tracing.span('x', a=1), tracing.NOOP)
+        headers = {'Accept': 'application/json'}
+        self.assertIs(tracing.inject(headers), headers)
+        with tracing.span('x') as span:
+            span.set(b=2)
+        self.assertIsNone(tracing.current())
+
+    def test_fetch(self):
+        finder = make_finder(tracing={'exporter': EXPORTER,
+                                      'request_id_header': 'X-Request-Id'})
+        reader = TenantBluefloodReader('a.b', 't', finder.bf_query_endpoint,
+                                       False, {}, None)
+        nodes = [TenantBluefloodLeafNode('a.b', reader)]
+        headers = {'traceparent': '00-%s-%s-01' % (TRACE_ID, PARENT_ID),
+                   'X-Request-Id': 'req-1'}
+        with requests_mock.mock() as m, \
+                self.app.test_request_context('/render?target=a.*',
+                                              headers=headers):
+            m.post(VIEWS_URL, json={'metrics': [{'metric': 'a.b',
+                                                 'data': []}]})
+            finder.fetch_multi(nodes, 1426120000, 1426123600)
+            sent = m.last_request.headers
+        spans = tracing.exporter.spans
+        self.assertEqual([s.name for s in spans],
+                         ['blueflood_request', 'multiplot', 'fetch_multi'])
+        request, group, fetch = spans
+        # one trace, continuing the caller's
+        self.assertEqual(set(s.trace_id for s in spans), set([TRACE_ID]))
+        self.assertEqual(fetch.parent_id, PARENT_ID)
+        self.assertEqual(group.parent_id, fetch.span_id)
+        self.assertEqual(request.parent_id, group.span_id)
+        self.assertEqual(fetch.attributes['request_id'], 'req-1')
+        self.assertEqual(fetch.attributes['pattern'], 'a.*')
+        self.assertEqual(fetch.attributes['tenant'], 't')
+        self.assertEqual(group.attributes['group_size'], 1)
+        self.assertEqual(request.attributes['status'], 200)
+        self.assertTrue(request.attributes['bytes'] > 0)
+        self.assertTrue(fetch.end >= request.end >= request.start)
+        # Blueflood gets the request id and the request's span
+        self.assertEqual(sent['X-Request-Id'], 'req-1')
+        self.assertEqual(sent['traceparent'], request.traceparent())
+
+    def test_find_nodes(self):
+        finder = make_finder(tracing={'exporter': EXPORTER})
+        with requests_mock.mock() as m:
+            m.get(SEARCH_URL, json=[{'a.b': True}, {'a.c': False}])
+            nodes = finder.find_nodes(FindQuery('a.*', 0, 1))
+            # nothing happens until the nodes are read
+            self.assertEqual(tracing.exporter.spans, [])
+            self.assertEqual(len(list(nodes)), 2)
+        request, find = tracing.exporter.spans
+        self.assertEqual(find.name, 'find_nodes')
+        self.assertEqual(find.attributes['items'], 2)
+        self.assertEqual(find.attributes['pattern'], 'a.*')
+        self.assertEqual(request.parent_id, find.span_id)
+        self.assertIsNone(tracing.current())
+
+    def test_events(self):
+        finder = make_finder(tracing={'exporter': EXPORTER})
+        with requests_mock.mock() as m:
+            m.get(EVENTS_URL, status_code=500)
+            self.assertRaises(ValueError, finder.getEvents, 0, 600, 'deploy')
+            m.get(EVENTS_URL, json=[{'when': 60000, 'what': 'deploy'}])
+            finder.getEvents(0, 600, 'deploy')
+        failed, ok = tracing.exporter.named('getEvents')
+        self.assertTrue(failed.error)
+        self.assertEqual(ok.attributes['events'], 1)
+        self.assertEqual(ok.attributes['tags'], 'deploy')
+
+    def test_auth_refresh(self):
+        make_finder(tracing={'exporter': EXPORTER})
+        auth = rax_auth.BluefloodAuth({'blueflood': {'username': 'u',
+                                                     'apikey': 'k'}})
+        with requests_mock.mock() as m:
+            m.post(rax_auth.IDENTITY_ENDPOINT + 'tokens', json={
+                'access': {'token': {'id': 'tok',
+                                     'expires': '2030-01-01T00:00:00Z'}}})
+            self.assertEqual(auth.get_token(True), 'tok')
+        span, = tracing.exporter.named('auth_refresh')
+        self.assertEqual(span.attributes['status'], 200)
+
+    def test_sampling(self):
+        # unsampled requests still carry their id to Blueflood
+        make_finder(tracing={'exporter': EXPORTER, 'sample_rate': 0,
+                             'request_id_header': 'X-Request-Id'})
+        with requests_mock.mock() as m, self.app.test_request_context('/'):
+            m.get(SEARCH_URL, json=[])
+            transport.get(SEARCH_URL)
+            transport.get(SEARCH_URL)
+            ids = [r.headers['X-Request-Id'] for r in m.request_history]
+        self.assertEqual(tracing.exporter.spans, [])
+        self.assertEqual(len(ids[0]), 32)
+        self.assertEqual(ids[0], ids[1])
+        self.assertNotIn('traceparent', m.last_request.headers)
+
+    def test_exporter_fails(self):
+        tracing.set_exporter(ListExporter(fail=True))
+        with tracing.span('outer'):
+            with tracing.span('inner'):
+                pass
+        self.assertEqual(len(tracing.exporter.spans), 2)
+        self.assertIsNone(tracing.current())
@@ -0,0 +1,84 @@
+import time
+from unittest import TestCase
+
+import requests
+import requests_mock
+
+from blueflood_graphite_finder import transport
+from blueflood_graphite_finder.blueflood import BluefloodClient
+from blueflood_graphite_finder.errors import BluefloodDeadlineExceeded
+
+URL = 'http://dummybf.com/v2.0/t/views'
+
+
+class TestRetries(TestCase):
+    def setUp(self):
+        transport.configure(new_max_retries=2, new_retry_backoff=0.01,
+                            new_retry_max_backoff=0.02)
+
+    def tearDown(self):
+        transport.configure()
+
+    def test_retries_transient_errors(self):
+        with requests_mock.mock() as m:
+            m.post(URL, [{'status_code': 503},
+                         {'exc': requests.exceptions.ConnectionError},
+                         {'json': {'metrics': []}, 'status_code': 200}])
+            r = transport.post(URL)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(m.call_count, 3)
+
+    def test_gives_up(self):
+        with requests_mock.mock() as m:
+            m.post(URL, status_code=503)
+            self.assertEqual(transport.post(URL).status_code, 503)
+            self.assertEqual(m.call_count, 3)
+        with requests_mock.mock() as m:
+            m.post(URL, exc=requests.exceptions.ConnectTimeout)
+            with self.assertRaises(requests.exceptions.ConnectTimeout):
+                transport.post(URL)
+            self.assertEqual(m.call_count, 3)
+        # client errors aren't retried
+        with requests_mock.mock() as m:
+            m.post(URL, status_code=400)
+            transport.post(URL)
+            self.assertEqual(m.call_count, 1)
+
+    def test_budget(self):
+        # more retries than can fit in the budget
+        transport.configure(new_max_retries=100, new_retry_backoff=0.05,
+                            new_retry_max_backoff=0.05)
+        with requests_mock.mock() as m:
+            m.post(URL, status_code=503)
+            start = time.time()
+            with transport.budget(0.2):
+                # a nested budget can't extend the outer one
+                with transport.budget(10):
+                    self.assertTrue(transport.remaining_time() <= 0.2)
+                    transport.post(URL)
+            self.assertTrue(time.time() - start < 0.3)
+            self.assertTrue(1 < m.call_count < 101)
+            self.assertIsNone(transport.remaining_time())
+
+            with transport.budget(0):
+                with self.assertRaises(BluefloodDeadlineExceeded):
+                    transport.post(URL)
+
+    def test_partial_results(self):
+        client = BluefloodClient('http://dummybf.com', 't', False, {}, False,
+                                 partial_results=True)
+        payload = client.gen_payload(0, 100, 'FULL')
+        good = {'metric': 'a.b', 'data': []}
+
+        def json_callback(request, context):
+            if 'a.b' in request.text:
+                return {'metrics': [good]}
+            context.status_code = 500
+            return {}
+
+        with requests_mock.mock() as m:
+            m.post(URL, json=json_callback)
+            self.assertEqual(
+                client.gen_responses([['a.b'], ['c.d']], payload), [good])
+            m.post(URL, exc=requests.exceptions.ConnectionError)
+            self.assertEqual(client.gen_responses([['a.b']], payload), [])
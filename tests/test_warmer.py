@@ -0,0 +1,178 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+import requests_mock
+from graphite_api.storage import FindQuery
+
+from blueflood_graphite_finder import breaker, lifecycle, transport, \
+    warmer as warmer_module
+from blueflood_graphite_finder.breaker import RateLimiter
+from . import make_finder
+
+SEARCH_URL = 'http://dummy.com/v2.0/t/metric_name/search'
+VIEWS_URL = 'http://dummy.com/v2.0/t/views'
+SHARED = {'backend': 'local'}
+
+
+class FakeClock(object):
+    # Stands in for the time module: sleeping moves "now" along
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
+class TestRateLimiter(TestCase):
+    def setUp(self):
+        self.real_time = breaker.time
+        self.clock = breaker.time = FakeClock(1000)
+
+    def tearDown(self):
+        breaker.time = self.real_time
+
+    def test_acquire(self):
+        limiter = RateLimiter(50, burst=2)
+        for _ in range(2):
+            limiter.acquire()
+        self.assertEqual(self.clock.now, 1000)
+        # then one every 20ms
+        for _ in range(3):
+            limiter.acquire()
+        self.assertAlmostEqual(self.clock.now, 1000.06)
+
+    def test_transport(self):
+        limiter = RateLimiter(20, burst=1)
+        with requests_mock.mock() as m:
+            m.get(SEARCH_URL, json=[])
+            with transport.limited(limiter):
+                for _ in range(3):
+                    transport.get(SEARCH_URL)
+            self.assertAlmostEqual(self.clock.now, 1000.1)
+            # nothing waits outside of the block
+            for _ in range(3):
+                transport.get(SEARCH_URL)
+            self.assertAlmostEqual(self.clock.now, 1000.1)
+
+
+class TestCacheWarmer(TestCase):
+    def test_targets(self):
+        finder = make_finder(shared_cache=SHARED, cache_warmer={
+            'targets': ['x.*', {'target': 'a.*', 'window': 3600}],
+            'rate': 100})
+        warmer = finder.warmer
+        # not running until the finder is used
+        self.assertIsNone(warmer.thread)
+        with requests_mock.mock() as m:
+            m.get(SEARCH_URL, json=[{'a.b': True}, {'a.c': False}])
+            m.post(VIEWS_URL, json={'metrics': []})
+            warmer.warm()
+            self.assertEqual(m.call_count, 3)
+            self.assertEqual(
+                [r.qs['query'] for r in m.request_history[:2]],
+                [['x.*'], ['a.*']])
+            views = m.request_history[2]
+            self.assertEqual(json.loads(views.body), ['a.b'])
+            self.assertTrue(int(views.qs['to'][0]) -
+                            int(views.qs['from'][0]) >= 3600000)
+        self.assertEqual(warmer.stats()['warmed'], 2)
+        warmer.stop()
+
+    def test_learn(self):
+        finder = make_finder(shared_cache=SHARED,
+                             cache_warmer={'learn': 1, 'rate': 100})
+        warmer = finder.warmer
+        now = time.time()
+        with requests_mock.mock() as m:
+            m.get(SEARCH_URL, json=[])
+            for pattern, times in (('a.*', 3), ('b.*', 2), ('c.*', 1)):
+                for i in range(times):
+                    query = FindQuery(pattern, now - 3600 + i, now + i)
+                    list(finder.find_nodes(query))
+            # the past isn't learned
+            list(finder.find_nodes(FindQuery('d.*', 0, 3600)))
+            list(finder.find_nodes(FindQuery('d.*', 0, 3600)))
+        self.assertIsNotNone(warmer.thread)
+        warmer.stop()
+        self.assertEqual(len(warmer.seen), 3)
+        targets = warmer.current_targets()
+        self.assertEqual([t.key() for t in targets], [(None, 'a.*', 3600)])
+        # decayed: a.* is down to 1.5 hits, b.* to 1, c.* forgotten
+        self.assertEqual(sorted(warmer.seen.values()), [1, 1.5])
+        self.assertEqual(warmer.current_targets(), [])
+
+    def test_busy(self):
+        finder = make_finder(max_concurrent_renders=1, shared_cache=SHARED,
+                             cache_warmer={'targets': ['a.*']})
+        with requests_mock.mock() as m:
+            m.get(SEARCH_URL, json=[])
+            with finder.admission:
+                finder.warmer.warm()
+            self.assertEqual(m.call_count, 0)
+            self.assertEqual(finder.warmer.skipped, 1)
+            finder.warmer.warm()
+            self.assertEqual(m.call_count, 1)
+
+    def test_render_after_warm(self):
+        finder = make_finder(shared_cache=SHARED, cache_warmer={
+            'targets': [{'target': 'a.*', 'window': 3600}], 'rate': 100})
+        # the entries outlive a round
+        self.assertEqual(finder.shared_cache.fetch_ttl, 60)
+        end = int(time.time())
+        real_time = warmer_module.time
+        warmer_module.time = FakeClock(end)
+        try:
+            with requests_mock.mock() as m:
+                m.get(SEARCH_URL, json=[{'a.b': True}])
+                m.post(VIEWS_URL, json={'metrics': [
+                    {'metric': 'a.b', 'data': [
+                        {'timestamp': (end - 600) * 1000, 'average': 1}]}]})
+                finder.warmer.warm()
+                self.assertEqual(m.call_count, 2)
+                query = FindQuery('a.*', end - 3600, end)
+                leaves = [n for n in finder.find_nodes(query) if n.is_leaf]
+                time_info, series = finder.fetch_multi(leaves, end - 3600,
+                                                       end)
+                self.assertEqual(m.call_count, 2)
+            self.assertIn(1, series['a.b'])
+        finally:
+            warmer_module.time = real_time
+            finder.warmer.stop()
+
+    def test_needs_shared_cache(self):
+        # without one, warming only adds load
+        self.assertRaises(ValueError, make_finder,
+                          cache_warmer={'targets': ['a.*']})
+
+    def test_shared(self):
+        # only one of the workers sharing a cache warms each target
+        cache_dir = tempfile.mkdtemp()
+        try:
+            config = {'shared_cache': {'backend': 'shm', 'slots': 64,
+                                       'path': os.path.join(cache_dir, 'c')},
+                      'cache_warmer': {'targets': ['a.*'], 'rate': 100}}
+            finders = [make_finder(**config) for _ in range(2)]
+            with requests_mock.mock() as m:
+                m.get(SEARCH_URL, json=[])
+                for f in finders:
+                    f.warmer.warm()
+                self.assertEqual(m.call_count, 1)
+            self.assertEqual([f.warmer.skipped for f in finders], [0, 1])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_after_fork(self):
+        finder = make_finder(shared_cache=SHARED,
+                             cache_warmer={'interval': 60})
+        finder.warmer.start()
+        lifecycle.pid = -1
+        lifecycle.check()
+        self.assertIsNone(finder.warmer.thread)
+        finder.warmer.stop()
@@ -1,9 +1,11 @@
 from blueflood_graphite_finder.blueflood import TenantBluefloodFinder, \
     TenantBluefloodReader, TenantBluefloodLeafNode, \
-    BluefloodClient, calc_res, NonNestedDataKey, NestedDataKey
+    BluefloodClient, calc_res, NonNestedDataKey, NestedDataKey, MISSING, \
+    step_correction
 
 import datetime
 import logging.config
+import multiprocessing
 import threading
 import unittest
 from unittest import TestCase
@@ -11,6 +13,12 @@ from unittest import TestCase
 import os
 import requests_mock
 from blueflood_graphite_finder import auth
+from blueflood_graphite_finder import codec
+from blueflood_graphite_finder import intervals
+from blueflood_graphite_finder import offload
+from blueflood_graphite_finder import transport
+from blueflood_graphite_finder.errors import BluefloodError
+from blueflood_graphite_finder.intervals import IntervalTracker
 
 logging_file = os.path.join(os.path.dirname(__file__), 'logging.ini')
 logging.config.fileConfig(logging_file)
@@ -362,6 +370,152 @@ class BluefloodTests(TestCase):
                               nodes[0].path: [None, None, None, None, 13, 12,
                                               11, 11, None]})
 
+    def test_fetch_offload(self):
+        step = 3000
+        start = 1426120000
+        end = 1426147000
+        endpoint = self.bfc.get_multi_endpoint(self.finder.bf_query_endpoint,
+                                               self.finder.tenant)
+        decoded = []
+        loads = codec.loads
+
+        def counting_loads(s):
+            decoded.append(s)
+            return loads(s)
+
+        metrics = (self.metric1, self.metric2, self.metric3)
+        for make in (self.make_data, self.make_enum_data):
+            nodes, responses = make(start, step)
+            for align in (False, True):
+                self.bfc.align_windows = align
+                with requests_mock.mock() as m:
+                    m.post(endpoint, json={'metrics': responses})
+                    intervals.set_tracker(IntervalTracker())
+                    expected = self.bfc.fetch_multi(nodes, start, end)
+                    gaps = [intervals.tracker.gaps.get((self.bfc.tenant, r))
+                            for r in metrics]
+                    intervals.set_tracker(IntervalTracker())
+                    offload.configure(2, 1)
+                    codec.loads = counting_loads
+                    try:
+                        time_info, dictionary = self.bfc.fetch_multi(
+                            nodes, start, end)
+                    finally:
+                        codec.loads = loads
+                        offload.configure()
+                self.assertEqual(time_info, expected[0])
+                self.assertDictEqual(dictionary, expected[1])
+                for path, values in dictionary.items():
+                    self.assertEqual(map(type, values),
+                                     map(type, expected[1][path]))
+                # the pool decoded the responses, not the request thread
+                self.assertEqual(decoded, [])
+                # and the interval tracker learnt the same gaps
+                self.assertNotEqual(gaps, [None] * len(metrics))
+                self.assertEqual([intervals.tracker.gaps.get(
+                    (self.bfc.tenant, r)) for r in metrics], gaps)
+
+    def test_fetch_offload_timeout(self):
+        step = 3000
+        start = 1426120000
+        end = 1426147000
+        endpoint = self.bfc.get_multi_endpoint(self.finder.bf_query_endpoint,
+                                               self.finder.tenant)
+        waits = []
+
+        class Lost(object):
+            # what a task given to a worker that died looks like
+            def get(self, timeout=None):
+                waits.append(timeout)
+                raise multiprocessing.TimeoutError()
+
+        class DeadPool(object):
+            def map_async(self, func, iterable, chunksize=None):
+                return Lost()
+
+        nodes, responses = self.make_data(start, step)
+        with requests_mock.mock() as m:
+            m.post(endpoint, json={'metrics': responses})
+            expected = self.bfc.fetch_multi(nodes, start, end)
+            offload.configure(2, 1, 10)
+            # forked when the finder is set up, not by the first fetch
+            self.assertIsNotNone(offload.pool)
+            pool = offload.pool
+            offload.pool = DeadPool()
+            try:
+                with transport.budget(5):
+                    result = self.bfc.fetch_multi(nodes, start, end)
+                result_without_budget = self.bfc.fetch_multi(nodes, start,
+                                                             end)
+            finally:
+                offload.pool = pool
+                offload.configure()
+        # processed by the request thread instead of waiting forever
+        self.assertEqual(result, expected)
+        self.assertEqual(result_without_budget, expected)
+        self.assertEqual(len(waits), 2)
+        self.assertTrue(0 <= waits[0] <= 5)
+        self.assertEqual(waits[1], 10)
+
+    def test_process_path_gaps(self):
+        # gaps are interpolated
+        key = NonNestedDataKey('sum')
+        values = [{'timestamp': 1000000, 'sum': 1.0},
+                  {'timestamp': 1240000, 'sum': 5.0}]
+        self.assertEqual(self.bfc.process_path(values, 1000, 1300, 60, key),
+                         [1.0, 2.0, 3.0, 4.0, 5.0])
+        # but not across null values
+        for points, expected in (
+                ([{'timestamp': 1000000, 'sum': 1.0},
+                  {'timestamp': 1060000, 'sum': None},
+                  {'timestamp': 1120000, 'sum': 3.0}],
+                 [1.0, None, 3.0, None, None]),
+                ([{'timestamp': 1000000, 'sum': 1.0},
+                  {'timestamp': 1060000, 'sum': None},
+                  {'timestamp': 1180000, 'sum': 4.0}],
+                 [1.0, None, None, 4.0, None])):
+            self.assertEqual(
+                self.bfc.process_path(points, 1000, 1300, 60, key), expected)
+        self.bfc.enable_statsd = True
+        self.assertEqual(self.bfc.process_path(values, 1000, 1360, 60, key),
+                         [1.0, None, None, None, 5.0, None])
+
+    def test_columns(self):
+        # the same values as extracting each datapoint on its own
+        def per_point(key, value, step):
+            if isinstance(key, NestedDataKey):
+                if key.key1 in value and key.key2 in value[key.key1]:
+                    return value[key.key1][key.key2]
+                return MISSING
+            if key.key1 not in value:
+                return MISSING
+            if key.key1 == 'average':
+                return step_correction(value[key.key1], step)
+            return value[key.key1]
+
+        values = [{u'timestamp': 1000000, u'average': 600, u'sum': 10},
+                  {u'timestamp': 1300000, u'average': None, u'sum': None},
+                  {u'timestamp': 1600000, u'sum': 7},
+                  {u'timestamp': 1900000, u'average': 45.5},
+                  {u'timestamp': 2200000, u'enum_values': {u'v1': 3}},
+                  {u'timestamp': 2500000, u'enum_values': {u'v2': 4}},
+                  {u'timestamp': 2800000, u'enum_values': {u'v1': None}}]
+        keys = [NonNestedDataKey(u'average'), NonNestedDataKey(u'sum'),
+                NestedDataKey(u'enum_values', u'v1')]
+        for key in keys:
+            for step in (60, 300, 3600):
+                times, vals = key.columns(values, step)
+                self.assertEqual(times, [1000, 1300, 1600, 1900, 2200, 2500,
+                                         2800])
+                expected = [per_point(key, v, step) for v in values]
+                self.assertEqual(vals, expected)
+                self.assertEqual(map(type, vals), map(type, expected))
+        # null and missing values differ
+        times, vals = keys[0].columns(values, 300)
+        self.assertEqual(vals[:3], [120, None, MISSING])
+        times, vals = keys[2].columns(values, 60)
+        self.assertEqual(vals[4:], [3, MISSING, None])
+
     def test_gen_responses(self):
         step = 3000
         start = 1426120000
@@ -373,8 +527,12 @@ class BluefloodTests(TestCase):
         # test 401 error
         with requests_mock.mock() as m:
             m.post(endpoint, json={}, status_code=401)
+            with self.assertRaises(BluefloodError):
+                self.bfc.gen_responses(groups1, payload)
+            self.bfc.partial_results = True
             responses = self.bfc.gen_responses(groups1, payload)
             self.assertSequenceEqual(responses, [])
+            self.bfc.partial_results = False
 
         # test single group
         _, responses = self.make_data(start, step)
@@ -582,6 +740,33 @@ class BluefloodTests(TestCase):
                          u'enum_values': enum_vals}],
                        [self.metric1 + '.' + v for v in enum_vals])
 
+    def test_negative_cache(self):
+        endpoint = self.finder.find_nodes_endpoint(
+            self.finder.bf_query_endpoint, self.finder.tenant)
+        endpoint_old = self.finder.find_metrics_endpoint(
+            self.finder.bf_query_endpoint, self.finder.tenant)
+        query = FindQuery("x.*", 1, 2)
+        with requests_mock.mock() as m:
+            m.get(endpoint, json=[], status_code=200)
+            self.assertEqual(self.finder.find_nodes_from_bf(query), [])
+            self.assertEqual(self.finder.find_nodes_from_bf(query), [])
+            self.assertEqual(m.call_count, 1)
+
+            # auth failures aren't remembered
+            m.get(endpoint, json={}, status_code=401)
+            query = FindQuery("y.*", 1, 2)
+            self.assertEqual(self.finder.find_nodes_from_bf(query), [])
+            self.assertEqual(self.finder.find_nodes_from_bf(query), [])
+            self.assertEqual(m.call_count, 3)
+
+            m.get(endpoint_old, json={}, status_code=500)
+            self.assertEqual(
+                self.finder.find_metrics_with_enum_values("z.*"), {})
+            self.assertEqual(
+                self.finder.find_metrics_with_enum_values("z.*"), {})
+            self.assertEqual(m.call_count, 4)
+        self.assertEqual(self.finder.cache_stats()['negative']['hits'], 2)
+
     def test_fetch(self):
         step = 3000
         start = 1426120000
@@ -645,6 +830,63 @@ class BluefloodTests(TestCase):
                 time_info, dictionary = self.finder.fetch_multi(nodes, start,
                                                                 end)
 
+    def test_fetch_max_data_points(self):
+        step = 3000
+        start = 1426120000
+        end = 1426147000
+        endpoint = self.bfc.get_multi_endpoint(self.finder.bf_query_endpoint,
+                                               self.finder.tenant)
+        nodes, responses = self.make_data(start, step)
+        with requests_mock.mock() as m:
+            m.post(endpoint, json={'metrics': responses}, status_code=200)
+            # 450 minutes only needs MIN20 rollups to fill 20 points
+            time_info, dictionary = self.finder.fetch_multi(nodes, start, end,
+                                                            20)
+            self.assertEqual(m.last_request.qs['resolution'], ['min20'])
+            self.assertSequenceEqual(time_info, (start, end + 1200, 1200))
+            self.assertEqual(len(dictionary['a.b.c']), 24)
+
+            # configured default
+            self.finder.client.max_data_points = 20
+            time_info, dictionary = self.finder.fetch_multi(nodes, start, end)
+            self.assertSequenceEqual(time_info, (start, end + 1200, 1200))
+
+    def test_fetch_aligned(self):
+        # raw points, the first and last just outside the range
+        start = 1426120010
+        end = 1426121015
+        data = [{'timestamp': ts * 1000, 'average': ts % 1000}
+                for ts in range(1426119990, 1426120900, 60) + [1426121020]]
+
+        def multiplot(request, context):
+            lo = int(request.qs['from'][0])
+            hi = int(request.qs['to'][0])
+            return {'metrics': [{'metric': 'a.b.c', 'data': [
+                d for d in data if lo <= d['timestamp'] < hi]}]}
+
+        endpoint = self.bfc.get_multi_endpoint(self.finder.bf_query_endpoint,
+                                               self.finder.tenant)
+        results = []
+        with requests_mock.mock() as m:
+            m.post(endpoint, json=multiplot)
+            for align in (False, True):
+                client = BluefloodClient(self.finder.bf_query_endpoint,
+                                         self.finder.tenant, False, {}, False,
+                                         align_windows=align)
+                reader = TenantBluefloodReader('a.b.c', self.finder.tenant,
+                                               self.finder.bf_query_endpoint,
+                                               False, {}, None)
+                node = TenantBluefloodLeafNode('a.b.c', reader)
+                results.append(client.fetch_multi([node], start, end))
+            # the same series, from whole minutes
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(m.last_request.qs['from'], ['1426119960000'])
+            self.assertEqual(m.last_request.qs['to'], ['1426121040000'])
+            # so a render a few seconds later asks for the same
+            client.fetch_multi([node], start + 5, end + 5)
+            self.assertEqual(m.request_history[-1].qs,
+                             m.request_history[-2].qs)
+
     def test_calc_res(self):
         start = 0
         # 1 minute more than 18 weeks: